@@ -3,15 +3,20 @@
 from rest_framework import serializers
 
 from emergency.models import Building
+from utils.imageUtil import ImageUrlField
 
 
 class EmergencyCreateSerializer(serializers.ModelSerializer):
+    image = ImageUrlField(max_length=255, required=False)
+
     class Meta:
         model = Building
         exclude = ("id", "type", "create_time")
 
 
 class EmergencyDetailSerializer(serializers.ModelSerializer):
+    image = ImageUrlField(max_length=255, required=False)
+
     class Meta:
         model = Building
         fields = "__all__"
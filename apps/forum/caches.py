@@ -0,0 +1,21 @@
+from utils.cacheUtil import ResponseCache, bump_version
+
+# 首页帖子列表缓存，按社区区分版本
+topic_list_cache = ResponseCache("topic_list")
+# 用户社区列表缓存
+community_list_cache = ResponseCache("community_list")
+
+
+def topic_namespace(community_id=None):
+    if community_id:
+        return "topics:community:%s" % community_id
+    return "topics:all"
+
+
+def invalidate_topics(community_id):
+    """社区内帖子或评论变化时，使该社区和全部帖子列表的缓存失效"""
+    bump_version(topic_namespace(), topic_namespace(community_id))
+
+
+def invalidate_communities():
+    bump_version("communities")
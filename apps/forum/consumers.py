@@ -0,0 +1,37 @@
+from django.conf import settings
+
+import forum.counters  # noqa: F401 注册计数缓冲
+from forum.models import Community, CommunityUsers
+from utils import serviceLogger
+from utils.counterUtil import CounterBuffer, flush_all
+from utils.mqUtil import message_handler
+from utils.yunpianUtil import YunPian
+
+
+@message_handler("forum.flush_counters")
+def flush_counters(data):
+    """
+    将redis中缓冲的帖子计数写回数据库
+    进程内的计数只能由所在web进程的刷新线程写回，消费者进程中没有这些计数，需要配置COUNTER_BUFFER_BACKEND=redis
+    """
+    local = [buffer for buffer in CounterBuffer.registry if not buffer.store.shared]
+    if local:
+        serviceLogger.warning("进程内计数缓冲不能由消费者刷新，需要配置COUNTER_BUFFER_BACKEND=redis: %s",
+                              ", ".join("%s.%s" % (buffer.model.__name__, buffer.field) for buffer in local))
+    return flush_all(shared_only=True)
+
+
+@message_handler("forum.announcement_sms")
+def send_announcement_sms(data):
+    """社区公告短信群发给社区成员(不含创建者)，内容由settings.COMMUNITY_ANNOUNCEMENT_SMS模板生成"""
+    community = Community.objects.filter(id=data["community"]).first()
+    if community is None or not community.announcement:
+        return None
+    mobiles = CommunityUsers.objects.filter(community=community).exclude(user_id=community.user_id) \
+        .exclude(user__mobile="").values_list("user__mobile", flat=True).distinct()
+    text = settings.COMMUNITY_ANNOUNCEMENT_SMS.format(name=community.name, announcement=community.announcement)
+    results = YunPian().broadcast(list(mobiles), text)
+    failed = [mobile for mobile, result in results.items() if result.get("code") != 0]
+    if failed:
+        serviceLogger.error("社区公告短信发送失败 %s: %s", community.id, ", ".join(failed))
+    return results
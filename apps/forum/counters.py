@@ -0,0 +1,7 @@
+from forum.models import Topic
+from utils.counterUtil import CounterBuffer
+
+# 帖子查看量写缓冲
+topic_views = CounterBuffer(Topic, "views")
+# 帖子点赞数写缓冲
+topic_thumbs = CounterBuffer(Topic, "thumbs")
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from utils import responseUtil
+from utils.responseUtil import CustomRenderer, FastJSONRenderer
+
+
+class Command(BaseCommand):
+    help = "压测用: 对比CustomRenderer与FastJSONRenderer渲染帖子列表的吞吐量"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-sizes", default="12,100,1000", help="每页帖子数，逗号分隔")
+        parser.add_argument("--rounds", type=int, default=200, help="每种渲染器的渲染次数")
+
+    def handle(self, *args, **options):
+        renderers = [("CustomRenderer", CustomRenderer(), None)]
+        if responseUtil.orjson is not None:
+            renderers.append(("FastJSONRenderer(orjson)", FastJSONRenderer(), responseUtil.orjson))
+        renderers.append(("FastJSONRenderer(json)", FastJSONRenderer(), None))
+
+        for page_size in [int(size) for size in options["page_sizes"].split(",")]:
+            self.stdout.write("========== 每页%d条 ==========" % page_size)
+            expected = None
+            for name, renderer, backend in renderers:
+                responseUtil.orjson, origin = backend, responseUtil.orjson
+                try:
+                    content, cost = self.bench(renderer, page_size, options["rounds"])
+                finally:
+                    responseUtil.orjson = origin
+                expected = expected or content
+                self.stdout.write("-- %s: %.2fms/次, %.1fMB/s, 输出%s" % (
+                    name, cost * 1000 / options["rounds"], len(content) * options["rounds"] / cost / 1024 / 1024,
+                    "一致" if content == expected else "不一致"))
+
+    def bench(self, renderer, page_size, rounds):
+        cost = 0
+        for _ in range(rounds):
+            # wrap会修改data，每次渲染使用新数据
+            data = self.payload(page_size)
+            start = time.perf_counter()
+            content = renderer.render(data, "application/json", {"view": APIView(), "response": Response(status=200)})
+            cost += time.perf_counter() - start
+        return content, cost
+
+    def payload(self, page_size):
+        now = datetime(2021, 6, 1, 12, 0, 0)
+        results = [OrderedDict([
+            ("id", i),
+            ("user", OrderedDict([("id", i % 50), ("nick_name", "蘑菇用户%d" % i), ("avatar", "avatar/%d.png" % i)])),
+            ("community", i % 10),
+            ("title", "帖子标题 %d" % i),
+            ("content", "这是一段帖子内容，包含中文、English和emoji😀。" * 5),
+            ("images", ["topic/%d_%d.png" % (i, j) for j in range(3)]),
+            ("views", i * 7),
+            ("thumbs", i * 3),
+            ("comments", i),
+            ("level", 0),
+            ("is_thumbed", bool(i % 2)),
+            ("create_time", now - timedelta(minutes=i)),
+        ]) for i in range(page_size)]
+        return OrderedDict([("count", page_size * 10), ("next", "http://localhost/?page=2"),
+                            ("previous", None), ("results", results)])
@@ -0,0 +1,101 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from forum.models import Community, CommunityCard, CommunityUsers, Topic, TopicComment
+from users.models import User, VerifyCode
+
+FEED_ORDERING = ("-level", "-create_time", "-id")
+
+
+class Command(BaseCommand):
+    help = "压测用: 写入大量帖子，对比删除/恢复Meta.indexes前后热点查询的EXPLAIN和耗时，只能在测试库执行"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--topics", type=int, default=1000000, help="帖子总数")
+        parser.add_argument("--users", type=int, default=1000, help="用户数量")
+        parser.add_argument("--communities", type=int, default=100, help="社区数量")
+        parser.add_argument("--batch-size", type=int, default=10000, help="bulk_create每批数量")
+        parser.add_argument("--skip-seed", action="store_true", help="不写入数据，直接对比")
+
+    def handle(self, *args, **options):
+        if not options["skip_seed"]:
+            self.seed(options)
+        user = User.objects.filter(username__startswith="bench_").first()
+        community = Community.objects.filter(name__startswith="bench_").first()
+        if user is None or community is None:
+            raise CommandError("没有压测数据，请先去掉--skip-seed执行")
+
+        queries = [
+            ("首页帖子流", Topic.objects.order_by(*FEED_ORDERING)[:12]),
+            ("社区帖子流", Topic.objects.filter(community=community).order_by(*FEED_ORDERING)[:12]),
+            ("社区帖子按时间", Topic.objects.filter(community=community).order_by("-create_time")[:12]),
+            ("用户帖子", Topic.objects.filter(user=user).order_by(*FEED_ORDERING)[:12]),
+            ("社区成员校验", CommunityUsers.objects.filter(user=user, community=community)),
+            ("验证码频率", VerifyCode.objects.filter(mobile=user.mobile,
+                                                  add_time__gt=datetime.now() - timedelta(minutes=1))),
+            ("我的名片", CommunityCard.objects.filter(status=1)[:12]),
+        ]
+        models = [Topic, CommunityUsers, TopicComment, CommunityCard, VerifyCode]
+        indexes = [(model, index) for model in models for index in model._meta.indexes if self.has_index(model, index)]
+        if not indexes:
+            raise CommandError("数据库中没有Meta.indexes声明的索引，请先执行migrate")
+
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.remove_index(model, index)
+        try:
+            self.report("删除索引后", queries)
+        finally:
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    editor.add_index(model, index)
+        self.report("恢复索引后", queries)
+
+    def has_index(self, model, index):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        return index.name in constraints
+
+    def report(self, title, queries):
+        self.stdout.write("========== %s ==========" % title)
+        for name, queryset in queries:
+            start = time.perf_counter()
+            list(queryset)
+            cost = (time.perf_counter() - start) * 1000
+            self.stdout.write("-- %s: %.2fms" % (name, cost))
+            self.stdout.write(queryset.explain())
+
+    def seed(self, options):
+        batch_size = options["batch_size"]
+        users = list(User.objects.filter(username__startswith="bench_"))
+        for i in range(len(users), options["users"]):
+            users.append(User(username="bench_%d" % i, mobile="1%010d" % i))
+        User.objects.bulk_create([user for user in users if user.pk is None], batch_size=batch_size)
+        users = list(User.objects.filter(username__startswith="bench_"))
+
+        communities = list(Community.objects.filter(name__startswith="bench_"))
+        new_communities = [Community(user=random.choice(users), name="bench_%d" % i, avatar="")
+                           for i in range(len(communities), options["communities"])]
+        Community.objects.bulk_create(new_communities, batch_size=batch_size)
+        communities = list(Community.objects.filter(name__startswith="bench_"))
+        if not CommunityUsers.objects.filter(user__username__startswith="bench_").exists():
+            CommunityUsers.objects.bulk_create(
+                [CommunityUsers(user=user, community=random.choice(communities)) for user in users],
+                batch_size=batch_size)
+
+        start_time = datetime.now() - timedelta(days=365)
+        remaining = options["topics"] - Topic.objects.count()
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            Topic.objects.bulk_create([
+                Topic(user=random.choice(users), community=random.choice(communities), title="bench",
+                      content="bench", level=1 if random.random() < 0.001 else 0,
+                      create_time=start_time + timedelta(seconds=random.randint(0, 365 * 86400)))
+                for _ in range(size)
+            ])
+            remaining -= size
+            self.stdout.write("剩余 %d" % remaining)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+import forum.counters  # noqa: F401 注册计数缓冲
+from utils.counterUtil import flush_all
+
+
+class Command(BaseCommand):
+    help = "将缓冲的帖子计数批量写回数据库，配合redis计数存储由定时任务调用"
+
+    def handle(self, *args, **options):
+        flushed = flush_all()
+        self.stdout.write("flushed %d rows" % flushed)
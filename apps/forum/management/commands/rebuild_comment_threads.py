@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from forum.models import TopicComment
+
+
+class Command(BaseCommand):
+    help = "为历史评论回填root_comment，按帖子分批处理"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批bulk_update的评论数量")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        topic_ids = TopicComment.objects.filter(parent_comment__isnull=False, root_comment__isnull=True) \
+            .values_list("topic_id", flat=True).distinct()
+        fixed = 0
+        for topic_id in list(topic_ids):
+            parents = dict(TopicComment.objects.filter(topic_id=topic_id).values_list("id", "parent_comment_id"))
+            changed = []
+            for comment in TopicComment.objects.filter(topic_id=topic_id, parent_comment__isnull=False) \
+                    .only("id", "root_comment_id"):
+                root_id = comment.id
+                while parents.get(root_id):
+                    root_id = parents[root_id]
+                if comment.root_comment_id != root_id:
+                    comment.root_comment_id = root_id
+                    changed.append(comment)
+            with transaction.atomic():
+                TopicComment.objects.bulk_update(changed, ["root_comment"], batch_size=batch_size)
+            fixed += len(changed)
+        self.stdout.write("fixed %d comments" % fixed)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from forum.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "创建并重建帖子全文检索索引(MySQL创建FULLTEXT ngram索引，SQLite重建FTS5表)，migrate后会自动创建"
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if backend is None:
+            self.stdout.write("TOPIC_SEARCH_BACKEND=like，无需建立索引")
+            return
+        backend.rebuild()
+        self.stdout.write("rebuilt %s" % backend.__class__.__name__)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from forum.models import Topic, TopicComment
+
+
+class Command(BaseCommand):
+    help = "根据评论记录分批重新计算帖子的comments计数"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批处理的帖子数量")
+
+    def handle(self, *args, **options):
+        # 只重算评论数：点赞数有缓冲中的增量，且早期的点赞没有TopicThumb记录，不能按记录重算
+        batch_size = options["batch_size"]
+        last_id, checked, fixed = 0, 0, 0
+        while True:
+            with transaction.atomic():
+                # 锁住本批帖子，重算期间新增的评论会等待本批提交
+                topics = list(Topic.objects.select_for_update().filter(id__gt=last_id).order_by("id")
+                              .only("id", "comments")[:batch_size])
+                if not topics:
+                    break
+                last_id = topics[-1].id
+                comments = dict(TopicComment.objects.filter(topic_id__in=[topic.id for topic in topics])
+                                .values("topic_id").annotate(total=Count("id")).values_list("topic_id", "total"))
+
+                changed = []
+                for topic in topics:
+                    comment_count = comments.get(topic.id, 0)
+                    if topic.comments != comment_count:
+                        topic.comments = comment_count
+                        changed.append(topic)
+                if changed:
+                    Topic.objects.bulk_update(changed, ["comments"], batch_size=batch_size)
+            checked += len(topics)
+            fixed += len(changed)
+
+        self.stdout.write("checked %d topics, fixed %d" % (checked, fixed))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from forum.caches import topic_list_cache, community_list_cache
+
+
+class Command(BaseCommand):
+    help = "查看接口响应缓存的命中、未命中次数"
+
+    def handle(self, *args, **options):
+        for response_cache in (topic_list_cache, community_list_cache):
+            stats = response_cache.stats()
+            total = stats["hit"] + stats["miss"]
+            ratio = stats["hit"] / total if total else 0
+            self.stdout.write("%s: hit=%d miss=%d wait=%d hit_ratio=%.2f" % (
+                response_cache.prefix, stats["hit"], stats["miss"], stats["wait"], ratio))
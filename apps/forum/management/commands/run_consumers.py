@@ -0,0 +1,86 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+import pika
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.module_loading import autodiscover_modules
+
+from utils.mqUtil import ConsumerStats, MQConsumer, get_connection_factory, message_handlers, queue_depth
+
+
+def run_worker(addr, queue_name, prefetch, stats, stop_event, ignore_signals):
+    if ignore_signals:
+        # 子进程不直接响应Ctrl+C，由主进程通知处理完当前消息后退出
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    MQConsumer(get_connection_factory(addr), queue_name, prefetch, stats).run(stop_event)
+
+
+class Command(BaseCommand):
+    help = "启动RabbitMQ消费者，按消息type分发给各app consumers模块中注册的处理函数"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue", default=getattr(settings, "RABBITMQ_QUEUE", "mushroom"), help="队列名")
+        parser.add_argument("--addr", default=getattr(settings, "RABBITMQ_ADDR", "localhost"), help="RabbitMQ地址")
+        parser.add_argument("--workers", type=int, default=4, help="worker数量")
+        parser.add_argument("--mode", choices=("thread", "process"), default="process",
+                            help="thread适合IO密集的处理函数，process可利用多核")
+        parser.add_argument("--prefetch", type=int, default=getattr(settings, "RABBITMQ_PREFETCH", 10),
+                            help="每个worker未确认消息上限")
+        parser.add_argument("--stats-interval", type=int, default=10, help="输出统计的间隔秒数")
+
+    def handle(self, *args, **options):
+        autodiscover_modules("consumers")
+        self.stdout.write("handlers: %s" % ", ".join(sorted(message_handlers)))
+
+        stats = ConsumerStats()
+        if options["mode"] == "process":
+            stop_event = multiprocessing.Event()
+            # 子进程不能复用父进程的数据库连接
+            connections.close_all()
+            worker_class = multiprocessing.Process
+        else:
+            stop_event = threading.Event()
+            worker_class = threading.Thread
+        workers = [worker_class(target=run_worker, name="consumer-%d" % i,
+                                args=(options["addr"], options["queue"], options["prefetch"], stats, stop_event,
+                                      options["mode"] == "process"))
+                   for i in range(options["workers"])]
+
+        stopping = []
+
+        def shutdown(signum, frame):
+            # 信号处理函数中不能操作stop_event，主线程可能正持有它的锁
+            stopping.append(signum)
+        # 先安装信号处理再启动worker，避免非daemon的worker线程导致进程无法退出
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        for worker in workers:
+            worker.start()
+
+        factory = get_connection_factory(options["addr"])
+        last, last_time = stats.snapshot(), time.monotonic()
+        while not stopping:
+            time.sleep(0.2)
+            if time.monotonic() - last_time < options["stats_interval"]:
+                continue
+            current, now = stats.snapshot(), time.monotonic()
+            try:
+                depth = queue_depth(factory, options["queue"])
+            except pika.exceptions.AMQPError:
+                depth = "-"
+            self.stdout.write("processed=%d failed=%d rate=%.1f/s lag=%.2fs queue=%s" % (
+                current["processed"], current["failed"],
+                (current["processed"] - last["processed"]) / (now - last_time),
+                current["lag"], depth))
+            last, last_time = current, now
+
+        self.stdout.write("stopping, waiting for workers to finish current messages")
+        stop_event.set()
+        for worker in workers:
+            worker.join()
+        self.stdout.write("processed=%(processed)d failed=%(failed)d" % stats.snapshot())
@@ -38,6 +38,12 @@ class CommunityUsers(models.Model):
     class Meta:
         verbose_name = "社区成员"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 成员校验、管理员权限按用户+社区查询
+            models.Index(fields=["user", "community"], name="community_users_user_idx"),
+            # 社区成员列表按社区过滤、按加入时间排序
+            models.Index(fields=["community", "create_time"], name="community_users_time_idx"),
+        ]
 
     def __str__(self):
         return self.user.name
@@ -62,11 +68,45 @@ class Topic(models.Model):
     class Meta:
         verbose_name = "帖子"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 首页帖子流 TopicPagination: level, create_time, id 倒序
+            models.Index(fields=["level", "create_time", "id"], name="topic_feed_idx"),
+            # TopicFilter按社区过滤后按帖子流排序或按create_time排序
+            models.Index(fields=["community", "level", "create_time"], name="topic_community_feed_idx"),
+            models.Index(fields=["community", "create_time"], name="topic_community_time_idx"),
+            # 用户帖子列表
+            models.Index(fields=["user", "level", "create_time"], name="topic_user_feed_idx"),
+        ]
 
     def __str__(self):
         return self.title
 
 
+class TopicThumb(models.Model):
+    """帖子点赞记录"""
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(User, related_name="user_thumbs", on_delete=models.CASCADE, verbose_name="点赞用户")
+    topic = models.ForeignKey(Topic, related_name="topic_thumbs", on_delete=models.CASCADE, verbose_name="帖子id")
+    create_time = models.DateTimeField(default=datetime.now, verbose_name="点赞时间")
+
+    class Meta:
+        verbose_name = "帖子点赞"
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(fields=("user", "topic"), name="unique_user_topic_thumb"),
+        ]
+
+    def __str__(self):
+        return "%s-%s" % (self.user_id, self.topic_id)
+
+    @classmethod
+    def thumbed_topic_ids(cls, user, topic_ids):
+        """一次查询返回用户已点赞的帖子id集合"""
+        if not user.is_authenticated or not topic_ids:
+            return set()
+        return set(cls.objects.filter(user=user, topic_id__in=topic_ids).values_list("topic_id", flat=True))
+
+
 class TopicComment(models.Model):
     """帖子评论"""
     id = models.AutoField(primary_key=True)
@@ -74,11 +114,18 @@ class TopicComment(models.Model):
     topic = models.ForeignKey(Topic, related_name="topic_comment", on_delete=models.CASCADE, verbose_name="帖子id")
     content = models.TextField(null=False, blank=False, verbose_name="评论内容")
     parent_comment = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE, verbose_name="父级评论")
+    root_comment = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE,
+                                     related_name="thread_comments", verbose_name="所属根评论，根评论本身为空")
     create_time = models.DateTimeField(default=datetime.now, verbose_name="评论时间")
 
     class Meta:
         verbose_name = "帖子评论"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 评论树: 帖子的根评论按时间分页、线程内回复按时间排序
+            models.Index(fields=["topic", "parent_comment", "create_time"], name="comment_topic_root_idx"),
+            models.Index(fields=["root_comment", "create_time"], name="comment_thread_idx"),
+        ]
 
     def __str__(self):
         return self.id
@@ -120,3 +167,9 @@ class CommunityCard(models.Model):
     status = models.IntegerField(default=0, verbose_name="状态 0-等待被交换人同意交换 1-已同意交换名片 2-拒绝交换名片")
     count = models.IntegerField(default=3, verbose_name="交换名片计数 最大三次")
     create_time = models.DateTimeField(default=datetime.now, verbose_name="交换名片时间")
+
+    class Meta:
+        indexes = [
+            # 我的名片列表按状态过滤
+            models.Index(fields=["status", "create_time"], name="community_card_status_idx"),
+        ]
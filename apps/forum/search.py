@@ -0,0 +1,225 @@
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, FloatField, Q, When
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+
+from forum.models import Topic
+
+
+class BaseSearchBackend(object):
+    """
+    帖子全文检索后端
+    search返回按相关度排序的queryset，长度小于min_term_length的词无法走全文索引，退化为LIKE
+    """
+    min_term_length = 1
+
+    def search(self, queryset, terms):
+        short_terms = [term for term in terms if len(term) < self.min_term_length]
+        terms = [term for term in terms if len(term) >= self.min_term_length]
+        for term in short_terms:
+            queryset = queryset.filter(Q(title__icontains=term) | Q(content__icontains=term))
+        if not terms:
+            return queryset
+        return self.match(queryset, terms)
+
+    def match(self, queryset, terms):
+        raise NotImplementedError
+
+    def index(self, topic):
+        """帖子新建或更新后调用"""
+
+    def remove(self, topic_id):
+        """帖子删除后调用"""
+
+    def setup(self):
+        """创建索引结构，migrate后调用"""
+
+    def rebuild(self):
+        """重建索引"""
+
+
+class MySQLFulltextBackend(BaseSearchBackend):
+    """MySQL FULLTEXT ngram索引，migrate后创建，由MySQL随写入自动维护"""
+    index_name = "topic_fulltext_idx"
+    # 与MySQL ngram_token_size保持一致
+    min_term_length = getattr(settings, "TOPIC_SEARCH_NGRAM_SIZE", 2)
+
+    def match(self, queryset, terms):
+        against = " ".join('+"%s"' % term.replace('"', " ") for term in terms)
+        rank = RawSQL("MATCH (forum_topic.title, forum_topic.content) AGAINST (%s IN BOOLEAN MODE)", (against,))
+        return queryset.annotate(search_rank=rank).filter(search_rank__gt=0).order_by("-search_rank")
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW INDEX FROM forum_topic WHERE Key_name = %s", [self.index_name])
+            if not cursor.fetchall():
+                cursor.execute("ALTER TABLE forum_topic ADD FULLTEXT INDEX %s (title, content) WITH PARSER ngram"
+                               % self.index_name)
+
+    def rebuild(self):
+        self.setup()
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """SQLite FTS5 trigram索引，用于开发和测试"""
+    table = "forum_topic_fts"
+    min_term_length = 3
+
+    def match(self, queryset, terms):
+        query = " ".join('"%s"' % term.replace('"', '""') for term in terms)
+        matched = RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (self.table, self.table), (query,))
+        # bm25越小越相关
+        rank = RawSQL("SELECT bm25(%s) FROM %s WHERE %s MATCH %%s AND rowid = forum_topic.id"
+                      % (self.table, self.table, self.table), (query,))
+        return queryset.filter(id__in=matched).annotate(search_rank=rank).order_by("search_rank")
+
+    def index(self, topic):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" % self.table, [topic.id])
+            cursor.execute("INSERT INTO %s (rowid, title, content) VALUES (%%s, %%s, %%s)" % self.table,
+                           [topic.id, topic.title, topic.content or ""])
+
+    def remove(self, topic_id):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" % self.table, [topic_id])
+
+    def setup(self):
+        """FTS5表不在migration中，migrate后创建，新建时导入已有帖子"""
+        if self.table not in connection.introspection.table_names():
+            self.rebuild()
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, content, tokenize='trigram')"
+                           % self.table)
+            cursor.execute("DELETE FROM %s" % self.table)
+            cursor.execute("INSERT INTO %s (rowid, title, content) SELECT id, title, COALESCE(content, '') "
+                           "FROM forum_topic" % self.table)
+
+
+def tokenize(text):
+    """英文数字按单词切分，中文按二元组切分"""
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+|[^\W\da-z_]+", (text or "").lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    """
+    进程内倒排索引，首次检索时从数据库构建，之后随帖子增删改增量更新
+    索引只由本进程的post_save/post_delete信号更新，其他进程修改的帖子要等本进程重启(或调用rebuild)后才能检索到，
+    因此只适合单进程部署和开发环境，多进程部署应使用数据库的全文索引
+    """
+    # 中文按二元组建索引，单字退化为LIKE
+    min_term_length = 2
+    # 只返回得分最高的前N个帖子，避免常见词生成过长的SQL(SQLite默认最多999个参数，每个帖子占3个)
+    max_results = getattr(settings, "TOPIC_SEARCH_MAX_RESULTS", 200)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = defaultdict(dict)
+        self._documents = {}
+        self._built = False
+
+    def match(self, queryset, terms):
+        scores = self.score(" ".join(terms))
+        if not scores:
+            return queryset.none()
+        top = heapq.nlargest(self.max_results, scores.items(), key=itemgetter(1))
+        ranking = Case(*[When(id=topic_id, then=score) for topic_id, score in top], output_field=FloatField())
+        return queryset.filter(id__in=[topic_id for topic_id, score in top]) \
+            .annotate(search_rank=ranking).order_by("-search_rank")
+
+    def score(self, query):
+        self.ensure_built()
+        tokens = set(tokenize(query))
+        with self._lock:
+            postings = [self._postings.get(token, {}) for token in tokens]
+            if not postings or not all(postings):
+                return {}
+            total = len(self._documents)
+            candidates = set.intersection(*[set(posting) for posting in postings])
+            scores = {}
+            for topic_id in candidates:
+                scores[topic_id] = sum(posting[topic_id] * math.log(1 + total / len(posting)) for posting in postings)
+        return scores
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def index(self, topic):
+        if not self._built:
+            return
+        with self._lock:
+            self._remove(topic.id)
+            tokens = tokenize(topic.title) + tokenize(topic.content)
+            self._documents[topic.id] = set(tokens)
+            for token in tokens:
+                self._postings[token][topic.id] = self._postings[token].get(topic.id, 0) + 1
+
+    def remove(self, topic_id):
+        with self._lock:
+            self._remove(topic_id)
+
+    def _remove(self, topic_id):
+        for token in self._documents.pop(topic_id, ()):
+            self._postings[token].pop(topic_id, None)
+            if not self._postings[token]:
+                del self._postings[token]
+
+    def rebuild(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._built = True
+            for topic in Topic.objects.only("id", "title", "content").iterator():
+                self.index(topic)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    """
+    根据settings.TOPIC_SEARCH_BACKEND选择检索后端: auto(默认，按数据库类型)、mysql、sqlite、memory、like
+    like表示不使用全文索引，返回None
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = getattr(settings, "TOPIC_SEARCH_BACKEND", "auto")
+                if name == "auto":
+                    name = connection.vendor
+                backends = {
+                    "mysql": MySQLFulltextBackend,
+                    "sqlite": SQLiteFTSBackend,
+                    "memory": InvertedIndexBackend,
+                }
+                _backend = backends[name]() if name in backends else False
+    return _backend or None
+
+
+class TopicSearchFilter(filters.SearchFilter):
+    """帖子全文检索，替换SearchFilter，未配置全文索引时仍使用LIKE"""
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        backend = get_search_backend()
+        if not terms or backend is None:
+            return super().filter_queryset(request, queryset, view)
+        return backend.search(queryset, terms)
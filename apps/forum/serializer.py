@@ -2,6 +2,7 @@ from rest_framework import serializers
 
 from forum.models import Topic, Community, CommunityUsers, TopicComment, CommunityCard
 from users.models import User, UserAddress, UserCompany
+from utils.imageUtil import ImageUrlField
 
 
 class AddressSerializer(serializers.ModelSerializer):
@@ -25,12 +26,25 @@ class UserDetailSerializer(serializers.ModelSerializer):
     用户详情序列化类
     """
     address = AddressSerializer(many=True)
-    company = CompanySerializer()
+    company = serializers.SerializerMethodField()
+    avatar = ImageUrlField(read_only=True)
+
+    # 嵌套序列化用到的反向关联，列表查询时需要prefetch
+    prefetch_fields = ("address", "company")
 
     class Meta:
         model = User
         fields = ("id", "nick_name", "gender", "mobile", "avatar", "address", "company")
 
+    def get_company(self, obj):
+        # company为反向外键，取用户的第一个公司，all()会使用prefetch的缓存
+        companies = obj.company.all()
+        return CompanySerializer(companies[0]).data if companies else None
+
+    @classmethod
+    def prefetch_lookups(cls, prefix):
+        return ["%s__%s" % (prefix, field) for field in cls.prefetch_fields]
+
 
 class TopicListSerializer(serializers.ModelSerializer):
     class Meta:
@@ -51,10 +65,16 @@ class CommunityTopicDetailSerializer(serializers.ModelSerializer):
 
 
 class CommunityTopicListSerializer(serializers.ModelSerializer):
+    # 列表响应会被缓存，点赞状态由视图按当前用户填充
+    is_thumbed = serializers.SerializerMethodField(help_text="当前用户是否已点赞")
+
     class Meta:
         model = Topic
         exclude = ("update_time", "community", "hidden", "user")
 
+    def get_is_thumbed(self, obj):
+        return obj.id in self.context.get("thumbed_ids", ())
+
 
 class CommunityMembersListSerializer(serializers.ModelSerializer):
     user = UserDetailSerializer()
@@ -63,6 +83,11 @@ class CommunityMembersListSerializer(serializers.ModelSerializer):
         model = CommunityUsers
         fields = "__all__"
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """按嵌套的UserDetailSerializer预加载用户、地址、公司，查询次数与分页大小无关"""
+        return queryset.select_related("user").prefetch_related(*UserDetailSerializer.prefetch_lookups("user"))
+
 
 class CommunityMembersDeleteSerializer(serializers.ModelSerializer):
     class Meta:
@@ -97,12 +122,16 @@ class CommunityMembersCreateSerializer(serializers.ModelSerializer):
 
 
 class TopicThumbUpdateSerializer(serializers.ModelSerializer):
+    is_thumbed = serializers.SerializerMethodField(help_text="当前用户是否已点赞")
 
     class Meta:
         model = Topic
-        fields = ("id", "thumbs")
+        fields = ("id", "thumbs", "is_thumbed")
         read_only_fields = ("thumbs", )
 
+    def get_is_thumbed(self, obj):
+        return obj.id in self.context.get("thumbed_ids", ())
+
 
 class TopicCommentRetrieveSerializer(serializers.ModelSerializer):
     user = UserDetailSerializer()
@@ -118,6 +147,40 @@ class TopicCommentCreateSerializer(serializers.ModelSerializer):
         model = TopicComment
         fields = ("topic", "content", "parent_comment")
 
+    def validate(self, attrs):
+        parent_comment = attrs.get("parent_comment")
+        if parent_comment and parent_comment.topic_id != attrs["topic"].id:
+            raise serializers.ValidationError("父级评论不属于该帖子")
+        return attrs
+
+
+class CommentAuthorSerializer(serializers.ModelSerializer):
+    """评论作者，评论树中只返回基本信息"""
+    avatar = ImageUrlField(read_only=True)
+
+    class Meta:
+        model = User
+        fields = ("id", "nick_name", "avatar")
+
+
+class TopicCommentTreeSerializer(serializers.ModelSerializer):
+    """
+    评论树节点，子评论由视图预先组装到children_list中，序列化时不再查询数据库
+    """
+    user = CommentAuthorSerializer()
+    reply_count = serializers.SerializerMethodField(help_text="根评论下的回复总数")
+    children = serializers.SerializerMethodField(help_text="子评论")
+
+    class Meta:
+        model = TopicComment
+        fields = ("id", "user", "content", "parent_comment", "create_time", "reply_count", "children")
+
+    def get_reply_count(self, obj):
+        return getattr(obj, "reply_count", None)
+
+    def get_children(self, obj):
+        return TopicCommentTreeSerializer(getattr(obj, "children_list", []), many=True, context=self.context).data
+
 
 class CommunityCardDetailSerializer(serializers.ModelSerializer):
     apply_user = UserDetailSerializer()
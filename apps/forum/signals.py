@@ -0,0 +1,52 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from forum.caches import invalidate_topics, invalidate_communities
+from forum.models import Topic, TopicComment, Community
+from forum.search import get_search_backend
+
+
+@receiver(post_migrate)
+def setup_topic_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """migrate后创建全文索引(MySQL FULLTEXT索引、SQLite FTS5表)，检索和写入时不再检查"""
+    if sender.name != "forum" or using != DEFAULT_DB_ALIAS:
+        return
+    backend = get_search_backend()
+    if backend is not None:
+        backend.setup()
+
+
+@receiver(post_save, sender=Topic)
+def index_topic(sender, instance, **kwargs):
+    """帖子新建或更新后增量更新检索索引"""
+    backend = get_search_backend()
+    if backend is not None:
+        backend.index(instance)
+
+
+@receiver(post_delete, sender=Topic)
+def remove_topic_index(sender, instance, **kwargs):
+    backend = get_search_backend()
+    if backend is not None:
+        backend.remove(instance.id)
+
+
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+def invalidate_topic_cache(sender, instance, **kwargs):
+    invalidate_topics(instance.community_id)
+
+
+@receiver(post_save, sender=TopicComment)
+@receiver(post_delete, sender=TopicComment)
+def invalidate_comment_cache(sender, instance, **kwargs):
+    # 评论数变化会体现在帖子列表中
+    community_id = Topic.objects.filter(pk=instance.topic_id).values_list("community_id", flat=True).first()
+    invalidate_topics(community_id)
+
+
+@receiver(post_save, sender=Community)
+@receiver(post_delete, sender=Community)
+def invalidate_community_cache(sender, instance, **kwargs):
+    invalidate_communities()
@@ -1,3 +1,551 @@
-from django.test import TestCase
+import base64
+import decimal
+import json
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+
+from forum.models import Community, CommunityUsers, Topic, TopicComment
+from forum.search import InvertedIndexBackend, SQLiteFTSBackend, get_search_backend
+from forum.views import CommunityDetailViewSet
+from users.models import User, UserAddress, UserCompany
+from utils import responseUtil
+from forum.consumers import flush_counters
+from forum.counters import topic_thumbs, topic_views
+from utils.counterUtil import LocalCounterStore
+from utils.mqUtil import MemoryBroker, MQPublisher, get_memory_broker, message_handler, message_handlers, \
+    publish_message
+from utils.responseUtil import CustomRenderer, FastJSONRenderer
+
+
+class CommunityMembersQueryTest(TestCase):
+    """社区成员列表查询次数不随分页大小增长"""
+    url = "/ayc_mushroom/api-v1/community/members/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username="owner", mobile="13800000000")
+        cls.community = Community.objects.create(user=cls.owner, name="社区", avatar="avatar")
+        for i in range(30):
+            user = User.objects.create(username="member%d" % i, mobile="1390000%04d" % i)
+            UserAddress.objects.create(user=user, location="地址%d" % i)
+            UserAddress.objects.create(user=user, location="公司地址%d" % i)
+            UserCompany.objects.create(user=user, name="公司%d" % i)
+            CommunityUsers.objects.create(user=user, community=cls.community)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_query_budget_per_page(self):
+        # count + 成员(含用户) + 地址 + 公司
+        for page_size in (5, 30):
+            with self.assertNumQueries(4):
+                response = self.client.get(self.url, {"community": self.community.id, "page_size": page_size})
+            self.assertEqual(response.status_code, 200)
+
+    def test_nested_user_detail(self):
+        response = self.client.get(self.url, {"community": self.community.id, "page_size": 1})
+        user = response.data["results"][0]["user"]
+        self.assertEqual(len(user["address"]), 2)
+        self.assertEqual(user["company"]["name"], "公司0")
+
+
+class ReconcileTopicCountersTest(TestCase):
+    """重算评论数，不改动点赞数"""
+
+    def test_reconcile_comments_only(self):
+        user = User.objects.create(username="owner", mobile="13800000000")
+        community = Community.objects.create(user=user, name="社区", avatar="avatar")
+        topics = [Topic.objects.create(user=user, community=community, title="帖子%d" % i, comments=5, thumbs=7)
+                  for i in range(3)]
+        for i in range(2):
+            TopicComment.objects.create(user=user, topic=topics[0], content="评论%d" % i)
+
+        out = StringIO()
+        call_command("reconcile_topic_counters", batch_size=2, stdout=out)
+        self.assertIn("checked 3 topics, fixed 3", out.getvalue())
+        self.assertEqual(list(Topic.objects.order_by("id").values_list("comments", "thumbs")),
+                         [(2, 7), (0, 7), (0, 7)])
+
+
+class CommentTreeQueryTest(TestCase):
+    """评论树、回复树的查询次数与评论数量、页大小无关"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="owner", mobile="13800000000")
+        community = Community.objects.create(user=cls.user, name="社区", avatar="avatar")
+        cls.small = cls.create_tree(community, roots=2, depth=1)
+        cls.large = cls.create_tree(community, roots=30, depth=4)
+
+    @classmethod
+    def create_tree(cls, community, roots, depth):
+        topic = Topic.objects.create(user=cls.user, community=community, title="帖子")
+        for i in range(roots):
+            root = parent = TopicComment.objects.create(user=cls.user, topic=topic, content="评论%d" % i)
+            for level in range(depth):
+                for j in range(2):
+                    reply = TopicComment.objects.create(user=cls.user, topic=topic, content="回复",
+                                                        parent_comment=parent, root_comment=root)
+                parent = reply
+        return topic
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_comments_query_count(self):
+        # 帖子 + 根评论(含用户) + 回复数 + 回复(含用户)
+        for topic, page_size in ((self.small, 1), (self.small, 20), (self.large, 5), (self.large, 100)):
+            with self.assertNumQueries(4):
+                response = self.client.get("/ayc_mushroom/api-v1/topic/%d/comments/" % topic.id,
+                                           {"page_size": page_size})
+            self.assertEqual(response.status_code, 200)
+        roots = response.data["results"]
+        self.assertEqual(len(roots), 30)
+        self.assertEqual(roots[0]["reply_count"], 8)
+        self.assertEqual(len(roots[0]["children"]), 2)
+        self.assertEqual(len(roots[0]["children"][1]["children"][1]["children"]), 2)
+
+    def test_replies_query_count(self):
+        for topic in (self.small, self.large):
+            root = TopicComment.objects.filter(topic=topic, parent_comment__isnull=True).first()
+            # 评论 + 一页回复(含用户)
+            with self.assertNumQueries(2):
+                response = self.client.get("/ayc_mushroom/api-v1/topic/comment/%d/replies/" % root.id)
+            self.assertEqual(response.status_code, 200)
+        replies = response.data["results"]
+        self.assertEqual([reply["parent_comment"] for reply in replies], [root.id] * 2)
+        self.assertEqual(len(replies[1]["children"]), 2)
+
+    def test_replies_paginated(self):
+        root = TopicComment.objects.filter(topic=self.large, parent_comment__isnull=True).first()
+        url = "/ayc_mushroom/api-v1/topic/comment/%d/replies/?page_size=3" % root.id
+        nodes = {}
+        while url:
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            # 父评论在之前页面的回复放在顶层
+            for reply in response.data["results"]:
+                self.assertIn(reply["parent_comment"], nodes.keys() | {root.id})
+            stack = list(response.data["results"])
+            while stack:
+                node = stack.pop()
+                nodes[node["id"]] = node
+                stack.extend(node["children"])
+            url = response.data["next"]
+        self.assertEqual(sorted(nodes), sorted(root.thread_comments.values_list("id", flat=True)))
+
+
+class TopicCursorPaginationTest(TestCase):
+    """帖子列表游标分页"""
+    url = "/ayc_mushroom/api-v1/topic/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="owner", mobile="13800000000")
+        community = Community.objects.create(user=cls.user, name="社区", avatar="avatar")
+        for i in range(5):
+            Topic.objects.create(user=cls.user, community=community, title="帖子%d" % i)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def test_follow_cursor(self):
+        ids = []
+        params = {"cursor": "", "page_size": 2}
+        while True:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            ids += [topic["id"] for topic in response.data["results"]]
+            if response.data["next"] is None:
+                break
+            params["cursor"] = parse_qs(urlparse(response.data["next"]).query)["cursor"][0]
+        self.assertEqual(ids, list(Topic.objects.order_by("-id").values_list("id", flat=True)))
+
+    def test_invalid_cursor(self):
+        for position in (["a", "b", "c"], [0, "2020-01-01T00:00:00", "x"], [0, None, 1], [[1], {}, 1], [0, 1]):
+            response = self.client.get(self.url, {"cursor": self.cursor(position)})
+            self.assertEqual(response.status_code, 404, position)
+        response = self.client.get(self.url, {"cursor": "!!"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_ordering_rejected(self):
+        response = self.client.get(self.url, {"cursor": "", "ordering": "create_time"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TopicSearchTest(TestCase):
+    """帖子全文检索，测试数据库为SQLite，使用FTS5后端"""
+    url = "/ayc_mushroom/api-v1/topic/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="owner", mobile="13800000000")
+        cls.community = Community.objects.create(user=cls.user, name="社区", avatar="avatar")
+        cls.topic = Topic.objects.create(user=cls.user, community=cls.community, title="香菇种植技术",
+                                         content="大棚里的香菇怎么浇水")
+        Topic.objects.create(user=cls.user, community=cls.community, title="平菇", content="平菇的做法")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, keyword):
+        response = self.client.get(self.url, {"search": keyword})
+        self.assertEqual(response.status_code, 200)
+        return [topic["id"] for topic in response.data["results"]]
+
+    def test_backend(self):
+        self.assertIsInstance(get_search_backend(), SQLiteFTSBackend)
+        # migrate后已创建FTS5表
+        self.assertIn(SQLiteFTSBackend.table, connection.introspection.table_names())
+
+    def test_index_and_search(self):
+        self.assertEqual(self.search("种植技术"), [self.topic.id])
+        self.assertEqual(self.search("香菇 浇水"), [self.topic.id])
+        self.assertEqual(self.search("种植技术 平菇的"), [])
+        # 短于3个字的词使用LIKE
+        self.assertEqual(len(self.search("菇")), 2)
+
+        self.topic.title = "猴头菇栽培"
+        self.topic.save()
+        self.assertEqual(self.search("种植技术"), [])
+        self.assertEqual(self.search("猴头菇"), [self.topic.id])
+
+        self.topic.delete()
+        self.assertEqual(self.search("猴头菇"), [])
+
+    def test_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s" % SQLiteFTSBackend.table)
+        self.assertEqual(self.search("种植技术"), [])
+        call_command("rebuild_topic_search", stdout=StringIO())
+        cache.clear()
+        self.assertEqual(self.search("种植技术"), [self.topic.id])
+
+    def test_inverted_index_top_results(self):
+        topics = [Topic.objects.create(user=self.user, community=self.community, title="灵芝" * i) for i in range(1, 4)]
+        backend = InvertedIndexBackend()
+        backend.max_results = 2
+        with CaptureQueriesContext(connection) as queries:
+            ids = list(backend.search(Topic.objects.all(), ["灵芝"]).values_list("id", flat=True))
+        # 只取得分最高的2个帖子构造查询
+        self.assertEqual(ids, [topics[2].id, topics[1].id])
+        self.assertEqual(queries[-1]["sql"].count("WHEN"), 2)
+
+
+class TopicListCacheTest(TestCase):
+    """帖子列表响应缓存"""
+    url = "/ayc_mushroom/api-v1/topic/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="owner", mobile="13800000000")
+        cls.community = Community.objects.create(user=cls.user, name="社区", avatar="avatar")
+        for i in range(3):
+            Topic.objects.create(user=cls.user, community=cls.community, title="帖子%d" % i)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_hit(self):
+        first = self.client.get(self.url, {"community": self.community.id})
+        # 命中缓存时只查询当前用户的点赞状态
+        with self.assertNumQueries(1):
+            second = self.client.get(self.url, {"community": self.community.id})
+        self.assertEqual(first.data, second.data)
+
+    def test_invalidate_on_write(self):
+        self.client.get(self.url, {"community": self.community.id})
+        self.client.get(self.url)
+        topic = Topic.objects.create(user=self.user, community=self.community, title="新帖子")
+        for params in ({"community": self.community.id}, {}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.data["results"][0]["id"], topic.id)
+            self.assertEqual(response.data["count"], 4)
+
+    @override_settings(ALLOWED_HOSTS=["a.example.com", "b.example.com"])
+    def test_host_in_key(self):
+        for host in ("a.example.com", "b.example.com"):
+            response = self.client.get(self.url, {"page_size": 1}, HTTP_HOST=host)
+            self.assertTrue(response.data["next"].startswith("http://%s/" % host))
+
+
+class FastJSONRendererTest(SimpleTestCase):
+    """FastJSONRenderer与CustomRenderer的输出一致"""
+
+    def render(self, renderer, data, status=200):
+        context = {"response": Response(status=status), "view": None, "request": None}
+        return renderer.render(data, "application/json", context)
+
+    def assertSameOutput(self, make_data, status=200):
+        expected = self.render(CustomRenderer(), make_data(), status)
+        # wrap会取出data中的message、code，每次使用新数据
+        self.assertEqual(self.render(FastJSONRenderer(), make_data(), status), expected)
+        with mock.patch.object(responseUtil, "orjson", None):
+            self.assertEqual(self.render(FastJSONRenderer(), make_data(), status), expected)
+
+    def test_same_output(self):
+        created = datetime(2021, 5, 1, 8, 30, 15, 123456)
+        self.assertSameOutput(lambda: {"id": 1, "title": "蘑菇\u2028", "tags": ["a", "b"], "score": 1.5})
+        self.assertSameOutput(lambda: {"message": "参数错误", "code": 400, "errors": {"title": ["必填"]}}, 400)
+        self.assertSameOutput(lambda: [{"id": 1}, {"id": 2}])
+        self.assertSameOutput(lambda: None, 204)
+        self.assertSameOutput(lambda: {"price": decimal.Decimal("12.50"), "create_time": created})
+        self.assertEqual(self.render(FastJSONRenderer(), None, 204), '{"msg":"请求成功","code":204,"data":null}'.encode())
+
+    def test_nan_rejected(self):
+        with mock.patch.object(responseUtil, "orjson", None), self.assertRaises(ValueError):
+            self.render(FastJSONRenderer(), {"score": float("nan")})
+
+
+@override_settings(FAST_RENDERER_STREAM_THRESHOLD=5)
+class StreamingListTest(TestCase):
+    """使用FastJSONRenderer时大列表流式输出"""
+    url = "/ayc_mushroom/api-v1/topic/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="owner", mobile="13800000000")
+        community = Community.objects.create(user=cls.user, name="社区", avatar="avatar")
+        for i in range(30):
+            Topic.objects.create(user=cls.user, community=community, title="帖子%d" % i)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, renderer_class, page_size):
+        with mock.patch.object(CommunityDetailViewSet, "renderer_classes", [renderer_class]):
+            return self.client.get(self.url, {"page_size": page_size})
+
+    def test_stream_large_list(self):
+        expected = self.get(CustomRenderer, 30)
+        response = self.get(FastJSONRenderer, 30)
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response["Content-Type"], "application/json")
+        chunks = list(response.streaming_content)
+        # 头部 + 每stream_chunk_size条一块 + 尾部
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(json.loads(b"".join(chunks)), json.loads(expected.content))
+
+    def test_small_list_not_streamed(self):
+        response = self.get(FastJSONRenderer, 5)
+        self.assertNotIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response.content, self.get(CustomRenderer, 5).content)
+
+
+class MQPublisherTest(SimpleTestCase):
+    """消息发布器，使用内存broker"""
+
+    def setUp(self):
+        self.now = 0
+        self.broker = MemoryBroker()
+        self.publisher = MQPublisher(self.broker.connection, pool_size=2, buffer_size=5, max_backoff=4,
+                                     clock=lambda: self.now)
+
+    def messages(self, queue_name="q"):
+        return list(self.broker.queues[queue_name])
+
+    def test_publish(self):
+        self.assertTrue(self.publisher.publish("q", "a"))
+        self.assertEqual(self.publisher.publish_batch("q", ["b", "c", "d"]), 3)
+        self.assertEqual(self.messages(), ["a", "b", "c", "d"])
+        # 每条消息都经过broker确认
+        self.assertEqual(self.broker.confirms, 4)
+        # 连接复用
+        self.assertEqual(len(self.broker.connections), 1)
+
+    def test_nacked_message(self):
+        self.broker.nack_bodies = {"b"}
+        with self.assertLogs("mushroom", "WARNING") as logs:
+            self.assertEqual(self.publisher.publish_batch("q", ["a", "b", "c"]), 1)
+        # 日志中的缓冲区条数包含本次失败的消息，已确认的消息不进入缓冲区
+        self.assertIn("缓冲区2条", logs.output[0])
+        self.assertEqual(self.messages(), ["a"])
+        self.assertEqual(list(self.publisher.buffer), [("q", "b"), ("q", "c")])
+        # 退避时间内不尝试发送
+        self.assertFalse(self.publisher.publish("q", "d"))
+        self.assertEqual(self.broker.confirms, 1)
+        self.now = 1
+        self.assertTrue(self.publisher.publish("q", "e"))
+        self.assertEqual(self.messages(), ["a", "b", "c", "d", "e"])
+        self.assertEqual(len(self.publisher.buffer), 0)
+
+    def test_reconnect_with_backoff(self):
+        self.assertTrue(self.publisher.publish("q", "a"))
+        self.broker.shutdown()
+        with self.assertLogs("mushroom", "WARNING"):
+            self.assertFalse(self.publisher.publish("q", "b"))
+            self.now = 1
+            self.assertFalse(self.publisher.publish("q", "c"))
+            self.now = 3
+            self.assertFalse(self.publisher.publish("q", "d"))
+            self.now = 7
+            self.assertFalse(self.publisher.publish("q", "e"))
+            self.now = 11
+            self.assertFalse(self.publisher.publish("q", "f"))
+        # 退避时间翻倍，不超过max_backoff
+        self.assertEqual(self.publisher._backoff, 4)
+        self.broker.available = True
+        self.now = 15
+        self.assertTrue(self.publisher.publish("q", "g"))
+        self.assertEqual(self.messages(), ["a", "b", "c", "d", "e", "f", "g"])
+        self.assertEqual(len(self.broker.connections), 2)
+
+    def test_bounded_buffer(self):
+        self.broker.available = False
+        with self.assertLogs("mushroom", "WARNING") as logs:
+            self.assertEqual(self.publisher.publish_batch("q", list("abcdefg")), 0)
+        self.assertIn("丢弃最早的2条消息", "\n".join(logs.output))
+        self.assertEqual([body for queue_name, body in self.publisher.buffer], list("cdefg"))
+
+    def test_replay_in_batches(self):
+        self.publisher.batch_size = 2
+        self.broker.available = False
+        with self.assertLogs("mushroom", "WARNING"):
+            self.publisher.publish_batch("q", list("abcde"))
+        self.broker.available = True
+        self.now = 1
+        self.assertEqual(self.publisher.flush_buffer(), 5)
+        self.assertEqual(self.messages(), list("abcde"))
+        self.assertEqual(self.broker.confirms, 5)
+
+    def test_memory_channel_prefetch(self):
+        self.broker.queues["q"].extend(["a", "b"])
+        channel = self.broker.connection().channel()
+        channel.basic_qos(prefetch_count=1)
+        deliveries = channel.consume("q", inactivity_timeout=0.01)
+        method, properties, body = next(deliveries)
+        self.assertEqual(body, "a")
+        # 未ack时达到预取上限，不再投递
+        self.assertEqual(next(deliveries), (None, None, None))
+        channel.basic_ack(method.delivery_tag)
+        self.assertEqual(next(deliveries)[2], "b")
+
+    def test_wait_for_concurrent_replay(self):
+        self.broker.available = False
+        with self.assertLogs("mushroom", "WARNING"):
+            self.publisher.publish("q", "a")
+        self.broker.available = True
+        self.now = 1
+        result = []
+        # 其他线程正在补发时等待补发完成后发送，而不是放入缓冲区
+        with self.publisher._flush_lock:
+            thread = threading.Thread(target=lambda: result.append(self.publisher.publish("q", "b")))
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(result, [])
+        thread.join()
+        self.assertEqual(result, [True])
+        self.assertEqual(self.messages(), ["a", "b"])
+
+
+class SharedCounterStore(LocalCounterStore):
+    """模拟redis计数存储"""
+    shared = True
+
+
+class FlushCountersHandlerTest(TestCase):
+    """消费者进程只能刷新共享存储中的计数"""
+
+    def setUp(self):
+        user = User.objects.create(username="owner", mobile="13800000000")
+        community = Community.objects.create(user=user, name="社区", avatar="avatar")
+        self.topic = Topic.objects.create(user=user, community=community, title="帖子")
+        for buffer in (topic_views, topic_thumbs):
+            patcher = mock.patch.object(buffer, "store", LocalCounterStore())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_local_store_skipped(self):
+        topic_views.store.incr(self.topic.id, 3)
+        with self.assertLogs("mushroom", "WARNING") as logs:
+            self.assertEqual(flush_counters(None), 0)
+        self.assertIn("COUNTER_BUFFER_BACKEND=redis", logs.output[0])
+        self.assertEqual(topic_views.pending(self.topic.id), 3)
+
+    def test_shared_store_flushed(self):
+        topic_views.store, topic_thumbs.store = SharedCounterStore(), SharedCounterStore()
+        topic_views.store.incr(self.topic.id, 3)
+        topic_thumbs.store.incr(self.topic.id, 1)
+        self.assertEqual(flush_counters(None), 2)
+        self.topic.refresh_from_db()
+        self.assertEqual((self.topic.views, self.topic.thumbs), (3, 1))
+
+
+@override_settings(RABBITMQ_BACKEND="memory", RABBITMQ_QUEUE="consumer-test")
+class RunConsumersTest(SimpleTestCase):
+    """run_consumers通过内存broker分发消息"""
+
+    def setUp(self):
+        self.broker = get_memory_broker()
+        self.received = []
+        for name in ("test.record", "test.fail"):
+            self.addCleanup(message_handlers.pop, name, None)
+        message_handler("test.record")(self.received.append)
+
+        @message_handler("test.fail")
+        def fail(data):
+            self.received.append("fail")
+            raise ValueError(data)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def run_consumers(self, expected):
+        """处理完expected条消息后发送SIGTERM，命令处理完当前消息后退出"""
+        def stop():
+            deadline = time.monotonic() + 10
+            while len(self.received) < expected and time.monotonic() < deadline:
+                time.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGTERM)
+        threading.Thread(target=stop, daemon=True).start()
+        out = StringIO()
+        call_command("run_consumers", mode="thread", workers=3, prefetch=2, stats_interval=0, stdout=out)
+        return out.getvalue()
+
+    def test_dispatch(self):
+        for i in range(20):
+            self.assertTrue(publish_message("test.record", i))
+        self.assertTrue(publish_message("test.fail", "x"))
+        with self.assertLogs("mushroom", "ERROR"):
+            output = self.run_consumers(22)
+        self.assertEqual(sorted(item for item in self.received if item != "fail"), list(range(20)))
+        # 处理失败的消息重新投递一次后丢弃
+        self.assertEqual(self.received.count("fail"), 2)
+        self.assertIn("processed=20 failed=2", output)
+        self.assertEqual(len(self.broker.queues["consumer-test"]) + len(self.broker.requeued["consumer-test"]), 0)
+
+    def test_flush_counters_message(self):
+        self.assertTrue(publish_message("forum.flush_counters"))
+        self.assertTrue(publish_message("test.record", "done"))
+        with mock.patch("forum.consumers.flush_all", return_value=0) as flush, \
+                self.assertLogs("mushroom", "WARNING"):
+            self.run_consumers(1)
+        self.assertEqual(self.received, ["done"])
+        flush.assert_called_once_with(shared_only=True)
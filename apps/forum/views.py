@@ -1,25 +1,35 @@
 import random
 
+from django.db import transaction
+from django.db.models import F, Count
 from rest_framework import filters
 from rest_framework.generics import CreateAPIView
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.decorators import action
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.authentication import SessionAuthentication
-from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, ListModelMixin, UpdateModelMixin
+from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, ListModelMixin, UpdateModelMixin, \
+    DestroyModelMixin
 from rest_framework import status as drf_status
 
+from forum.caches import topic_list_cache, topic_namespace
+from forum.counters import topic_views, topic_thumbs
 from forum.filter import TopicFilter, CommunityUsersFilter
-from forum.models import Topic, CommunityUsers, TopicComment, CommunityCard
+from forum.models import Topic, CommunityUsers, TopicComment, CommunityCard, TopicThumb
 from forum.permissions import IsCommunityAdminPermission
+from forum.search import TopicSearchFilter
 from forum.serializer import TopicListSerializer, TopicDetailSerializer, CommunityTopicDetailSerializer, \
     CommunityTopicListSerializer, CommunityMembersListSerializer, CommunityMembersCreateSerializer, \
     CommunityMembersUpdateSerializer, CommunityMembersDeleteSerializer, TopicThumbUpdateSerializer, \
     TopicCommentCreateSerializer, TopicCommentRetrieveSerializer, CommunityCardCreateSerializer, \
-    CommunityCardDetailSerializer, CommunityCardUpdateSerializer
+    CommunityCardDetailSerializer, CommunityCardUpdateSerializer, TopicCommentTreeSerializer
+from utils.cacheUtil import CacheListMixin
+from utils.paginationUtil import TopicPagination
+from utils.responseUtil import StreamingListMixin
 
 
 class CommonPagination(PageNumberPagination):
@@ -29,35 +39,101 @@ class CommonPagination(PageNumberPagination):
     max_page_size = 100
 
 
-class CommunityDetailViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet):
+class CommentCursorPagination(CursorPagination):
+    """根评论游标分页"""
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("create_time", "id")
+
+
+class CommentReplyCursorPagination(CursorPagination):
+    """评论线程内回复的游标分页，按回复时间正序，使用comment_thread_idx索引"""
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    ordering = ("create_time", "id")
+
+
+def attach_comment_replies(comments, replies):
+    """将回复按parent_comment组装到评论的children_list中，replies需按时间排序"""
+    nodes = {comment.id: comment for comment in comments}
+    nodes.update((reply.id, reply) for reply in replies)
+    for node in nodes.values():
+        node.children_list = []
+    for reply in replies:
+        parent = nodes.get(reply.parent_comment_id)
+        if parent is not None:
+            parent.children_list.append(reply)
+
+
+class CommunityDetailViewSet(StreamingListMixin, CacheListMixin, RetrieveModelMixin, ListModelMixin, GenericViewSet):
     """
     retrieve: 首页帖子详情
     list: 首页帖子列表
+    comments: 帖子评论树
     """
     queryset = Topic.objects.all()
-    filter_backends = (DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter)
+    filter_backends = (DjangoFilterBackend, TopicSearchFilter, filters.OrderingFilter)
     filter_class = TopicFilter
-    pagination_class = CommonPagination
+    pagination_class = TopicPagination
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication)
     permission_classes = [IsAuthenticated]
     search_fields = ("title", "content")
     ordering_fields = ("create_time",)
+    # 回复数不超过该值的根评论直接返回整棵回复树，否则由topic/comment/{id}/replies懒加载
+    comment_inline_replies = 20
+    response_cache = topic_list_cache
 
     def get_serializer_class(self):
         if self.action == "list":
             return CommunityTopicListSerializer
         return CommunityTopicDetailSerializer
 
+    def get_cache_namespaces(self):
+        return [topic_namespace(self.request.query_params.get("community"))]
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        # 缓存的列表不区分用户，当前页帖子的点赞状态一次查出
+        topics = response.data["results"] if isinstance(response.data, dict) else response.data
+        thumbed_ids = TopicThumb.thumbed_topic_ids(request.user, [topic["id"] for topic in topics])
+        for topic in topics:
+            topic["is_thumbed"] = topic["id"] in thumbed_ids
+        return response
+
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         views_random = random.randint(1, 10)
-        instance.views += views_random
-        instance.save()
+        # 查看量先写入缓冲，由刷新线程批量写回，返回值包含未刷新的增量
+        instance.views += topic_views.incr(instance.pk, views_random)
+        instance.thumbs += topic_thumbs.pending(instance.pk)
         serializer = self.get_serializer(instance)
         return Response(serializer.data, drf_status.HTTP_200_OK)
 
+    @action(detail=True, methods=["get"])
+    def comments(self, request, *args, **kwargs):
+        """帖子评论树，根评论游标分页，查询次数与页大小无关"""
+        topic = self.get_object()
+        paginator = CommentCursorPagination()
+        roots = paginator.paginate_queryset(
+            TopicComment.objects.filter(topic=topic, parent_comment__isnull=True).select_related("user"),
+            request)
+        reply_counts = dict(TopicComment.objects.filter(root_comment__in=[root.id for root in roots])
+                            .values("root_comment").annotate(total=Count("id")).values_list("root_comment", "total"))
+        inline_ids = [root_id for root_id, total in reply_counts.items() if total <= self.comment_inline_replies]
+        replies = []
+        if inline_ids:
+            replies = list(TopicComment.objects.filter(root_comment__in=inline_ids).select_related("user")
+                           .order_by("create_time", "id"))
+        for root in roots:
+            root.reply_count = reply_counts.get(root.id, 0)
+        attach_comment_replies(roots, replies)
+        serializer = TopicCommentTreeSerializer(roots, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
 
-class CommunityMembersViewSet(ModelViewSet):
+
+class CommunityMembersViewSet(StreamingListMixin, ModelViewSet):
     """
     read:
         获取成员信息
@@ -70,7 +146,7 @@ class CommunityMembersViewSet(ModelViewSet):
     delete:
         删除社区成员(社区管理员权限)
     """
-    queryset = CommunityUsers.objects.all()
+    queryset = CommunityUsers.objects.order_by("id")
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication)
     # permission_classes = [IsAuthenticated]
     pagination_class = CommonPagination
@@ -94,11 +170,19 @@ class CommunityMembersViewSet(ModelViewSet):
             return CommunityMembersDeleteSerializer
         return CommunityMembersListSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.get_serializer_class() is CommunityMembersListSerializer:
+            queryset = CommunityMembersListSerializer.setup_eager_loading(queryset)
+        return queryset
 
-class TopicThumbViewSet(UpdateModelMixin, GenericViewSet):
+
+class TopicThumbViewSet(UpdateModelMixin, DestroyModelMixin, GenericViewSet):
     """
     update:
-        帖子点赞
+        帖子点赞，重复点赞不重复计数
+    delete:
+        取消点赞，未点赞时不计数
     """
     queryset = Topic.objects.all()
     serializer_class = TopicThumbUpdateSerializer
@@ -107,9 +191,24 @@ class TopicThumbViewSet(UpdateModelMixin, GenericViewSet):
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
-        instance.thumbs += 1
-        instance.save()
-        serializer = self.get_serializer(instance)
+        _, created = TopicThumb.objects.get_or_create(user=request.user, topic=instance)
+        if created:
+            topic_thumbs.incr(instance.pk, 1)
+        return self.thumb_response(instance, True)
+
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        deleted, _ = TopicThumb.objects.filter(user=request.user, topic=instance).delete()
+        if deleted:
+            topic_thumbs.incr(instance.pk, -1)
+        return self.thumb_response(instance, False)
+
+    def thumb_response(self, instance, is_thumbed):
+        # 点赞数 = 已写回数据库的值 + 缓冲中的增量
+        instance.thumbs += topic_thumbs.pending(instance.pk)
+        context = self.get_serializer_context()
+        context["thumbed_ids"] = {instance.pk} if is_thumbed else set()
+        serializer = self.get_serializer_class()(instance, context=context)
         return Response(serializer.data, drf_status.HTTP_202_ACCEPTED)
 
 
@@ -119,8 +218,10 @@ class TopicCommentViewSet(CreateModelMixin, RetrieveModelMixin, GenericViewSet):
         获取评论
     create:
         帖子评论
+    replies:
+        分页获取评论所在线程的回复
     """
-    queryset = TopicComment.objects.all()
+    queryset = TopicComment.objects.select_related("user")
     serializer_class = TopicCommentCreateSerializer
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication)
     permission_classes = [IsAuthenticated]
@@ -128,20 +229,33 @@ class TopicCommentViewSet(CreateModelMixin, RetrieveModelMixin, GenericViewSet):
     def get_serializer_class(self):
         if self.action == "retrieve":
             return TopicCommentRetrieveSerializer
+        elif self.action == "replies":
+            return TopicCommentTreeSerializer
         return TopicCommentCreateSerializer
 
-    def create(self, request, *args, **kwargs):
-        json_data = request.data
-        json_data["user"] = request.user
-        serializer = self.get_serializer(json_data)
-        serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
-        # 帖子评论数+1
-        topic = Topic.objects.get(request.data["topic"])
-        topic.comments += 1
-        topic.save()
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=drf_status.HTTP_201_CREATED, headers=headers)
+    @action(detail=True, methods=["get"])
+    def replies(self, request, *args, **kwargs):
+        """
+        分页获取评论所在线程的回复，非根评论返回其根评论的整个线程
+        每页的回复在内存中组装成树，父评论不在本页的回复放在results顶层，客户端按parent_comment挂到之前页面的节点下
+        """
+        comment = self.get_object()
+        thread = TopicComment.objects.filter(root_comment=comment.root_comment_id or comment.id).select_related("user")
+        paginator = CommentReplyCursorPagination()
+        page = paginator.paginate_queryset(thread, request)
+        attach_comment_replies([], page)
+        ids = {reply.id for reply in page}
+        serializer = self.get_serializer([reply for reply in page if reply.parent_comment_id not in ids], many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    def perform_create(self, serializer):
+        parent_comment = serializer.validated_data.get("parent_comment")
+        root_comment_id = (parent_comment.root_comment_id or parent_comment.id) if parent_comment else None
+        with transaction.atomic():
+            comment = serializer.save(user=self.request.user, root_comment_id=root_comment_id)
+            # 帖子评论数+1，只更新comments列
+            Topic.objects.filter(pk=comment.topic_id).update(comments=F("comments") + 1)
+        return comment
 
 
 class CommunityCardChangeViewSet(ModelViewSet):
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from forum.models import Topic, Community, CommunityUsers
+from utils.imageUtil import ImageUrlField
 
 
 class UserTopicRetrieveSerializer(serializers.ModelSerializer):
@@ -40,15 +41,19 @@ class CommunityUsersSerializer(serializers.ModelSerializer):
 
 
 class UserRetrieveCommunitySerializer(serializers.ModelSerializer):
+    avatar = ImageUrlField(read_only=True)
+
     class Meta:
         model = Community
-        fields = ("name", "announcement", "type", "create_time")
+        fields = ("name", "announcement", "avatar", "type", "create_time")
 
 
 class UserListCommunitySerializer(serializers.ModelSerializer):
+    avatar = ImageUrlField(read_only=True)
+
     class Meta:
         model = Community
-        fields = ("id", "name", "announcement", "type", "create_time")
+        fields = ("id", "name", "announcement", "avatar", "type", "create_time")
 
 
 class UserUpdateCommunitySerializer(serializers.ModelSerializer):
@@ -65,6 +70,7 @@ class UserUpdateCommunitySerializer(serializers.ModelSerializer):
 
 
 class UserCreateCommunitySerializer(serializers.ModelSerializer):
+    avatar = ImageUrlField(max_length=256)
 
     class Meta:
         model = Community
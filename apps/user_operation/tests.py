@@ -1,3 +1,80 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from forum.models import Community, CommunityUsers
+from users.models import User
+from utils.yunpianUtil import FakeSmsClient, SmsBatcher
+
+
+class UserCommunityCacheTest(TestCase):
+    """用户社区列表缓存按用户区分"""
+    url = "/ayc_mushroom/api-v1/user/community/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username="user%d" % i, mobile="1380000000%d" % i) for i in range(2)]
+        cls.common = Community.objects.create(user=cls.users[0], name="公共社区", avatar="avatar", is_common=True)
+        cls.own = Community.objects.create(user=cls.users[0], name="我的社区", avatar="avatar")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def names(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return sorted(community["name"] for community in response.data["results"])
+
+    def test_per_user(self):
+        for i in range(2):
+            self.assertEqual(self.names(self.users[0]), ["公共社区", "我的社区"])
+            self.assertEqual(self.names(self.users[1]), ["公共社区"])
+
+    def test_invalidate_on_write(self):
+        self.assertEqual(self.names(self.users[1]), ["公共社区"])
+        Community.objects.create(user=self.users[1], name="新社区", avatar="avatar")
+        self.assertEqual(self.names(self.users[1]), ["公共社区", "新社区"])
+
+
+@override_settings(TASK_QUEUE_BACKEND="sync", COMMUNITY_ANNOUNCEMENT_SMS="【蘑菇】{name}社区公告：{announcement}")
+class AnnouncementSmsTest(TestCase):
+    """社区公告更新后合并为一次批量请求通知社区成员"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username="user%d" % i, mobile="1380000000%d" % i) for i in range(4)]
+        cls.community = Community.objects.create(user=cls.users[0], name="蘑菇", avatar="avatar")
+        for i, user in enumerate(cls.users[:3]):
+            CommunityUsers.objects.create(community=cls.community, user=user, is_create=i == 0)
+
+    def setUp(self):
+        self.gateway = FakeSmsClient()
+        for name, value in (("_client", self.gateway), ("_batcher", SmsBatcher(window=0))):
+            patcher = mock.patch("utils.yunpianUtil.%s" % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.url = "/ayc_mushroom/api-v1/user/community/%d/" % self.community.id
+
+    def update(self, user, announcement):
+        self.client.force_authenticate(user)
+        response = self.client.patch(self.url, {"announcement": announcement}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_notify_members(self):
+        self.update(self.users[0], "周末活动")
+        self.assertEqual(self.gateway.calls, 1)
+        self.assertEqual(sorted(sms["mobile"] for sms in self.gateway.sent), ["13800000001", "13800000002"])
+        self.assertEqual(self.gateway.sent[0]["text"], "【蘑菇】蘑菇社区公告：周末活动")
+        # 公告未变化不再发送
+        self.update(self.users[0], "周末活动")
+        self.assertEqual(self.gateway.calls, 1)
+
+    def test_disabled(self):
+        with override_settings(COMMUNITY_ANNOUNCEMENT_SMS=None):
+            self.update(self.users[0], "周末活动")
+        self.assertEqual(self.gateway.calls, 0)
@@ -4,9 +4,14 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from rest_framework.authentication import SessionAuthentication
 
+from django.conf import settings
 from django.db.models import Q
 
+from forum.caches import community_list_cache
 from forum.models import Topic, Community
+from utils.cacheUtil import CacheListMixin
+from utils.mqUtil import enqueue_task
+from utils.paginationUtil import TopicPagination
 from user_operation.serializer import UserTopicRetrieveSerializer, UserTopicListSerializer, \
     UserCreateTopicSerializer, UserUpdateTopicSerializer, UserRetrieveCommunitySerializer, UserListCommunitySerializer, \
     UserCreateCommunitySerializer, UserUpdateCommunitySerializer
@@ -32,7 +37,7 @@ class UserTopicListViewSet(ModelViewSet):
     delete：
         删除用户帖子
     """
-    pagination_class = UserOperationPagination
+    pagination_class = TopicPagination
     ordering_fields = ("-create_time", )
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication)
     permission_classes = [IsAuthenticated]
@@ -52,8 +57,16 @@ class UserTopicListViewSet(ModelViewSet):
     def perform_create(self, serializer):
         return serializer.save()
 
+    def perform_update(self, serializer):
+        announcement = serializer.instance.announcement
+        community = serializer.save()
+        # 社区创建者更新公告后短信通知社区成员，未配置COMMUNITY_ANNOUNCEMENT_SMS模板时不发送
+        if getattr(settings, "COMMUNITY_ANNOUNCEMENT_SMS", None) and community.user_id == self.request.user.id \
+                and community.announcement and community.announcement != announcement:
+            enqueue_task("forum.announcement_sms", {"community": community.id})
+
 
-class UserCommunityViewSet(ModelViewSet):
+class UserCommunityViewSet(CacheListMixin, ModelViewSet):
     """
     list:
         获取用户加入的或创建的社区
@@ -70,6 +83,14 @@ class UserCommunityViewSet(ModelViewSet):
     ordering_fields = ("-create_time", )
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication)
     permission_classes = [IsAuthenticated]
+    response_cache = community_list_cache
+
+    def get_cache_namespaces(self):
+        return ["communities"]
+
+    def get_cache_key_parts(self):
+        # 列表包含用户自己创建的社区
+        return super().get_cache_key_parts() + [self.request.user.id]
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -85,3 +106,11 @@ class UserCommunityViewSet(ModelViewSet):
 
     def perform_create(self, serializer):
         return serializer.save()
+
+    def perform_update(self, serializer):
+        announcement = serializer.instance.announcement
+        community = serializer.save()
+        # 社区创建者更新公告后短信通知社区成员，未配置COMMUNITY_ANNOUNCEMENT_SMS模板时不发送
+        if getattr(settings, "COMMUNITY_ANNOUNCEMENT_SMS", None) and community.user_id == self.request.user.id \
+                and community.announcement and community.announcement != announcement:
+            enqueue_task("forum.announcement_sms", {"community": community.id})
@@ -0,0 +1,28 @@
+import requests
+
+from utils import serviceLogger
+from utils.imageUtil import ImageDerivatives
+from utils.mqUtil import message_handler
+from utils.verifyCodeUtil import get_code_store
+from utils.yunpianUtil import YunPian
+
+
+@message_handler("users.register_sms")
+def send_register_sms(data):
+    """发送登录验证码短信，发送失败时删除验证码并释放60s的发送间隔"""
+    try:
+        sms_status = YunPian().send_register_sms_once(data["key"], data["mobile"], {"code": data["code"]})
+    except (requests.RequestException, ValueError) as e:
+        sms_status = {"code": -1, "msg": str(e)}
+    if sms_status is not None and sms_status["code"] != 0:
+        serviceLogger.error("验证码短信发送失败 %s: %s", data["mobile"], sms_status["msg"])
+        get_code_store().release(data["mobile"], data["code"])
+
+
+@message_handler("users.image_derivatives")
+def generate_image_derivatives(data):
+    """生成上传图片的缩略图和webp，失败时等待IMAGE_DERIVATIVE_RETRY后由下一次请求重新触发"""
+    try:
+        ImageDerivatives().generate(data["object_name"])
+    except Exception:
+        serviceLogger.exception("缩略图生成失败: %s", data["object_name"])
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from users.models import VerifyCode
+
+
+class Command(BaseCommand):
+    help = "分批删除VerifyCode表中的历史验证码，验证码已改为存放在缓存中，该表不再写入"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=0, help="保留最近几天的记录，默认全部删除")
+        parser.add_argument("--batch-size", type=int, default=5000, help="每批删除数量")
+
+    def handle(self, *args, **options):
+        before = datetime.now() - timedelta(days=options["days"])
+        total = 0
+        while True:
+            ids = list(VerifyCode.objects.filter(add_time__lt=before).order_by("id")
+                       .values_list("id", flat=True)[:options["batch_size"]])
+            if not ids:
+                break
+            total += VerifyCode.objects.filter(id__in=ids).delete()[0]
+            self.stdout.write("deleted %d" % total)
+        self.stdout.write("purged %d verify codes" % total)
@@ -43,6 +43,10 @@ class VerifyCode(models.Model):
     class Meta:
         verbose_name = "短信验证码"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 发送频率校验、注册时取最新验证码
+            models.Index(fields=["mobile", "add_time"], name="verify_code_mobile_time_idx"),
+        ]
 
     def __str__(self):
         return self.code
@@ -87,3 +91,64 @@ class UserCompany(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class UserUpload(models.Model):
+    """客户端直传OSS的文件，确认上传后记录"""
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(User, related_name="uploads", on_delete=models.CASCADE, verbose_name="用户id")
+    object_name = models.CharField(max_length=150, unique=True, verbose_name="OSS对象名")
+    size = models.BigIntegerField(default=0, verbose_name="文件大小")
+    content_type = models.CharField(max_length=100, default="", verbose_name="文件类型")
+    create_time = models.DateTimeField(verbose_name='创建时间', default=datetime.now)
+
+    class Meta:
+        verbose_name = "用户上传文件"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return self.object_name
+
+
+class UploadObject(models.Model):
+    """
+    上传文件去重索引，同样内容的文件只保存一份，ref_count为引用次数，为0时删除文件
+    用户的引用记录在UploadReference中，编辑器等没有用户的上传只计数，不会被释放
+    """
+    id = models.AutoField(primary_key=True)
+    storage = models.CharField(max_length=10, choices=(("oss", "OSS"), ("local", "本地MEDIA_ROOT")),
+                               verbose_name="存储位置")
+    content_hash = models.CharField(max_length=64, verbose_name="文件内容sha256")
+    size = models.BigIntegerField(default=0, verbose_name="文件大小")
+    name = models.CharField(max_length=255, verbose_name="OSS对象名或MEDIA_ROOT下的路径")
+    ref_count = models.IntegerField(default=1, verbose_name="引用次数")
+    create_time = models.DateTimeField(verbose_name='创建时间', default=datetime.now)
+
+    class Meta:
+        verbose_name = "上传文件去重索引"
+        verbose_name_plural = verbose_name
+        unique_together = ("storage", "content_hash")
+        indexes = [
+            # 删除文件时按对象名查询引用
+            models.Index(fields=["storage", "name"], name="upload_object_name_idx"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class UploadReference(models.Model):
+    """用户对去重文件的引用，同一个用户对同一个文件只有一个引用，删除时只能释放自己的引用"""
+    id = models.AutoField(primary_key=True)
+    upload = models.ForeignKey(UploadObject, related_name="references", on_delete=models.CASCADE,
+                               verbose_name="上传文件")
+    user = models.ForeignKey(User, related_name="upload_references", on_delete=models.CASCADE, verbose_name="用户id")
+    create_time = models.DateTimeField(verbose_name='创建时间', default=datetime.now)
+
+    class Meta:
+        verbose_name = "上传文件引用"
+        verbose_name_plural = verbose_name
+        unique_together = ("upload", "user")
+
+    def __str__(self):
+        return "%s: %s" % (self.user_id, self.upload_id)
@@ -1,11 +1,12 @@
 import re
-from datetime import datetime, timedelta
 
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 
 from ayc_mushroom.settings import REGEX_MOBILE
-from users.models import User, VerifyCode, UserAddress, UserCompany
+from users.models import User, UserAddress, UserCompany
+from utils.imageUtil import ImageUrlField
+from utils.verifyCodeUtil import get_code_store
 
 
 class AddressSerializer(serializers.ModelSerializer):
@@ -30,6 +31,7 @@ class UserDetailSerializer(serializers.ModelSerializer):
     """
     address = AddressSerializer(many=True)
     company = CompanySerializer()
+    avatar = ImageUrlField(read_only=True)
 
     class Meta:
         model = User
@@ -55,19 +57,9 @@ class UserRegSerializer(serializers.ModelSerializer):
 
     # 字段级验证
     def validate_code(self, code):
-        verify_records = VerifyCode.objects.filter(mobile=self.initial_data["mobile"]).order_by("-add_time")
-        if verify_records:
-            last_record = verify_records[0]
-
-            five_mintes_ago = datetime.now() - timedelta(hours=0, minutes=5, seconds=0)
-            if five_mintes_ago > last_record.add_time:
-                raise serializers.ValidationError("验证码过期")
-
-            if last_record.code != code:
-                raise serializers.ValidationError("验证码错误")
-
-        else:
-            raise serializers.ValidationError("验证码错误")
+        # 验证码5分钟后自动过期
+        if get_code_store().get(self.initial_data["mobile"]) != code:
+            raise serializers.ValidationError("验证码错误或已过期")
 
     # 对象级验证
     def validate(self, attrs):
@@ -75,12 +67,20 @@ class UserRegSerializer(serializers.ModelSerializer):
         del attrs["code"]
         return attrs
 
+    def create(self, validated_data):
+        user = super().create(validated_data)
+        # 验证码只能使用一次
+        get_code_store().delete(user.mobile)
+        return user
+
     class Meta:
         model = User
         fields = ("nick_name", "code", "mobile", "password")
 
 
 class UserUpdateSerializer(serializers.ModelSerializer):
+    avatar = ImageUrlField(max_length=150, required=False)
+
     class Meta:
         model = User
         fields = ("nick_name", "avatar", "email", "birthday")
@@ -97,16 +97,15 @@ class SmsCodeSerializer(serializers.Serializer):
         """
 
         # 手机是否注册
-        if User.objects.filter(mobile=mobile).count():
+        if User.objects.filter(mobile=mobile).exists():
             raise serializers.ValidationError("用户已经存在")
 
         # 验证手机号码是否合法
         if not re.match(REGEX_MOBILE, mobile):
             raise serializers.ValidationError("手机号码非法")
 
-        # 验证码发送频率
-        one_mintes_ago = datetime.now() - timedelta(hours=0, minutes=1, seconds=0)
-        if VerifyCode.objects.filter(add_time__gt=one_mintes_ago, mobile=mobile).count():
+        # 验证码发送频率，通过校验即占用60s的发送间隔
+        if not get_code_store().reserve(mobile):
             raise serializers.ValidationError("距离上一次发送未超过60s")
 
         return mobile
@@ -1,3 +1,598 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import requests
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+
+from users.consumers import send_register_sms
+from PIL import Image
+
+from forum.models import Community
+from users.models import UploadObject, UploadReference, User, UserUpload
+from utils import imageUtil
+from utils.dedupUtil import UploadDedup, add_hashing_handler, file_digest
+from utils.imageUtil import ImageDerivatives, make_derivatives
+from utils.ossUtil import MemoryBucket, OSSUploadSigner, RunOSS, get_bucket, get_upload_signer, object_url
+from utils.verifyCodeUtil import CacheCodeStore, MemoryCodeStore, get_code_store
+from utils.yunpianUtil import FakeSmsClient, SmsBatcher
+from utils.ypclient.aio import AsyncClientV2
+from utils.ypclient.yunpian import ClientV2
+
+
+@override_settings(TASK_QUEUE_BACKEND="sync", SMS_RETRY_DELAY=0, VERIFY_CODE_STORE="memory")
+class SmsCodeQueueTest(TestCase):
+    """验证码短信在后台发送，请求不等待短信网关"""
+    url = "/ayc_mushroom/api-v1/code/"
+
+    def setUp(self):
+        cache.clear()
+        self.store = get_code_store()
+        self.store.clear()
+        self.gateway = FakeSmsClient()
+        patcher = mock.patch("utils.yunpianUtil._client", self.gateway)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_send_code(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {"mobile": "13800000000"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.gateway.sent, [{"mobile": "13800000000", "tpl_id": 1,
+                                              "tpl_context": {"code": self.store.get("13800000000")}}])
+        response = self.client.post(self.url, {"mobile": "13800000000"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_duplicate_task_sent_once(self):
+        data = {"key": "verify_code:1", "mobile": "13800000000", "code": "1234"}
+        send_register_sms(data)
+        send_register_sms(data)
+        self.assertEqual(len(self.gateway.sent), 1)
+
+    def test_retry_then_give_up(self):
+        data = {"key": "verify_code:1", "mobile": "13800000000", "code": "1234"}
+        self.gateway.fail_times = 2
+        with override_settings(SMS_MAX_RETRIES=2):
+            send_register_sms(data)
+        self.assertEqual(len(self.gateway.sent), 1)
+
+        self.assertTrue(self.store.reserve("13900000000"))
+        self.store.save("13900000000", "1234")
+        data.update(key="verify_code:2", mobile="13900000000")
+        self.gateway.fail_times = 3
+        with override_settings(SMS_MAX_RETRIES=2):
+            send_register_sms(data)
+        # 发送失败删除验证码，用户可以立即重新获取
+        self.assertIsNone(self.store.get("13900000000"))
+        self.assertTrue(self.store.reserve("13900000000"))
+
+
+class CodeStoreTest(SimpleTestCase):
+    """验证码发送间隔和有效期由TTL控制"""
+
+    def setUp(self):
+        self.now = 0
+        self.stores = [MemoryCodeStore(clock=lambda: self.now), CacheCodeStore()]
+        cache.clear()
+
+    def test_interval_and_expire(self):
+        store = self.stores[0]
+        self.assertTrue(store.reserve("13800000000"))
+        self.assertFalse(store.reserve("13800000000"))
+        store.save("13800000000", "1234")
+        self.now = 61
+        self.assertTrue(store.reserve("13800000000"))
+        self.assertEqual(store.get("13800000000"), "1234")
+        self.now = 301
+        self.assertIsNone(store.get("13800000000"))
+
+    def test_release_keeps_newer_code(self):
+        for store in self.stores:
+            store.reserve("13800000000")
+            store.save("13800000000", "5678")
+            store.release("13800000000", "1234")
+            self.assertEqual(store.get("13800000000"), "5678")
+            store.release("13800000000", "5678")
+            self.assertIsNone(store.get("13800000000"))
+            self.assertTrue(store.reserve("13800000000"))
+
+
+@override_settings(VERIFY_CODE_STORE="memory")
+class UserRegisterTest(TestCase):
+    url = "/ayc_mushroom/api-v1/users/"
+
+    def test_code_used_once(self):
+        store = get_code_store()
+        store.save("13800000000", "1234")
+        data = {"mobile": "13800000000", "code": "1234", "nick_name": "蘑菇", "password": "123456"}
+        response = self.client.post(self.url, data, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(store.get("13800000000"))
+        response = self.client.post(self.url, data, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class SmsBatcherTest(TestCase):
+    """窗口内的短信合并为一次批量请求，结果按号码返回"""
+
+    def setUp(self):
+        self.gateway = FakeSmsClient()
+        self.batcher = SmsBatcher(client=self.gateway, window=60)
+
+    def test_broadcast_same_text(self):
+        mobiles = ["1380000%04d" % i for i in range(50)]
+        futures = self.batcher.send_many(mobiles, "公告")
+        self.batcher.flush()
+        self.assertEqual(self.gateway.calls, 1)
+        self.assertEqual([future.result()["mobile"] for future in futures], mobiles)
+
+    def test_multi_send_and_partial_failure(self):
+        self.gateway.rejected.add("13800000001")
+        futures = [self.batcher.send("1380000000%d" % i, "内容%d" % i) for i in range(3)]
+        duplicate = self.batcher.send("13800000000", "内容0")
+        self.batcher.flush()
+        # 一次multi_send，失败的号码再单独重发一次
+        self.assertEqual(self.gateway.calls, 2)
+        self.assertEqual([future.result()["code"] for future in futures], [0, 2, 0])
+        self.assertEqual(duplicate.result(), futures[0].result())
+        self.assertEqual(len(self.gateway.sent), 2)
+
+    def test_batch_error_falls_back(self):
+        self.gateway.fail_times = 1
+        futures = self.batcher.send_many(["13800000000", "13800000001"], "公告")
+        with self.assertLogs("mushroom", "WARNING"):
+            self.batcher.flush()
+        self.assertEqual(self.gateway.calls, 3)
+        self.assertTrue(all(future.result()["code"] == 0 for future in futures))
+
+    def test_read_timeout_not_resent(self):
+        # 读超时时网关可能已经发送，不能逐条重发
+        errors = [requests.ReadTimeout("read timeout"),
+                  requests.ConnectionError(MaxRetryError(None, "/", ReadTimeoutError(None, "/", "read timeout")))]
+        for error in errors:
+            with mock.patch.object(self.gateway, "broadcast_sms", side_effect=error):
+                futures = self.batcher.send_many(["13800000000", "13800000001"], "公告")
+                with self.assertLogs("mushroom", "ERROR"):
+                    self.batcher.flush()
+            self.assertEqual([future.result()["code"] for future in futures], [-1, -1])
+        self.assertEqual(self.gateway.calls, 0)
+        self.assertEqual(self.gateway.sent, [])
+
+
+class StubSmsHandler(BaseHTTPRequestHandler):
+    """本地云片接口桩，status_codes依次作为响应状态码，用完后返回200"""
+    status_codes = []
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.requests.append((self.path, parse_qs(body)))
+        status = self.status_codes.pop(0) if self.status_codes else 200
+        content = json.dumps({"code": 0 if status == 200 else -50, "msg": "ok", "mobile": "13800000000"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class YunPianClientTest(SimpleTestCase):
+    """ypclient连接池、重试和asyncio客户端"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSmsHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url_tpl = "http://127.0.0.1:%d/{business_type}/{version}/{resource}/{function}.{res_format}" \
+                      % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        StubSmsHandler.status_codes = []
+        StubSmsHandler.requests = []
+
+    def make_client(self, client_class=ClientV2, **kwargs):
+        client = client_class("key", backoff_factor=0, **kwargs)
+        client.url_tpl = self.url_tpl
+        return client
+
+    def test_retry_unavailable(self):
+        StubSmsHandler.status_codes = [503, 503]
+        response = self.make_client(max_retries=2).send_sms("13800000000", "内容")
+        self.assertEqual(response.json()["code"], 0)
+        self.assertEqual(len(StubSmsHandler.requests), 3)
+        self.assertEqual(StubSmsHandler.requests[0][0], "/sms/v2/sms/single_send.json")
+
+        StubSmsHandler.status_codes = [503, 503]
+        response = self.make_client(max_retries=1).send_sms("13800000000", "内容")
+        self.assertEqual(response.status_code, 503)
+
+    def test_shared_pool(self):
+        client = self.make_client(pool_size=2)
+        with client.timeout(1):
+            self.assertEqual(client.get_time_out(), 1)
+            for _ in range(3):
+                client.send_sms("13800000000", "内容")
+        self.assertEqual(client.get_time_out(), 5)
+        adapter = client.session.get_adapter(self.url_tpl)
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+
+    def test_async_client(self):
+        StubSmsHandler.status_codes = [503]
+
+        async def send():
+            async with self.make_client(AsyncClientV2) as client:
+                return await asyncio.gather(client.send_sms("13800000000", "内容"),
+                                            client.broadcast_sms(["13800000000", "13800000001"], "公告"))
+
+        single, broadcast = asyncio.run(send())
+        self.assertEqual(single.json()["code"], 0)
+        self.assertEqual(broadcast.status_code, 200)
+        # 503可能落在任意一个请求上，重试后共3次请求
+        paths = [path for path, params in StubSmsHandler.requests]
+        self.assertEqual(len(paths), 3)
+        self.assertEqual(set(paths), {"/sms/v2/sms/batch_send.json", "/sms/v2/sms/single_send.json"})
+
+
+@override_settings(OSS_PART_SIZE=100 * 1024, OSS_MULTIPART_THRESHOLD=250 * 1024, OSS_UPLOAD_THREADS=3,
+                   OSS_PART_RETRIES=1)
+class RunOSSUploadTest(SimpleTestCase):
+    """文件上传不整体读入内存，大文件分片上传并可断点续传"""
+
+    def setUp(self):
+        cache.clear()
+        self.bucket = MemoryBucket()
+        self.oss = RunOSS(dirname="img/", bucket=self.bucket)
+
+    def test_small_file(self):
+        upload = SimpleUploadedFile("a.png", b"x" * 1000)
+        ret = self.oss.uploadFIle(upload, upload.name)
+        self.assertEqual(ret["status"], 200)
+        self.assertTrue(ret["objectname"].startswith("img/") and ret["objectname"].endswith(".png"))
+        self.assertEqual(self.bucket.objects[ret["objectname"]], b"x" * 1000)
+
+    def test_multipart_resume(self):
+        content = bytes(range(256)) * 2000
+        upload = SimpleUploadedFile("a.mp4", content)
+        self.bucket.fail_parts = {4}
+        ret = self.oss.uploadFIle(upload, upload.name, object_name="video/a.mp4")
+        self.assertIsInstance(ret, Exception)
+        self.assertNotIn("video/a.mp4", self.bucket.objects)
+
+        self.bucket.fail_parts = set()
+        self.bucket.part_uploads = 0
+        ret = self.oss.uploadFIle(upload, upload.name, object_name="video/a.mp4")
+        self.assertEqual(ret["status"], 200)
+        self.assertEqual(self.bucket.objects["video/a.mp4"], content)
+        # 第4片及之后失败或未读取的分片需要重新上传
+        self.assertLess(self.bucket.part_uploads, 6)
+
+    def test_stale_part_not_reused(self):
+        content = bytes(range(256)) * 2000
+        self.bucket.fail_parts = {4}
+        self.oss.uploadFIle(SimpleUploadedFile("a.mp4", content), "a.mp4", object_name="video/a.mp4")
+
+        # 同样大小、内容不同的分片需要重新上传
+        changed = b"y" * 1024 + content[1024:]
+        self.bucket.fail_parts = set()
+        self.bucket.part_uploads = 0
+        ret = self.oss.uploadFIle(SimpleUploadedFile("a.mp4", changed), "a.mp4", object_name="video/a.mp4")
+        self.assertEqual(ret["status"], 200)
+        self.assertEqual(self.bucket.objects["video/a.mp4"], changed)
+        self.assertLess(self.bucket.part_uploads, 6)
+
+
+@override_settings(OSS_BACKEND="memory", OSS_BUCKET_NAME="mushroom-test", OSS_DIRECT_UPLOAD_MAX_SIZE=1024,
+                   TASK_QUEUE_BACKEND="sync", IMAGE_THUMBNAIL_SIZES={"small": 10})
+class DirectUploadTest(TestCase):
+    """客户端直传OSS，应用只签名和确认"""
+
+    def setUp(self):
+        cache.clear()
+        imageUtil._local_manifests.clear()
+        self.user = User.objects.create(username="13800000000", mobile="13800000000")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sign(self, **data):
+        data = dict({"filename": "a.png", "content_type": "image/png", "size": 100}, **data)
+        return self.client.post("/ayc_mushroom/oss/sign/", data, format="json")
+
+    def test_sign_put_and_confirm(self):
+        response = self.sign()
+        self.assertEqual(response.status_code, 201)
+        object_name = response.data["object_name"]
+        upload = response.data["upload"]
+        self.assertEqual(upload["method"], "PUT")
+        self.assertIn("Signature=", upload["url"])
+        signer = get_upload_signer()
+        query = parse_qs(upload["url"].split("?")[1])
+        self.assertTrue(signer.verify(object_name, "image/png", int(query["Expires"][0]), query["Signature"][0]))
+        self.assertFalse(signer.verify(object_name, "text/html", int(query["Expires"][0]), query["Signature"][0]))
+
+        # 未上传时不能确认
+        response = self.client.post("/ayc_mushroom/oss/confirm/", {"object_name": object_name}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+        content = image_bytes((40, 20), fmt="PNG")
+        get_bucket().put_object(object_name, content, headers={"Content-Type": "image/png"})
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username="13900000000", mobile="13900000000"))
+        response = other.post("/ayc_mushroom/oss/confirm/", {"object_name": object_name}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post("/ayc_mushroom/oss/confirm/", {"object_name": object_name, "filename": "a.png"},
+                                    format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["size"], len(content))
+        upload = UserUpload.objects.get(object_name=object_name)
+        self.assertEqual((upload.user, upload.content_type), (self.user, "image/png"))
+        # 确认后生成缩略图
+        manifest = ImageDerivatives().cached(object_name)
+        self.assertEqual(set(manifest["small"]), {"webp", "jpg"})
+        small = Image.open(io.BytesIO(get_bucket().objects[manifest["small"]["jpg"]]))
+        self.assertEqual(small.size, (10, 5))
+
+    def test_only_uploader_can_delete(self):
+        object_name = self.sign().data["object_name"]
+        get_bucket().put_object(object_name, image_bytes((40, 20), fmt="PNG"))
+        file_url = object_url(object_name)
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username="13900000000", mobile="13900000000"))
+        # 确认前后其他用户都不能删除
+        response = other.delete("/ayc_mushroom/oss/", {"file_url": file_url}, format="json")
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post("/ayc_mushroom/oss/confirm/", {"object_name": object_name}, format="json")
+        self.assertEqual(response.status_code, 201)
+        response = other.delete("/ayc_mushroom/oss/", {"file_url": file_url}, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(object_name, get_bucket().objects)
+
+        response = self.client.delete("/ayc_mushroom/oss/", {"file_url": file_url}, format="json")
+        self.assertEqual(response.status_code, 204)
+        self.assertNotIn(object_name, get_bucket().objects)
+        self.assertFalse(UserUpload.objects.exists())
+
+    def test_sign_post_policy(self):
+        response = self.sign(method="post")
+        self.assertEqual(response.status_code, 201)
+        fields = response.data["upload"]["fields"]
+        policy = json.loads(base64.b64decode(fields["policy"]))
+        self.assertIn(["eq", "$key", response.data["object_name"]], policy["conditions"])
+        self.assertIn(["content-length-range", 1, 1024], policy["conditions"])
+
+    def test_reject_oversize(self):
+        self.assertEqual(self.sign(size=2048).status_code, 400)
+        self.assertEqual(self.sign(filename="noext").status_code, 400)
+
+        object_name = self.sign().data["object_name"]
+        get_bucket().put_object(object_name, b"x" * 2048)
+        response = self.client.post("/ayc_mushroom/oss/confirm/", {"object_name": object_name}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(object_name, get_bucket().objects)
+        self.assertFalse(UserUpload.objects.exists())
+
+    def test_oss_signer(self):
+        with override_settings(OSS_BACKEND="oss", OSS_ENDPOINT="http://oss-cn-beijing.aliyuncs.com"):
+            upload = OSSUploadSigner().sign_put("img/a.png", "image/png", 60)
+        self.assertTrue(upload["url"].startswith("http://mushroom-test.oss-cn-beijing.aliyuncs.com/img%2Fa.png?"))
+        self.assertIn("Signature=", upload["url"])
+
+
+def image_bytes(size, mode="RGB", fmt="JPEG"):
+    output = io.BytesIO()
+    Image.new(mode, size, (200, 100, 50, 128)[:len(mode)]).save(output, fmt)
+    return output.getvalue()
+
+
+@override_settings(OSS_BACKEND="memory", OSS_BUCKET_NAME="mushroom-test", TASK_QUEUE_BACKEND="sync",
+                   IMAGE_THUMBNAIL_SIZES={"small": 100, "large": 400})
+class ImageDerivativesTest(TestCase):
+    """头像等图片按规格返回缩略图，同样内容只生成一次"""
+
+    def setUp(self):
+        cache.clear()
+        imageUtil._local_manifests.clear()
+        self.bucket = get_bucket()
+        self.bucket.objects.clear()
+
+    def test_make_derivatives(self):
+        result = make_derivatives(image_bytes((800, 200)), {"small": 100, "large": 400})
+        self.assertEqual(set(result), {("small", "webp"), ("small", "jpg"), ("large", "webp"), ("large", "jpg")})
+        self.assertEqual(Image.open(io.BytesIO(result[("small", "webp")])).size, (100, 25))
+        self.assertEqual(Image.open(io.BytesIO(result[("large", "jpg")])).size, (400, 100))
+        # 不放大，透明图兼容格式为png
+        result = make_derivatives(image_bytes((50, 50), "RGBA", "PNG"), {"small": 100})
+        self.assertEqual(set(result), {("small", "webp"), ("small", "png")})
+        self.assertEqual(Image.open(io.BytesIO(result[("small", "png")])).size, (50, 50))
+
+    def test_content_hash_cache(self):
+        content = image_bytes((800, 600))
+        self.bucket.put_object("img/a.jpg", content)
+        self.bucket.put_object("img/b.jpg", content)
+        derivatives = ImageDerivatives()
+        manifest = derivatives.generate("img/a.jpg")
+        count = len(self.bucket.objects)
+        self.assertEqual(count, 6)
+        with mock.patch("utils.imageUtil.make_derivatives") as make:
+            self.assertEqual(derivatives.generate("img/b.jpg"), manifest)
+        make.assert_not_called()
+        self.assertEqual(len(self.bucket.objects), count)
+
+    def test_serializer_size_param(self):
+        self.bucket.put_object("img/avatar.jpg", image_bytes((800, 600)))
+        avatar = "https://mushroom-test.oss-cn-beijing.aliyuncs.com/img/avatar.jpg"
+        user = User.objects.create(username="13800000000", mobile="13800000000", avatar=avatar)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = "/ayc_mushroom/api-v1/users/%d/" % user.id
+        self.assertEqual(client.get(url).data["avatar"], avatar)
+        # 第一次请求时后台生成(测试中同步执行)，仍返回原图
+        self.assertEqual(client.get(url, {"image_size": "small"}).data["avatar"], avatar)
+        small = client.get(url, {"image_size": "small"}).data["avatar"]
+        self.assertTrue(small.endswith("/small.webp"))
+        self.assertEqual(Image.open(io.BytesIO(self.bucket.objects[small.split(".com/")[1]])).size, (100, 75))
+        self.assertTrue(client.get(url, {"image_size": "large", "image_format": "jpg"}).data["avatar"]
+                        .endswith("/large.jpg"))
+        self.assertEqual(client.get(url, {"image_size": "huge"}).data["avatar"], avatar)
+
+    def test_community_avatar(self):
+        self.bucket.put_object("img/community.jpg", image_bytes((800, 600)))
+        avatar = "https://mushroom-test.oss-cn-beijing.aliyuncs.com/img/community.jpg"
+        user = User.objects.create(username="13800000000", mobile="13800000000")
+        community = Community.objects.create(user=user, name="社区", avatar=avatar)
+        ImageDerivatives().generate("img/community.jpg")
+        client = APIClient()
+        client.force_authenticate(user)
+        for url in ("/ayc_mushroom/api-v1/user/community/", "/ayc_mushroom/api-v1/user/community/%d/" % community.id):
+            data = client.get(url, {"image_size": "small"}).data
+            data = data["results"][0] if "results" in data else data
+            self.assertTrue(data["avatar"].endswith("/small.webp"), url)
+
+    def test_remove(self):
+        content = image_bytes((800, 600))
+        self.bucket.put_object("img/a.jpg", content)
+        self.bucket.put_object("img/b.jpg", content)
+        derivatives = ImageDerivatives()
+        derivatives.generate("img/a.jpg")
+        derivatives.generate("img/b.jpg")
+        # 同样内容的其他原图还在使用缩略图
+        self.assertEqual(derivatives.remove("img/a.jpg"), 0)
+        self.assertEqual(len(self.bucket.objects), 6)
+        self.assertIsNone(derivatives.cached("img/a.jpg"))
+        self.assertEqual(derivatives.remove("img/b.jpg"), 4)
+        self.assertEqual(set(self.bucket.objects), {"img/a.jpg", "img/b.jpg"})
+
+    def test_remove_after_cache_expired(self):
+        self.bucket.put_object("img/a.jpg", image_bytes((800, 600)))
+        ImageDerivatives().generate("img/a.jpg")
+        cache.clear()
+        imageUtil._local_manifests.clear()
+        ImageDerivatives().remove("img/a.jpg")
+        self.assertEqual(set(self.bucket.objects), {"img/a.jpg"})
+
+
+@override_settings(OSS_BACKEND="memory", OSS_BUCKET_NAME="mushroom-test", TASK_QUEUE_BACKEND="sync")
+class UploadDedupTest(TestCase):
+    """同样内容的文件只上传一次，全部引用删除后才删除文件"""
+    url = "/ayc_mushroom/oss/"
+
+    def setUp(self):
+        cache.clear()
+        self.bucket = get_bucket()
+        self.bucket.objects.clear()
+        self.client = self.login("13800000000")
+
+    def login(self, mobile):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username=mobile, mobile=mobile))
+        return client
+
+    def upload(self, content, name="a.txt", client=None):
+        response = (client or self.client).post(self.url, {"file": SimpleUploadedFile(name, content)},
+                                                format="multipart")
+        self.assertEqual(response.status_code, 201)
+        return response.data["file_url"]
+
+    def delete(self, file_url, client=None):
+        return (client or self.client).delete(self.url, {"file_url": file_url}, format="json").status_code
+
+    def test_dedup_and_refcount(self):
+        other_user = self.login("13900000000")
+        with mock.patch.object(RunOSS, "uploadFIle", autospec=True, side_effect=RunOSS.uploadFIle) as upload:
+            first = self.upload(b"sticker")
+            # 同一个用户重复上传只有一个引用
+            self.assertEqual(self.upload(b"sticker", "b.txt"), first)
+            self.assertEqual(self.upload(b"sticker", client=other_user), first)
+            other = self.upload(b"other")
+        self.assertNotEqual(first, other)
+        self.assertEqual(upload.call_count, 2)
+        record = UploadObject.objects.get(name=first.split(".com/")[1])
+        self.assertEqual(record.ref_count, 2)
+        self.assertEqual(UploadReference.objects.filter(upload=record).count(), 2)
+
+        object_name = record.name
+        # 重复删除只释放自己的引用
+        self.assertEqual(self.delete(first), 204)
+        self.assertEqual(self.delete(first), 204)
+        self.assertIn(object_name, self.bucket.objects)
+        # 没有引用的用户不能删除
+        self.assertEqual(self.delete(first, self.login("13700000000")), 204)
+        self.assertIn(object_name, self.bucket.objects)
+        self.assertEqual(self.delete(first, other_user), 204)
+        self.assertNotIn(object_name, self.bucket.objects)
+        self.assertFalse(UploadObject.objects.filter(name=object_name).exists())
+
+    def test_delete_removes_derivatives(self):
+        file_url = self.upload(image_bytes((300, 200)), "a.jpg")
+        self.assertGreater(len(self.bucket.objects), 1)
+        self.assertEqual(self.delete(file_url), 204)
+        self.assertEqual(self.bucket.objects, {})
+
+    def test_delete_failure_keeps_reference(self):
+        file_url = self.upload(b"sticker")
+        with mock.patch.object(RunOSS, "deleteFIle", return_value=Exception("network error")):
+            self.assertEqual(self.delete(file_url), 400)
+        self.assertEqual(UploadReference.objects.count(), 1)
+        self.assertEqual(self.delete(file_url), 204)
+        self.assertFalse(UploadObject.objects.exists())
+
+    def test_acquire_released_object(self):
+        dedup = UploadDedup("oss")
+        user = User.objects.get(mobile="13800000000")
+        self.assertEqual(dedup.register("hash", 1, "img/a.txt", user), "img/a.txt")
+        self.assertTrue(dedup.release("img/a.txt", user, lambda name: True))
+        # 已释放的文件不会再被引用
+        self.assertIsNone(dedup.acquire("hash", user))
+        self.assertFalse(UploadReference.objects.exists())
+
+    def test_same_file_name_in_one_request(self):
+        request = RequestFactory().post("/", {"file": [SimpleUploadedFile("a.txt", b"first"),
+                                                       SimpleUploadedFile("a.txt", b"second")]})
+        add_hashing_handler(request)
+        uploads = request.FILES.getlist("file")
+        self.assertEqual(len(request.upload_hashes["file"]), 2)
+        self.assertEqual([file_digest(request, upload) for upload in uploads],
+                         [hashlib.sha256(b"first").hexdigest(), hashlib.sha256(b"second").hexdigest()])
+
+    def test_missing_object_uploaded_again(self):
+        first = self.upload(b"sticker")
+        self.bucket.objects.clear()
+        # 对象名由内容hash决定，重新上传到同一个对象
+        self.assertEqual(self.upload(b"sticker"), first)
+        self.assertEqual(self.bucket.objects[first.split(".com/")[1]], b"sticker")
+        self.assertEqual(UploadObject.objects.count(), 1)
+
+    @override_settings(OSS_PART_SIZE=100 * 1024, OSS_MULTIPART_THRESHOLD=250 * 1024)
+    def test_resume_interrupted_upload(self):
+        content = bytes(range(256)) * 2000
+        self.bucket.fail_parts = {4}
+        response = self.client.post(self.url, {"file": SimpleUploadedFile("a.mp4", content)}, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+        self.bucket.fail_parts = set()
+        self.bucket.part_uploads = 0
+        file_url = self.upload(content, "a.mp4")
+        self.assertEqual(self.bucket.objects[file_url.split(".com/")[1]], content)
+        # 再次上传时跳过已上传的分片
+        self.assertLess(self.bucket.part_uploads, 6)
@@ -1,6 +1,9 @@
 import os
+import uuid
 from random import choice
 
+import oss2
+from django.core.cache import cache
 from django.db.models import Q
 from rest_framework import status as drf_status
 from rest_framework.mixins import CreateModelMixin, UpdateModelMixin, RetrieveModelMixin
@@ -14,10 +17,13 @@ from rest_framework.views import APIView
 from django.conf import settings
 
 from utils import serviceLogger
-from utils.ossUtil import RunOSS
+from utils.dedupUtil import UploadDedup, add_hashing_handler, file_digest
+from utils.imageUtil import ImageDerivatives
+from utils.ossUtil import RunOSS, get_bucket, get_upload_signer, object_url
 from utils.permissions import IsOwnerOrReadOnly
-from utils.yunpianUtil import YunPian
-from users.models import User, VerifyCode, UserAddress
+from utils.verifyCodeUtil import get_code_store
+from utils.mqUtil import enqueue_task
+from users.models import User, UserAddress, UserUpload
 from users.serializer import UserRegSerializer, UserDetailSerializer, SmsCodeSerializer, UserUpdateSerializer, \
     UserAddressSerializer
 
@@ -112,22 +118,18 @@ class SmsCodeViewset(CreateModelMixin, GenericViewSet):
 
         mobile = serializer.validated_data["mobile"]
 
-        yun_pian = YunPian()
-
         code = self.generate_code()
 
-        sms_status = yun_pian.send_register_sms(mobile=mobile, context={"code": code})
-
-        if sms_status["code"] != 0:
-            return Response({
-                "mobile": sms_status["msg"]
-            }, status=drf_status.HTTP_400_BAD_REQUEST)
-        else:
-            code_record = VerifyCode(code=code, mobile=mobile)
-            code_record.save()
-            return Response({
-                "mobile": mobile
-            }, status=drf_status.HTTP_201_CREATED)
+        get_code_store().save(mobile, code)
+        # 短信放到后台发送，不阻塞请求；key保证任务重复投递时只发送一次
+        enqueue_task("users.register_sms", {
+            "key": "verify_code:%s" % uuid.uuid4().hex,
+            "mobile": mobile,
+            "code": code,
+        })
+        return Response({
+            "mobile": mobile
+        }, status=drf_status.HTTP_201_CREATED)
 
 
 class UploadApiView(APIView):
@@ -140,35 +142,142 @@ class UploadApiView(APIView):
     authentication_classes = (JSONWebTokenAuthentication, )
     permission_classes = [IsAuthenticated]
 
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method == "POST":
+            # 接收文件时计算hash，用于去重
+            add_hashing_handler(request)
+
     def post(self, request):
         file = request.FILES['file']
         file_name = file.name
         oss = RunOSS(dirname=settings.OSS_UPLOAD_IMG_DIR)
-        ret = oss.uploadFIle(object_file=file, file_name=file_name)
-        status = ret.get("status")
-        if status == 200:
-            file_url = ret['pay_certificate']
-            result_dict = {
-                "file_url": file_url,
-                "filename": file_name
-            }
-            return Response(result_dict, status=drf_status.HTTP_201_CREATED)
-        else:
-            return Response(data="文件上传失败", status=drf_status.HTTP_400_BAD_REQUEST)
+        dedup = UploadDedup("oss")
+        content_hash = file_digest(request, file)
+        # 同样内容的文件已上传过时直接返回已有的地址
+        object_name = dedup.acquire(content_hash, request.user, exists=oss.getBucket().object_exists)
+        if object_name is None:
+            # 以内容hash命名，上传中断后再次上传同一个文件时续传已上传的分片
+            ret = oss.uploadFIle(object_file=file, file_name=file_name,
+                                 object_name=oss.objectName(file_name, content_hash))
+            if not isinstance(ret, dict) or ret.get("status") != 200:
+                return Response(data="文件上传失败", status=drf_status.HTTP_400_BAD_REQUEST)
+            object_name = dedup.register(content_hash, file.size, ret['objectname'], request.user)
+            if object_name != ret['objectname']:
+                # 并发上传了同样的文件，保留先登记的
+                oss.deleteFIle(ret['objectname'])
+            ImageDerivatives().schedule(object_name)
+        result_dict = {
+            "file_url": object_url(object_name),
+            "filename": file_name
+        }
+        return Response(result_dict, status=drf_status.HTTP_201_CREATED)
 
     def delete(self, request):
         file_url = request.data["file_url"]
         url_split = file_url.split("/")
         object_name = url_split[-2] + "/" + url_split[-1]
         oss = RunOSS(dirname=settings.OSS_UPLOAD_IMG_DIR)
-        ret = oss.deleteFIle(object_name=object_name)
-        status = ret.get("status")
-        if status == 204:
+        # 直传的文件不在去重索引中，确认前按签名时记录的用户、确认后按上传记录校验，只有上传者可以删除
+        owner_id = cache.get("oss:pending:%s" % object_name) or \
+            UserUpload.objects.filter(object_name=object_name).values_list("user_id", flat=True).first()
+        if owner_id is not None and owner_id != request.user.id:
+            return Response(data="无权删除该文件", status=drf_status.HTTP_403_FORBIDDEN)
+
+        def delete_object(name):
+            ImageDerivatives().remove(name)
+            ret = oss.deleteFIle(object_name=name)
+            if not isinstance(ret, dict) or ret.get("status") != 204:
+                return False
+            UserUpload.objects.filter(object_name=name).delete()
+            return True
+
+        # 只释放当前用户的引用，没有其他引用时才删除文件
+        if UploadDedup("oss").release(object_name, request.user, delete_object):
             return Response(status=drf_status.HTTP_204_NO_CONTENT)
         else:
             return Response(status=drf_status.HTTP_400_BAD_REQUEST)
 
 
+class UploadSignApiView(APIView):
+    """
+    create:
+        获取直传OSS的签名，客户端直接上传到bucket，不经过应用服务器
+        参数: filename, content_type, size, method(put: 签名URL，post: 表单policy)
+        上传完成后调用oss/confirm/确认
+    """
+    authentication_classes = (JSONWebTokenAuthentication, )
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        file_name = request.data.get("filename", "")
+        content_type = request.data.get("content_type") or "application/octet-stream"
+        method = request.data.get("method", "put")
+        max_size = getattr(settings, "OSS_DIRECT_UPLOAD_MAX_SIZE", 100 * 1024 * 1024)
+        try:
+            size = int(request.data.get("size", 0))
+        except (TypeError, ValueError):
+            size = 0
+        if "." not in file_name or method not in ("put", "post"):
+            return Response(data="参数错误", status=drf_status.HTTP_400_BAD_REQUEST)
+        if not 0 < size <= max_size:
+            return Response(data="文件大小超出限制", status=drf_status.HTTP_400_BAD_REQUEST)
+
+        expires = getattr(settings, "OSS_SIGN_EXPIRES", 300)
+        object_name = RunOSS(dirname=settings.OSS_UPLOAD_IMG_DIR).objectName(file_name)
+        signer = get_upload_signer()
+        if method == "put":
+            upload = signer.sign_put(object_name, content_type, expires)
+        else:
+            upload = signer.sign_post(object_name, max_size, expires)
+        # 确认上传时校验对象是本人申请的，多留一些时间给上传
+        cache.set("oss:pending:%s" % object_name, request.user.id, expires * 2)
+        return Response({
+            "object_name": object_name,
+            "file_url": object_url(object_name),
+            "expires": expires,
+            "upload": upload,
+        }, status=drf_status.HTTP_201_CREATED)
+
+
+class UploadConfirmApiView(APIView):
+    """
+    create:
+        确认直传完成，记录上传的文件
+        参数: object_name, filename
+    """
+    authentication_classes = (JSONWebTokenAuthentication, )
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        object_name = request.data.get("object_name", "")
+        pending_key = "oss:pending:%s" % object_name
+        if cache.get(pending_key) != request.user.id:
+            return Response(data="上传已过期或不存在", status=drf_status.HTTP_400_BAD_REQUEST)
+        bucket = get_bucket()
+        try:
+            meta = bucket.head_object(object_name)
+        except oss2.exceptions.NotFound:
+            return Response(data="文件未上传", status=drf_status.HTTP_400_BAD_REQUEST)
+        if meta.content_length > getattr(settings, "OSS_DIRECT_UPLOAD_MAX_SIZE", 100 * 1024 * 1024):
+            bucket.delete_object(object_name)
+            cache.delete(pending_key)
+            return Response(data="文件大小超出限制", status=drf_status.HTTP_400_BAD_REQUEST)
+
+        UserUpload.objects.get_or_create(object_name=object_name, defaults={
+            "user": request.user,
+            "size": meta.content_length,
+            "content_type": meta.content_type or "",
+        })
+        cache.delete(pending_key)
+        ImageDerivatives().schedule(object_name)
+        return Response({
+            "file_url": object_url(object_name),
+            "filename": request.data.get("filename", object_name.split("/")[-1]),
+            "size": meta.content_length,
+        }, status=drf_status.HTTP_201_CREATED)
+
+
 class UserAddressViewSet(ModelViewSet):
     """
     收货地址管理
@@ -0,0 +1,127 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+
+class ResponseCache(object):
+    """
+    接口响应缓存
+    缓存key包含各命名空间的版本号，数据变更时调用bump_version使旧key全部失效
+    同一个key未命中时只有一个请求重新计算，其他请求等待计算结果
+    """
+
+    def __init__(self, prefix, timeout=None, lock_timeout=10, wait_timeout=3):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, "RESPONSE_CACHE_ALIAS", "default")]
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return getattr(settings, "RESPONSE_CACHE_TIMEOUT", 60)
+
+    def make_key(self, namespaces, parts):
+        versions = "-".join(str(get_version(namespace)) for namespace in namespaces)
+        digest = hashlib.md5("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+        return "response_cache:%s:%s:%s" % (self.prefix, versions, digest)
+
+    def get_or_compute(self, namespaces, parts, compute):
+        key = self.make_key(namespaces, parts)
+        value = self.cache.get(key)
+        if value is not None:
+            self.incr_metric("hit")
+            return value
+        self.incr_metric("miss")
+
+        lock_key = key + ":lock"
+        if self.cache.add(lock_key, 1, self.lock_timeout):
+            try:
+                value = compute()
+                self.cache.set(key, value, self.get_timeout())
+            finally:
+                self.cache.delete(lock_key)
+            return value
+
+        # 其他请求正在计算，等待其结果，超时后自行计算
+        self.incr_metric("wait")
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        return compute()
+
+    def metric_key(self, name):
+        return "response_cache:metrics:%s:%s" % (self.prefix, name)
+
+    def incr_metric(self, name):
+        key = self.metric_key(name)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            if not self.cache.add(key, 1, None):
+                self.cache.incr(key)
+
+    def stats(self):
+        """命中、未命中、等待其他请求计算的次数"""
+        names = ("hit", "miss", "wait")
+        values = self.cache.get_many([self.metric_key(name) for name in names])
+        return {name: values.get(self.metric_key(name), 0) for name in names}
+
+
+def version_key(namespace):
+    return "response_cache:version:%s" % namespace
+
+
+def get_version(namespace):
+    cache = caches[getattr(settings, "RESPONSE_CACHE_ALIAS", "default")]
+    version = cache.get(version_key(namespace))
+    if version is None:
+        cache.add(version_key(namespace), 1, None)
+        version = cache.get(version_key(namespace), 1)
+    return version
+
+
+def bump_version(*namespaces):
+    """使命名空间下的缓存全部失效"""
+    cache = caches[getattr(settings, "RESPONSE_CACHE_ALIAS", "default")]
+    for namespace in namespaces:
+        try:
+            cache.incr(version_key(namespace))
+        except ValueError:
+            # 版本号丢失时用时间戳，避免回到旧版本号命中旧数据
+            cache.set(version_key(namespace), int(time.time() * 1000), None)
+
+
+class CacheListMixin(object):
+    """
+    list接口响应缓存，视图需设置response_cache并实现get_cache_namespaces
+    get_cache_namespaces返回None时不缓存
+    """
+    response_cache = None
+
+    def get_cache_namespaces(self):
+        return None
+
+    def get_cache_key_parts(self):
+        # 分页的next、previous是包含域名的绝对地址，不同域名分开缓存
+        request = self.request
+        return [request.build_absolute_uri(request.path), sorted(request.query_params.lists())]
+
+    def list(self, request, *args, **kwargs):
+        namespaces = self.get_cache_namespaces() if self.response_cache is not None else None
+        if namespaces is None:
+            return super(CacheListMixin, self).list(request, *args, **kwargs)
+        data = self.response_cache.get_or_compute(
+            namespaces, self.get_cache_key_parts(),
+            lambda: super(CacheListMixin, self).list(request, *args, **kwargs).data)
+        return Response(data)
@@ -0,0 +1,140 @@
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from utils import serviceLogger
+
+
+class LocalCounterStore(object):
+    """进程内计数存储，适用于单进程部署和测试，只能由所在进程刷新"""
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counts[key] += amount
+            return self._counts[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._counts.get(key, 0)
+
+    def drain(self):
+        """取出并清空所有待刷新的计数"""
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(int)
+        return dict(counts)
+
+
+class RedisCounterStore(object):
+    """基于redis hash的共享计数存储，多进程/多机部署时使用"""
+    shared = True
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def incr(self, key, amount=1):
+        return self.client.hincrby(self.name, key, amount)
+
+    def get(self, key):
+        value = self.client.hget(self.name, key)
+        return int(value) if value else 0
+
+    def drain(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(self.name)
+        pipe.delete(self.name)
+        counts, _ = pipe.execute()
+        return {int(key): int(value) for key, value in counts.items()}
+
+
+def get_counter_store(name):
+    """根据settings.COUNTER_BUFFER_BACKEND创建计数存储"""
+    backend = getattr(settings, "COUNTER_BUFFER_BACKEND", "local")
+    if backend == "redis":
+        import redis
+        client = redis.Redis.from_url(settings.COUNTER_BUFFER_REDIS_URL)
+        return RedisCounterStore(client, "counter:%s" % name)
+    return LocalCounterStore()
+
+
+class CounterBuffer(object):
+    """
+    计数写缓冲
+    计数先累加到存储中，由定时刷新线程或flush_counters命令用F()表达式批量写回数据库
+    """
+    registry = []
+
+    def __init__(self, model, field, store=None):
+        self.model = model
+        self.field = field
+        self.store = store or get_counter_store("%s.%s" % (model._meta.label_lower, field))
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        CounterBuffer.registry.append(self)
+
+    def incr(self, pk, amount=1):
+        self.ensure_flusher()
+        return self.store.incr(pk, amount)
+
+    def pending(self, pk):
+        """尚未写回数据库的增量"""
+        return self.store.get(pk)
+
+    def flush(self):
+        """将缓冲的增量写回数据库，相同增量的行合并为一条UPDATE"""
+        counts = self.store.drain()
+        if not counts:
+            return 0
+        groups = defaultdict(list)
+        for pk, amount in counts.items():
+            if amount:
+                groups[amount].append(pk)
+        try:
+            with transaction.atomic():
+                for amount, pks in groups.items():
+                    self.model.objects.filter(pk__in=pks).update(**{self.field: F(self.field) + amount})
+        except Exception as e:
+            # 写回失败时把增量放回存储，等待下一次刷新
+            for pk, amount in counts.items():
+                self.store.incr(pk, amount)
+            serviceLogger.error("计数刷新失败 %s.%s: %s" % (self.model.__name__, self.field, e))
+            raise
+        return len(counts)
+
+    def ensure_flusher(self):
+        """进程内存储需要在本进程内定时刷新，COUNTER_FLUSH_INTERVAL为0时只能手动刷新"""
+        if not isinstance(self.store, LocalCounterStore) or self._flusher is not None:
+            return
+        interval = getattr(settings, "COUNTER_FLUSH_INTERVAL", 5)
+        if not interval:
+            return
+        with self._flusher_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, args=(interval,), daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self, interval):
+        event = threading.Event()
+        while not event.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                serviceLogger.exception("定时刷新计数失败 %s.%s" % (self.model.__name__, self.field))
+
+
+def flush_all(shared_only=False):
+    """刷新所有已注册的计数缓冲，shared_only时只刷新共享存储(redis)中的计数"""
+    flushed = 0
+    for buffer in CounterBuffer.registry:
+        if shared_only and not buffer.store.shared:
+            continue
+        flushed += buffer.flush()
+    return flushed
@@ -0,0 +1,119 @@
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    接收上传文件时计算sha256，不保存数据，交给后面的handler处理
+    结果按字段保存在request.upload_hashes中: {字段名: [各文件的sha256]}，顺序与request.FILES.getlist(字段名)一致
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not hasattr(self.request, "upload_hashes"):
+            self.request.upload_hashes = {}
+        self.request.upload_hashes.setdefault(self.field_name, []).append(self.hasher.hexdigest())
+        return None
+
+
+def add_hashing_handler(request):
+    """在读取request.FILES之前调用，drf的Request会代理到django的request"""
+    request = getattr(request, "_request", request)
+    request.upload_handlers.insert(0, HashingUploadHandler(request))
+
+
+def file_digest(request, upload):
+    """上传文件的sha256，按文件在request.FILES中的字段和位置取HashingUploadHandler的结果，没有时按块读取计算"""
+    request = getattr(request, "_request", request)
+    hashes = getattr(request, "upload_hashes", {})
+    for field_name, uploads in request.FILES.lists():
+        for index, item in enumerate(uploads):
+            if item is upload and index < len(hashes.get(field_name, ())):
+                return hashes[field_name][index]
+    hasher = hashlib.sha256()
+    for chunk in upload.chunks():
+        hasher.update(chunk)
+    upload.seek(0)
+    return hasher.hexdigest()
+
+
+class UploadDedup(object):
+    """
+    按内容hash去重的上传文件索引，storage为oss或local
+    acquire: 已有同样内容的文件时增加引用并返回其文件名，调用方不再保存
+    register: 保存新文件后登记，并发上传同样内容时返回先登记的文件名，调用方需删除自己保存的文件
+    release: 释放owner的引用，没有引用时删除文件
+    owner为用户时每个用户对同一个文件只有一个引用，只能释放自己的引用；为None时(如编辑器上传)只计数，不会被释放
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def objects(self):
+        from users.models import UploadObject
+        return UploadObject.objects.filter(storage=self.storage)
+
+    def acquire(self, content_hash, owner=None, exists=None):
+        # 锁住索引行，与release互斥，不会返回正在被删除的文件
+        with transaction.atomic():
+            record = self.objects.select_for_update().filter(content_hash=content_hash).first()
+            if record is None:
+                return None
+            if exists is not None and not exists(record.name):
+                # 文件已被删除(如手动清理)，索引失效
+                record.delete()
+                return None
+            self.add_reference(record, owner)
+            return record.name
+
+    def register(self, content_hash, size, name, owner=None):
+        try:
+            with transaction.atomic():
+                record = self.objects.create(storage=self.storage, content_hash=content_hash, size=size, name=name,
+                                             ref_count=0)
+                self.add_reference(record, owner)
+            return name
+        except IntegrityError:
+            # 先登记的记录在此期间被释放时重新登记
+            return self.acquire(content_hash, owner) or self.register(content_hash, size, name, owner)
+
+    def add_reference(self, record, owner):
+        from users.models import UploadReference
+        if owner is not None:
+            _, created = UploadReference.objects.get_or_create(upload=record, user=owner)
+            if not created:
+                return
+        self.objects.filter(pk=record.pk).update(ref_count=F("ref_count") + 1)
+
+    def release(self, name, owner, delete):
+        """
+        释放owner对文件的引用，没有引用时在持有索引行锁期间调用delete(name)删除文件，不在索引中的旧文件直接删除
+        delete返回False表示删除失败，此时保留索引和引用并返回False，其他情况(包括owner没有引用)返回True
+        """
+        from users.models import UploadReference
+        with transaction.atomic():
+            record = self.objects.select_for_update().filter(name=name).first()
+            if record is None:
+                return delete(name)
+            released, _ = UploadReference.objects.filter(upload=record, user=owner).delete()
+            if not released:
+                return True
+            if record.ref_count > 1:
+                self.objects.filter(pk=record.pk).update(ref_count=F("ref_count") - 1)
+                return True
+            if not delete(name):
+                transaction.set_rollback(True)
+                return False
+            record.delete()
+            return True
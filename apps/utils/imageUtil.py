@@ -0,0 +1,233 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import oss2
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import serializers
+
+from utils.mqUtil import enqueue_task
+from utils.ossUtil import get_bucket, object_url
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover 未安装Pillow时不生成缩略图，始终返回原图
+    Image = ImageOps = None
+
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "bmp", "webp")
+
+
+def thumbnail_sizes():
+    """缩略图规格: {名称: 最长边像素}"""
+    return getattr(settings, "IMAGE_THUMBNAIL_SIZES", {"small": 160, "medium": 480, "large": 1080})
+
+
+def is_image(object_name):
+    return object_name.rsplit(".", 1)[-1].lower() in IMAGE_EXTENSIONS
+
+
+def object_name_of(url):
+    """本bucket的文件URL转为对象名，外部URL返回None"""
+    host = object_url("")
+    if not url or not url.startswith(host):
+        return None
+    return url[len(host):].split("?")[0]
+
+
+def make_derivatives(content, sizes):
+    """
+    生成各规格的缩略图，返回{(规格, 格式): 图片数据}
+    每个规格生成webp和一个兼容格式(透明图为png，其余为jpg)，原图小于规格时不放大
+    """
+    image = Image.open(io.BytesIO(content))
+    # jpeg解码时直接按最大规格缩小，减少解码的像素
+    image.draft("RGB", (max(sizes.values()),) * 2)
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    fallback = ("png", "PNG") if has_alpha else ("jpg", "JPEG")
+    quality = getattr(settings, "IMAGE_THUMBNAIL_QUALITY", 80)
+
+    result = {}
+    # 从大到小缩放，每次在上一个规格的基础上缩小
+    for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        if max(image.size) > size:
+            image = image.resize(_fit(image.size, size), Image.LANCZOS)
+        for ext, fmt in (("webp", "WEBP"), fallback):
+            output = io.BytesIO()
+            image.save(output, fmt, optimize=True, **({} if fmt == "PNG" else {"quality": quality}))
+            result[(name, ext)] = output.getvalue()
+    return result
+
+
+def _fit(image_size, size):
+    width, height = image_size
+    scale = size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImageDerivatives(object):
+    """
+    图片缩略图，按原图内容的md5生成和缓存，同样内容的图片只生成一次
+    缩略图对象名: IMAGE_DERIVATIVE_DIR/md5/规格.格式
+    缓存 image:derivatives:对象名 -> {规格: {格式: 对象名}}，image:hash:md5 -> 同上，
+    image:sources:md5 -> 使用这组缩略图的原图对象名，删除原图时没有其他原图使用才删除缩略图
+    """
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+
+    def getBucket(self):
+        return self.bucket or get_bucket()
+
+    @property
+    def timeout(self):
+        return getattr(settings, "IMAGE_DERIVATIVE_CACHE_TIMEOUT", 30 * 86400)
+
+    def cached(self, object_name):
+        manifest = _local_manifests.get(object_name)
+        if manifest is None:
+            manifest = cache.get("image:derivatives:%s" % object_name)
+            if manifest is not None:
+                _local_manifests.set(object_name, manifest)
+        return manifest
+
+    def schedule(self, object_name):
+        """后台生成缩略图，失败后IMAGE_DERIVATIVE_RETRY秒内不再重试"""
+        if Image is None or not is_image(object_name):
+            return False
+        if not cache.add("image:pending:%s" % object_name, 1, getattr(settings, "IMAGE_DERIVATIVE_RETRY", 600)):
+            return False
+        return enqueue_task("users.image_derivatives", {"object_name": object_name})
+
+    def generate(self, object_name):
+        manifest = self.cached(object_name)
+        if manifest is not None:
+            return manifest
+        bucket = self.getBucket()
+        content = bucket.get_object(object_name).read()
+        content_hash = hashlib.md5(content).hexdigest()
+        manifest = cache.get("image:hash:%s" % content_hash)
+        if manifest is None:
+            sizes = thumbnail_sizes()
+            manifest = {}
+            dirname = getattr(settings, "IMAGE_DERIVATIVE_DIR", "thumb/")
+            for (name, ext), data in make_derivatives(content, sizes).items():
+                key = "%s%s/%s.%s" % (dirname, content_hash, name, ext)
+                bucket.put_object(key, data, headers={
+                    "Content-Type": "image/jpeg" if ext == "jpg" else "image/" + ext,
+                    # 对象名包含内容hash，内容不会变化
+                    "Cache-Control": "public, max-age=31536000, immutable",
+                })
+                manifest.setdefault(name, {})[ext] = key
+            cache.set("image:hash:%s" % content_hash, manifest, self.timeout)
+        sources = cache.get("image:sources:%s" % content_hash, set())
+        sources.add(object_name)
+        cache.set("image:sources:%s" % content_hash, sources, self.timeout)
+        cache.set("image:derivatives:%s" % object_name, manifest, self.timeout)
+        _local_manifests.set(object_name, manifest)
+        return manifest
+
+    def remove(self, object_name):
+        """
+        删除原图的缩略图，在删除或覆盖原图之前调用，返回删除的缩略图数
+        缩略图按内容共享，同样内容的其他原图还在使用时只删除本图的清单
+        """
+        if not is_image(object_name):
+            return 0
+        bucket = self.getBucket()
+        manifest = self.cached(object_name)
+        if manifest:
+            content_hash = next(iter(next(iter(manifest.values())).values())).rsplit("/", 2)[-2]
+        else:
+            # 清单已过期时按原图内容找到缩略图
+            try:
+                content_hash = hashlib.md5(bucket.get_object(object_name).read()).hexdigest()
+            except oss2.exceptions.NotFound:
+                return 0
+            manifest = cache.get("image:hash:%s" % content_hash)
+        cache.delete("image:derivatives:%s" % object_name)
+        _local_manifests.delete(object_name)
+        sources = cache.get("image:sources:%s" % content_hash, set())
+        sources.discard(object_name)
+        if sources:
+            cache.set("image:sources:%s" % content_hash, sources, self.timeout)
+            return 0
+        cache.delete_many(["image:sources:%s" % content_hash, "image:hash:%s" % content_hash])
+        if manifest:
+            keys = [key for formats in manifest.values() for key in formats.values()]
+        else:
+            dirname = getattr(settings, "IMAGE_DERIVATIVE_DIR", "thumb/")
+            keys = ["%s%s/%s.%s" % (dirname, content_hash, name, ext)
+                    for name in thumbnail_sizes() for ext in ("webp", "jpg", "png")]
+        for key in keys:
+            bucket.delete_object(key)
+        return len(keys)
+
+    def url(self, url, size, fmt=None):
+        """
+        url对应规格的缩略图地址，未生成时返回原图地址并在后台生成
+        fmt为webp或空(兼容格式)
+        """
+        object_name = object_name_of(url)
+        if object_name is None or size not in thumbnail_sizes():
+            return url
+        manifest = self.cached(object_name)
+        if manifest is None:
+            self.schedule(object_name)
+            return url
+        formats = manifest.get(size, {})
+        key = formats.get("webp") if fmt == "webp" else next((v for k, v in formats.items() if k != "webp"), None)
+        return object_url(key) if key else url
+
+
+class LocalManifests(object):
+    """进程内的缩略图清单LRU缓存，对象名唯一，清单生成后只在删除原图时失效"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local_manifests = LocalManifests()
+
+
+class ImageUrlField(serializers.CharField):
+    """
+    图片URL字段，写入时同CharField
+    请求参数image_size为缩略图规格(small、medium、large)时返回对应缩略图，image_format=jpg时返回兼容格式，默认webp
+    """
+
+    def to_representation(self, value):
+        value = super().to_representation(value)
+        request = self.context.get("request")
+        size = request.query_params.get("image_size") if request is not None else None
+        if not size or not value:
+            return value
+        fmt = request.query_params.get("image_format", getattr(settings, "IMAGE_DEFAULT_FORMAT", "webp"))
+        return ImageDerivatives().url(value, size, "webp" if fmt == "webp" else None)
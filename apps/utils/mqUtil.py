@@ -1,4 +1,18 @@
+import atexit
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
 import pika
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import autodiscover_modules
+
+from utils import serviceLogger
 
 
 class RabbitMQ(object):
@@ -26,15 +40,542 @@ class RabbitMQ(object):
             print('AMQPError {0} , {1}'.format(self.mqAddr, e))
 
     def msg_send(self, msg):
-        print("[Producer] send %s" % msg)
-        self.mqParam = pika.ConnectionParameters(self.mqAddr)
+        """通过进程内共享的发布器发送，broker不可用时消息暂存在本地缓冲区，返回是否已发送"""
+        return get_publisher(self.mqAddr).publish(self.msgQueueName, msg)
+
+
+def blocking_connection_factory(addr):
+    def factory():
+        if "://" in addr:
+            return pika.BlockingConnection(pika.URLParameters(addr))
+        return pika.BlockingConnection(pika.ConnectionParameters(addr))
+    return factory
+
+
+def get_connection_factory(addr):
+    """
+    settings.RABBITMQ_BACKEND为memory时连接进程内的MemoryBroker(测试用，run_consumers只能用thread模式)，否则连接RabbitMQ
+    """
+    if getattr(settings, "RABBITMQ_BACKEND", "rabbitmq") == "memory":
+        return get_memory_broker().connection
+    return blocking_connection_factory(addr)
+
+
+class PublishError(pika.exceptions.AMQPError):
+    """发送中途失败，confirmed为失败前已被broker确认的条数，这些消息不需要重发"""
+
+    def __init__(self, error, confirmed):
+        super().__init__(error)
+        self.error = error
+        self.confirmed = confirmed
+
+
+class PooledChannel(object):
+    """
+    连接池中的一个连接，开启publisher confirms，每个队列只声明一次
+    BlockingConnection在confirm模式下basic_publish等到broker确认后才返回，被nack时抛出NackError，
+    因此一批消息中失败之前的消息都已确认，只有失败的和之后未发送的消息需要重发
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.confirm_delivery()
+        self.declared = set()
 
+    def publish(self, messages):
+        """发送[(队列名, 消息)]，失败时抛出PublishError"""
+        for confirmed, (queue_name, body) in enumerate(messages):
+            try:
+                if queue_name not in self.declared:
+                    self.channel.queue_declare(queue=queue_name)
+                    self.declared.add(queue_name)
+                self.channel.basic_publish(exchange='', routing_key=queue_name, body=body)
+            except pika.exceptions.AMQPError as e:
+                raise PublishError(e, confirmed)
+
+    def close(self):
         try:
-            self.connection = pika.BlockingConnection(self.mqParam)
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
 
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(queue=self.msgQueueName)
 
-            self.channel.basic_publish(exchange='', routing_key=self.msgQueueName, body=msg)
-        except pika.exceptions.AMQPError as e:
-            print('AMQPError {0} , {1}'.format(self.mqAddr, e))
+class MQPublisher(object):
+    """
+    长连接消息发布器，线程安全
+    pika的BlockingConnection不能跨线程使用，因此池中每个连接同一时间只借给一个线程，最多pool_size个连接
+    broker不可用时消息进入本地缓冲区(最多buffer_size条，满了丢弃最早的)，按指数退避重连，重连成功后先补发缓冲区
+    """
+    batch_size = 100
+
+    def __init__(self, connection_factory, pool_size=None, buffer_size=None, max_backoff=None, clock=None):
+        self.connection_factory = connection_factory
+        self.clock = clock or time.monotonic
+        self.pool_size = pool_size or getattr(settings, "RABBITMQ_POOL_SIZE", 4)
+        self.buffer = deque(maxlen=buffer_size or getattr(settings, "RABBITMQ_BUFFER_SIZE", 10000))
+        self.max_backoff = max_backoff or getattr(settings, "RABBITMQ_MAX_BACKOFF", 30)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._backoff = 0
+        self._retry_at = 0
+
+    def publish(self, queue_name, body):
+        """发送一条消息，返回是否已发送，未发送的消息进入缓冲区"""
+        return self.publish_batch(queue_name, [body]) == 1
+
+    def publish_batch(self, queue_name, bodies):
+        """多条消息作为一批发送，返回已被broker确认的条数，其余消息进入缓冲区"""
+        messages = [(queue_name, body) for body in bodies]
+        if not messages:
+            return 0
+        if self.buffer or self.clock() < self._retry_at:
+            # 缓冲区有消息时先补发，补发失败或在退避时间内则排在缓冲区后面，保证顺序
+            with self._flush_lock:
+                self._flush()
+                if self.buffer or self.clock() < self._retry_at:
+                    self._buffer(messages)
+                    return 0
+        return self._send_or_buffer(messages)
+
+    def flush_buffer(self):
+        """补发缓冲区中的消息，返回补发条数，其他线程正在补发时等待其完成"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        flushed = 0
+        while self.buffer and self.clock() >= self._retry_at:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.buffer.popleft())
+            except IndexError:
+                pass
+            sent, error = self._send(batch)
+            flushed += sent
+            if error is not None:
+                self.buffer.extendleft(reversed(batch[sent:]))
+                self._fail(error)
+                break
+        return flushed
+
+    def _send_or_buffer(self, messages):
+        sent, error = self._send(messages)
+        if error is not None:
+            self._buffer(messages[sent:])
+            self._fail(error)
+        return sent
+
+    def _buffer(self, messages):
+        dropped = max(0, len(self.buffer) + len(messages) - self.buffer.maxlen)
+        self.buffer.extend(messages)
+        if dropped:
+            serviceLogger.error("RabbitMQ发布缓冲区已满，丢弃最早的%d条消息", dropped)
+
+    def _send(self, messages):
+        """发送并等待确认，返回(已确认条数, 异常)，全部确认时异常为None"""
+        sent = 0
+        # 池中的空闲连接可能已被broker断开，失败后用新连接重试一次未确认的消息
+        for attempt in range(2):
+            try:
+                channel, reused = self._acquire()
+            except pika.exceptions.AMQPError as e:
+                return sent, e
+            try:
+                channel.publish(messages[sent:])
+            except PublishError as e:
+                sent += e.confirmed
+                self._discard(channel)
+                if reused and attempt == 0:
+                    continue
+                return sent, e.error
+            self._idle.put(channel)
+            self._backoff = 0
+            self._retry_at = 0
+            return len(messages), None
+
+    def _acquire(self):
+        """返回(连接, 是否为复用的连接)"""
+        while True:
+            try:
+                return self._idle.get_nowait(), True
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_create = self._created < self.pool_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return PooledChannel(self.connection_factory()), False
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                return self._idle.get(timeout=0.1), True
+            except queue.Empty:
+                continue
+
+    def _discard(self, channel):
+        channel.close()
+        with self._lock:
+            self._created -= 1
+
+    def _fail(self, error):
+        """未发送的消息已进入缓冲区后调用"""
+        self._backoff = min(self.max_backoff, self._backoff * 2 or 1)
+        self._retry_at = self.clock() + self._backoff
+        serviceLogger.warning("RabbitMQ发布失败，%s秒后重试，缓冲区%d条: %s", self._backoff, len(self.buffer), error)
+
+    def close(self):
+        """补发缓冲区并关闭所有连接"""
+        self.flush_buffer()
+        while True:
+            try:
+                channel = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(channel)
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(addr=None):
+    """进程内按地址共享发布器，默认地址为settings.RABBITMQ_ADDR"""
+    addr = addr or getattr(settings, "RABBITMQ_ADDR", "localhost")
+    key = (getattr(settings, "RABBITMQ_BACKEND", "rabbitmq"), addr)
+    publisher = _publishers.get(key)
+    if publisher is None:
+        with _publishers_lock:
+            publisher = _publishers.get(key)
+            if publisher is None:
+                publisher = _publishers[key] = MQPublisher(get_connection_factory(addr))
+    return publisher
+
+
+@atexit.register
+def close_publishers():
+    for publisher in list(_publishers.values()):
+        publisher.close()
+
+
+message_handlers = {}
+
+
+def message_handler(msg_type):
+    """注册消息处理函数，处理函数接收消息中的data"""
+    def decorator(func):
+        message_handlers[msg_type] = func
+        return func
+    return decorator
+
+
+def mq_message(msg_type, data=None):
+    """消息格式 {"type": 类型, "data": 数据, "ts": 发布时间}，ts用于统计消费延迟"""
+    return json.dumps({"type": msg_type, "data": data, "ts": time.time()})
+
+
+def publish_message(msg_type, data=None, queue_name=None):
+    """发送到settings.RABBITMQ_QUEUE，由run_consumers命令的worker处理"""
+    queue_name = queue_name or getattr(settings, "RABBITMQ_QUEUE", "mushroom")
+    return get_publisher().publish(queue_name, mq_message(msg_type, data))
+
+
+class LocalTaskQueue(object):
+    """进程内线程池执行任务，未部署RabbitMQ时使用，进程退出时未执行的任务会丢失"""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def put(self, msg_type, data):
+        if len(self._workers) < self.threads:
+            with self._lock:
+                while len(self._workers) < self.threads:
+                    worker = threading.Thread(target=self.run, name="task-%d" % len(self._workers), daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+        self.queue.put((msg_type, data))
+
+    def run(self):
+        while True:
+            msg_type, data = self.queue.get()
+            try:
+                message_handlers[msg_type](data)
+            except Exception:
+                serviceLogger.exception("后台任务执行失败: %s", msg_type)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def join(self):
+        """等待已提交的任务执行完"""
+        self.queue.join()
+
+
+_local_queue = None
+_handlers_discovered = False
+
+
+def enqueue_task(msg_type, data=None):
+    """
+    后台执行message_handler注册的任务，由settings.TASK_QUEUE_BACKEND决定执行方式:
+    thread(默认，进程内线程池)、rabbitmq(发送到队列，由run_consumers的worker执行)、sync(同步执行，测试用)
+    """
+    global _local_queue, _handlers_discovered
+    backend = getattr(settings, "TASK_QUEUE_BACKEND", "thread")
+    if backend == "rabbitmq":
+        return publish_message(msg_type, data)
+    if not _handlers_discovered:
+        autodiscover_modules("consumers")
+        _handlers_discovered = True
+    if backend == "sync":
+        message_handlers[msg_type](data)
+        return True
+    if _local_queue is None:
+        with _publishers_lock:
+            if _local_queue is None:
+                _local_queue = LocalTaskQueue(getattr(settings, "TASK_QUEUE_THREADS", 4))
+    _local_queue.put(msg_type, data)
+    return True
+
+
+class ConsumerStats(object):
+    """消费统计，使用共享内存，线程和进程模式的worker都可以直接累加"""
+
+    def __init__(self):
+        self.processed = multiprocessing.Value("q", 0)
+        self.failed = multiprocessing.Value("q", 0)
+        # 最近一条消息从发布到处理完成的秒数
+        self.lag = multiprocessing.Value("d", 0.0)
+
+    def record(self, success, published_at=None):
+        counter = self.processed if success else self.failed
+        with counter.get_lock():
+            counter.value += 1
+        if published_at:
+            self.lag.value = max(0.0, time.time() - published_at)
+
+    def snapshot(self):
+        return {"processed": self.processed.value, "failed": self.failed.value, "lag": self.lag.value}
+
+
+class MQConsumer(object):
+    """
+    消息消费者，按消息type分发给message_handler注册的处理函数
+    basic_qos限制未确认消息数，处理完成后手动ack；处理失败的消息重新入队一次，再次失败则丢弃并记录日志
+    stop_event置位后处理完当前消息即退出，未处理的预取消息退回队列
+    """
+
+    def __init__(self, connection_factory, queue_name, prefetch=None, stats=None, max_backoff=None):
+        self.connection_factory = connection_factory
+        self.queue_name = queue_name
+        self.prefetch = prefetch or getattr(settings, "RABBITMQ_PREFETCH", 10)
+        self.stats = stats or ConsumerStats()
+        self.max_backoff = max_backoff or getattr(settings, "RABBITMQ_MAX_BACKOFF", 30)
+
+    def run(self, stop_event):
+        backoff = 0
+        while not stop_event.is_set():
+            try:
+                self.consume(stop_event)
+                backoff = 0
+            except pika.exceptions.AMQPError as e:
+                backoff = min(self.max_backoff, backoff * 2 or 1)
+                serviceLogger.warning("RabbitMQ消费中断，%s秒后重连: %s", backoff, e)
+                stop_event.wait(backoff)
+
+    def consume(self, stop_event):
+        connection = self.connection_factory()
+        try:
+            channel = connection.channel()
+            channel.basic_qos(prefetch_count=self.prefetch)
+            channel.queue_declare(queue=self.queue_name)
+            for method, properties, body in channel.consume(self.queue_name, inactivity_timeout=1):
+                if method is not None:
+                    self.handle(channel, method, body)
+                if stop_event.is_set():
+                    break
+            channel.cancel()
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def handle(self, channel, method, body):
+        try:
+            message = json.loads(body)
+            handler = message_handlers[message["type"]]
+        except (ValueError, KeyError, TypeError):
+            serviceLogger.error("无法处理的消息: %r", body)
+            channel.basic_ack(method.delivery_tag)
+            self.stats.record(False)
+            return
+        try:
+            handler(message.get("data"))
+        except Exception:
+            serviceLogger.exception("消息处理失败: %s", message["type"])
+            channel.basic_nack(method.delivery_tag, requeue=not method.redelivered)
+            self.stats.record(False)
+            return
+        channel.basic_ack(method.delivery_tag)
+        self.stats.record(True, message.get("ts"))
+
+
+def queue_depth(connection_factory, queue_name):
+    """队列中待消费的消息数"""
+    connection = connection_factory()
+    try:
+        return connection.channel().queue_declare(queue=queue_name, passive=True).method.message_count
+    finally:
+        connection.close()
+
+
+class MemoryBroker(object):
+    """
+    内存中的broker替身，用于测试
+    connection可作为connection_factory传给MQPublisher和MQConsumer，available设为False模拟broker宕机，
+    nack_bodies中的消息在confirm模式下发送时被broker nack一次
+    """
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+        # 被nack重新入队的消息，优先投递并标记redelivered
+        self.requeued = defaultdict(deque)
+        self.connections = []
+        self.available = True
+        self.nack_bodies = set()
+        # confirm模式下已确认的消息数
+        self.confirms = 0
+        self.condition = threading.Condition()
+
+    def connection(self):
+        if not self.available:
+            raise pika.exceptions.AMQPConnectionError("broker unavailable")
+        connection = MemoryConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def shutdown(self):
+        self.available = False
+        for connection in self.connections:
+            connection.is_open = False
+
+    def get(self, queue_name):
+        """返回(body, redelivered)，队列为空时返回None"""
+        if self.requeued[queue_name]:
+            return self.requeued[queue_name].popleft(), True
+        if self.queues[queue_name]:
+            return self.queues[queue_name].popleft(), False
+        return None
+
+
+_memory_broker = None
+
+
+def get_memory_broker():
+    """RABBITMQ_BACKEND=memory时进程内共享的broker"""
+    global _memory_broker
+    if _memory_broker is None:
+        with _publishers_lock:
+            if _memory_broker is None:
+                _memory_broker = MemoryBroker()
+    return _memory_broker
+
+
+class MemoryConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return MemoryChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+class MemoryChannel(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch = 0
+        self.unacked = {}
+        self.delivery_tag = 0
+        self.consuming = None
+        self.confirming = False
+
+    def check(self):
+        if not self.connection.is_open:
+            raise pika.exceptions.StreamLostError("connection lost")
+
+    def confirm_delivery(self):
+        self.check()
+        self.confirming = True
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.prefetch = prefetch_count
+
+    def queue_declare(self, queue, passive=False, **kwargs):
+        self.check()
+        with self.broker.condition:
+            count = len(self.broker.queues[queue]) + len(self.broker.requeued[queue])
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=count))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.check()
+        with self.broker.condition:
+            if self.confirming and body in self.broker.nack_bodies:
+                self.broker.nack_bodies.remove(body)
+                raise pika.exceptions.NackError([])
+            self.broker.queues[routing_key].append(body)
+            if self.confirming:
+                self.broker.confirms += 1
+            self.broker.condition.notify_all()
+
+    def consume(self, queue, auto_ack=False, exclusive=False, arguments=None, inactivity_timeout=None):
+        self.consuming = queue
+        while True:
+            self.check()
+            with self.broker.condition:
+                item = None
+                if not self.prefetch or len(self.unacked) < self.prefetch:
+                    item = self.broker.get(queue)
+                if item is None:
+                    self.broker.condition.wait(inactivity_timeout)
+                    # 醒来后重新检查预取上限
+                    if not self.prefetch or len(self.unacked) < self.prefetch:
+                        item = self.broker.get(queue)
+                if item is not None:
+                    self.delivery_tag += 1
+                    self.unacked[self.delivery_tag] = item[0]
+            if item is None:
+                yield None, None, None
+            else:
+                yield SimpleNamespace(delivery_tag=self.delivery_tag, redelivered=item[1]), None, item[0]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.unacked.pop(delivery_tag)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        body = self.unacked.pop(delivery_tag)
+        if requeue:
+            with self.broker.condition:
+                self.broker.requeued[self.consuming].append(body)
+                self.broker.condition.notify_all()
+
+    def cancel(self):
+        with self.broker.condition:
+            for delivery_tag in sorted(self.unacked, reverse=True):
+                self.broker.requeued[self.consuming].appendleft(self.unacked.pop(delivery_tag))
+            self.broker.condition.notify_all()
@@ -1,37 +1,92 @@
+import base64
 import datetime
+import hashlib
+import hmac
+import json
 import random
 import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 import oss2
 from django.conf import settings
+from django.core.cache import cache
+
+from utils import serviceLogger
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket():
+    """进程内共享的Bucket，复用oss2的连接；OSS_BACKEND为memory时使用内存中的假对象存储"""
+    key = (getattr(settings, "OSS_BACKEND", "oss"), settings.OSS_AK, settings.OSS_ENDPOINT, settings.OSS_BUCKET_NAME)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                if key[0] == "memory":
+                    bucket = MemoryBucket(settings.OSS_BUCKET_NAME)
+                else:
+                    bucket = oss2.Bucket(oss2.Auth(settings.OSS_AK, settings.OSS_SK), settings.OSS_ENDPOINT,
+                                         settings.OSS_BUCKET_NAME)
+                _buckets[key] = bucket
+    return bucket
+
+
+def object_url(object_name):
+    """对象的访问地址，OSS_PUBLIC_HOST默认为bucket的外网域名"""
+    host = getattr(settings, "OSS_PUBLIC_HOST", None)
+    if host is None:
+        host = "https://{}.oss-cn-beijing.aliyuncs.com/".format(settings.OSS_BUCKET_NAME)
+    return host + object_name
 
 
 class RunOSS:
-    def __init__(self, dirname=None):
+    def __init__(self, dirname=None, bucket=None):
         self.AccessKeyId = settings.OSS_AK
         self.AccessKeySecret = settings.OSS_SK
         self.Endpoint = settings.OSS_ENDPOINT
         self.BuckerName = settings.OSS_BUCKET_NAME
         self.dirname = dirname
+        self.bucket = bucket
 
     def getBucket(self):
-        auth = oss2.Auth(self.AccessKeyId, self.AccessKeySecret)
-        bucket = oss2.Bucket(auth, self.Endpoint, self.BuckerName)
-        return bucket
+        return self.bucket or get_bucket()
 
-    def uploadFIle(self, object_file, file_name):
+    def uploadFIle(self, object_file, file_name, object_name=None):
+        """
+        上传文件，不把整个文件读入内存
+        大于OSS_MULTIPART_THRESHOLD的文件分片并行上传；传入固定的object_name时，失败后再次上传会跳过已上传的分片
+        """
         bucket = self.getBucket()
-        now = datetime.datetime.now()
-        random_name = now.strftime("%Y%m%d%H%M%S") + ''.join([random.choice(string.digits) for _ in range(4)])
-        object_name = self.dirname + random_name + "." + file_name.split(".")[-1]
-        f = object_file.read()
+        if object_name is None:
+            object_name = self.objectName(file_name)
+        size = getattr(object_file, "size", None)
         try:
-            ret = bucket.put_object(object_name, f)
-            link = "https://{}.oss-cn-beijing.aliyuncs.com/".format(self.BuckerName) + object_name
-            return {'status': ret.status, 'pay_certificate': link, 'objectname': object_name}
+            if size is not None and size >= getattr(settings, "OSS_MULTIPART_THRESHOLD", 10 * 1024 * 1024):
+                ret = multipart_upload(bucket, object_name, object_file)
+            else:
+                # UploadedFile按块读取，oss2以chunked方式发送
+                ret = bucket.put_object(object_name, object_file.chunks() if hasattr(object_file, "chunks")
+                                        else object_file)
+            return {'status': ret.status, 'pay_certificate': object_url(object_name), 'objectname': object_name}
         except Exception as e:
             return e
 
+    def objectName(self, file_name, content_hash=None):
+        """
+        目录 + 时间 + 4位随机数 + 原扩展名
+        传入content_hash时为 目录 + 内容hash + 原扩展名，同一个文件的对象名不变，中断的分片上传再次上传时可以续传
+        """
+        if content_hash:
+            return self.dirname + content_hash + "." + file_name.split(".")[-1]
+        now = datetime.datetime.now()
+        random_name = now.strftime("%Y%m%d%H%M%S") + ''.join([random.choice(string.digits) for _ in range(4)])
+        return self.dirname + random_name + "." + file_name.split(".")[-1]
+
     def deleteFIle(self, object_name):
         bucket = self.getBucket()
         try:
@@ -39,3 +94,210 @@ class RunOSS:
             return {'status': ret.status}
         except Exception as e:
             return e
+
+
+def multipart_upload(bucket, key, fileobj, part_size=None, num_threads=None):
+    """
+    分片上传，顺序读取分片、多线程上传，内存中最多同时有num_threads个分片
+    upload_id保存在缓存中，上传失败时保留，同一个key再次上传时通过list_parts跳过已上传的分片，
+    大小和ETag(分片的MD5)都与本地分片一致才跳过，文件内容变化时重新上传
+    """
+    part_size = part_size or getattr(settings, "OSS_PART_SIZE", 5 * 1024 * 1024)
+    num_threads = num_threads or getattr(settings, "OSS_UPLOAD_THREADS", 4)
+    retries = getattr(settings, "OSS_PART_RETRIES", 2)
+    checkpoint_key = "oss:multipart:%s" % hashlib.md5(("%s:%s" % (bucket.bucket_name, key)).encode()).hexdigest()
+
+    upload_id = cache.get(checkpoint_key)
+    uploaded = {}
+    if upload_id is not None:
+        try:
+            uploaded = {part.part_number: part for part in oss2.PartIterator(bucket, key, upload_id)}
+        except oss2.exceptions.NoSuchUpload:
+            upload_id = None
+    if upload_id is None:
+        upload_id = bucket.init_multipart_upload(key).upload_id
+        cache.set(checkpoint_key, upload_id, getattr(settings, "OSS_MULTIPART_CHECKPOINT_TIMEOUT", 86400))
+
+    def upload(part_number, data):
+        for attempt in range(retries + 1):
+            try:
+                return oss2.models.PartInfo(part_number, bucket.upload_part(key, upload_id, part_number, data).etag,
+                                            size=len(data))
+            except oss2.exceptions.OssError as e:
+                if attempt == retries:
+                    raise
+                serviceLogger.warning("分片%d上传失败，重试: %s", part_number, e)
+
+    if hasattr(fileobj, "seek"):
+        fileobj.seek(0)
+    # 信号量限制已读取未上传完的分片数量
+    slots = threading.BoundedSemaphore(num_threads)
+    failed = []
+
+    def on_done(future):
+        slots.release()
+        if future.exception() is not None:
+            failed.append(future)
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        part_number = 1
+        # 有分片最终失败时不再读取后面的分片
+        while not failed:
+            data = fileobj.read(part_size)
+            if not data:
+                break
+            done = uploaded.get(part_number)
+            if done is not None and done.size == len(data) and \
+                    done.etag.strip('"').upper() == hashlib.md5(data).hexdigest().upper():
+                futures.append(done)
+            else:
+                slots.acquire()
+                future = executor.submit(upload, part_number, data)
+                future.add_done_callback(on_done)
+                futures.append(future)
+            part_number += 1
+    parts = [part if isinstance(part, oss2.models.PartInfo) else part.result() for part in futures]
+    ret = bucket.complete_multipart_upload(key, upload_id, parts)
+    cache.delete(checkpoint_key)
+    return ret
+
+
+class OSSUploadSigner(object):
+    """签发客户端直传OSS的凭证: PUT签名URL，或浏览器表单上传的POST policy"""
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket or get_bucket()
+
+    def sign_put(self, object_name, content_type, expires):
+        headers = {"Content-Type": content_type}
+        return {"method": "PUT", "url": self.bucket.sign_url("PUT", object_name, expires, headers=headers),
+                "headers": headers}
+
+    def sign_post(self, object_name, max_size, expires):
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires)
+        policy = base64.b64encode(json.dumps({
+            "expiration": expiration.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "conditions": [["eq", "$key", object_name], ["content-length-range", 1, max_size]],
+        }).encode()).decode()
+        return {"method": "POST", "url": object_url(""), "fields": {
+            "key": object_name,
+            "OSSAccessKeyId": settings.OSS_AK,
+            "policy": policy,
+            "Signature": self.signature(policy),
+            "success_action_status": "200",
+        }}
+
+    def signature(self, content):
+        return base64.b64encode(hmac.new(settings.OSS_SK.encode(), content.encode(), hashlib.sha1).digest()).decode()
+
+
+class LocalUploadSigner(OSSUploadSigner):
+    """本地替身，配合MemoryBucket用于测试和本地开发，签名用SECRET_KEY计算，可用verify校验"""
+
+    def sign_put(self, object_name, content_type, expires):
+        deadline = int(datetime.datetime.now().timestamp()) + expires
+        signature = self.signature("PUT\n%s\n%d\n%s" % (content_type, deadline, object_name))
+        return {"method": "PUT", "url": "memory://%s/%s?Expires=%d&Signature=%s" % (
+            self.bucket.bucket_name, object_name, deadline, signature), "headers": {"Content-Type": content_type}}
+
+    def signature(self, content):
+        return base64.urlsafe_b64encode(hmac.new(settings.SECRET_KEY.encode(), content.encode(),
+                                                 hashlib.sha1).digest()).decode()
+
+    def verify(self, object_name, content_type, deadline, signature):
+        return deadline >= datetime.datetime.now().timestamp() and hmac.compare_digest(
+            signature, self.signature("PUT\n%s\n%d\n%s" % (content_type, deadline, object_name)))
+
+
+def get_upload_signer():
+    if getattr(settings, "OSS_BACKEND", "oss") == "memory":
+        return LocalUploadSigner()
+    return OSSUploadSigner()
+
+
+class MemoryBucket(object):
+    """
+    内存中的假对象存储，接口与oss2.Bucket一致，用于测试和本地开发
+    fail_parts中的分片号上传失败，用于模拟网络错误
+    """
+
+    def __init__(self, bucket_name="memory"):
+        self.bucket_name = bucket_name
+        self.objects = {}
+        self.content_types = {}
+        self.uploads = {}
+        self.fail_parts = set()
+        self.part_uploads = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def read_data(data):
+        if isinstance(data, str):
+            return data.encode()
+        if isinstance(data, bytes):
+            return data
+        if hasattr(data, "read"):
+            return data.read()
+        return b"".join(data)
+
+    def put_object(self, key, data, headers=None, progress_callback=None):
+        content = self.read_data(data)
+        with self._lock:
+            self.objects[key] = content
+            self.content_types[key] = (headers or {}).get("Content-Type")
+        return SimpleNamespace(status=200, etag=hashlib.md5(content).hexdigest().upper())
+
+    def get_object(self, key, *args, **kwargs):
+        if key not in self.objects:
+            raise oss2.exceptions.NoSuchKey(404, {}, b"", {})
+        return SimpleNamespace(status=200, read=lambda *a: self.objects[key])
+
+    def object_exists(self, key, headers=None):
+        return key in self.objects
+
+    def head_object(self, key, headers=None, params=None):
+        if key not in self.objects:
+            raise oss2.exceptions.NotFound(404, {}, b"", {})
+        return SimpleNamespace(status=200, content_length=len(self.objects[key]),
+                               content_type=self.content_types.get(key),
+                               etag=hashlib.md5(self.objects[key]).hexdigest().upper())
+
+    def delete_object(self, key, params=None, headers=None):
+        with self._lock:
+            self.objects.pop(key, None)
+            self.content_types.pop(key, None)
+        return SimpleNamespace(status=204)
+
+    def init_multipart_upload(self, key, headers=None, params=None):
+        upload_id = hashlib.md5(("%s:%d" % (key, len(self.uploads))).encode()).hexdigest()
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return SimpleNamespace(status=200, upload_id=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, data, progress_callback=None, headers=None):
+        content = self.read_data(data)
+        with self._lock:
+            self.part_uploads += 1
+            if part_number in self.fail_parts:
+                raise oss2.exceptions.RequestError(Exception("fake part failure"))
+            self.uploads[upload_id][part_number] = content
+        return SimpleNamespace(status=200, etag=hashlib.md5(content).hexdigest().upper())
+
+    def list_parts(self, key, upload_id, marker='', max_parts=1000, headers=None):
+        if upload_id not in self.uploads:
+            raise oss2.exceptions.NoSuchUpload(404, {}, b"", {})
+        parts = [oss2.models.PartInfo(number, hashlib.md5(content).hexdigest().upper(), size=len(content))
+                 for number, content in sorted(self.uploads[upload_id].items())]
+        return SimpleNamespace(status=200, parts=parts, is_truncated=False, next_marker="")
+
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        with self._lock:
+            uploaded = self.uploads.pop(upload_id)
+            self.objects[key] = b"".join(uploaded[part.part_number] for part in parts)
+        return SimpleNamespace(status=200)
+
+    def abort_multipart_upload(self, key, upload_id, headers=None):
+        with self._lock:
+            self.uploads.pop(upload_id, None)
+        return SimpleNamespace(status=204)
@@ -0,0 +1,149 @@
+import base64
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    页码分页 + 游标(keyset)分页
+    请求带cursor参数时(首页传空值)按ordering做keyset分页，不执行COUNT和OFFSET，翻页期间插入新数据不会导致重复或遗漏
+    游标分页的排序固定为ordering，不能与ordering请求参数同时使用
+    页码分页时可传count=0跳过COUNT查询
+    """
+    page_size = 12
+    page_size_query_param = 'page_size'
+    page_query_param = "page"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    # 最后一个字段必须唯一
+    ordering = ("-id", )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.mode = "page"
+        self.has_next = False
+        if not queryset.ordered:
+            queryset = queryset.order_by(*self.ordering)
+        if self.cursor_query_param in request.query_params:
+            if api_settings.ORDERING_PARAM in request.query_params:
+                raise ParseError("游标分页不支持%s参数" % api_settings.ORDERING_PARAM)
+            return self.paginate_keyset(queryset, request)
+        if request.query_params.get(self.count_query_param, "").lower() in ("0", "false"):
+            return self.paginate_without_count(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_keyset(self, queryset, request):
+        self.mode = "cursor"
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.keyset_filter(position))
+        results = list(queryset[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.results = results[:page_size]
+        return self.results
+
+    def paginate_without_count(self, queryset, request):
+        self.mode = "nocount"
+        page_size = self.get_page_size(request)
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            raise NotFound("无效的页码")
+        if self.page_number < 1:
+            raise NotFound("无效的页码")
+        offset = (self.page_number - 1) * page_size
+        results = list(queryset[offset:offset + page_size + 1])
+        self.has_next = len(results) > page_size
+        self.results = results[:page_size]
+        return self.results
+
+    def keyset_filter(self, position):
+        """按ordering构造 (a, b, c) 在游标之后的条件"""
+        condition = Q()
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            branch = Q(**{"%s__%s" % (name, lookup): position[index]})
+            for prev_index, prev_field in enumerate(self.ordering[:index]):
+                branch &= Q(**{prev_field.lstrip("-"): position[prev_index]})
+            condition |= branch
+        return condition
+
+    def encode_cursor(self, instance):
+        position = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip("-"))
+            if isinstance(value, (datetime, date)):
+                value = value.isoformat()
+            position.append(value)
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def decode_cursor(self, request, model):
+        """解析游标，并按排序字段的类型转换每个值，无效时返回404"""
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (TypeError, ValueError):
+            raise NotFound("无效的游标")
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound("无效的游标")
+        values = []
+        for field, value in zip(self.ordering, position):
+            try:
+                value = model._meta.get_field(field.lstrip("-")).to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound("无效的游标")
+            if value is None:
+                raise NotFound("无效的游标")
+            values.append(value)
+        return values
+
+    def get_next_link(self):
+        if self.mode == "page":
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.mode == "cursor":
+            return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.results[-1]))
+        return replace_query_param(url, self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.mode == "page":
+            return super().get_previous_link()
+        # 游标分页只支持向后翻页
+        if self.mode == "cursor" or self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+    def get_paginated_response(self, data):
+        if self.mode == "page":
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', None),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class TopicPagination(KeysetPagination):
+    """帖子列表分页，置顶级别高的在前，其次按发布时间倒序"""
+    ordering = ("-level", "-create_time", "-id")
@@ -1,45 +1,136 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
 
 
 # 导入控制返回的JSON格式的类
 from rest_framework.response import Response
 from rest_framework.views import exception_handler
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class CustomRenderer(JSONRenderer):
     # 重构render方法
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if renderer_context:
+            return super().render(self.wrap(data, renderer_context), accepted_media_type, renderer_context)
+        else:
+            return super().render(data, accepted_media_type, renderer_context)
+
+    def wrap(self, data, renderer_context):
+        # print(renderer_context)
+        # print(renderer_context["response"].status_code)
+
+        # 响应的信息，成功和错误的都是这个
+        # 成功和异常响应的信息，异常信息在前面自定义异常处理中已经处理为{'message': 'error'}这种格式
+        # print(data)
 
-            # print(renderer_context)
-            # print(renderer_context["response"].status_code)
-
-            # 响应的信息，成功和错误的都是这个
-            # 成功和异常响应的信息，异常信息在前面自定义异常处理中已经处理为{'message': 'error'}这种格式
-            # print(data)
-
-            # 如果返回的data为字典
-            if isinstance(data, dict):
-                # 响应信息中有message和code这两个key，则获取响应信息中的message和code，并且将原本data中的这两个key删除，放在自定义响应信息里
-                # 响应信息中没有则将msg内容改为请求成功 code改为请求的状态码
-                msg = data.pop('message', '请求成功')
-                code = data.pop('code', renderer_context["response"].status_code)
-            # 如果不是字典则将msg内容改为请求成功 code改为请求的状态码
-            else:
-                msg = '请求成功'
-                code = renderer_context["response"].status_code
-
-            # 自定义返回的格式
-            ret = {
-                'msg': msg,
-                'code': code,
-                'data': data,
-            }
-            # 返回JSON数据
-            return super().render(ret, accepted_media_type, renderer_context)
+        # 如果返回的data为字典
+        if isinstance(data, dict):
+            # 响应信息中有message和code这两个key，则获取响应信息中的message和code，并且将原本data中的这两个key删除，放在自定义响应信息里
+            # 响应信息中没有则将msg内容改为请求成功 code改为请求的状态码
+            msg = data.pop('message', '请求成功')
+            code = data.pop('code', renderer_context["response"].status_code)
+        # 如果不是字典则将msg内容改为请求成功 code改为请求的状态码
         else:
+            msg = '请求成功'
+            code = renderer_context["response"].status_code
+
+        # 自定义返回的格式
+        return {
+            'msg': msg,
+            'code': code,
+            'data': data,
+        }
+
+
+# 未安装orjson时复用同一个编码器实例，输出格式与JSONRenderer一致，与JSONRenderer一样不允许NaN、Infinity
+_json_encoder = encoders.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+
+def _orjson_default(obj):
+    # orjson不支持的类型(Decimal、懒翻译字符串等)以及日期时间交给DRF的编码器，保持原有格式
+    return _json_encoder.default(obj)
+
+
+class FastJSONRenderer(CustomRenderer):
+    """
+    高性能JSON渲染器，返回的{msg, code, data}结构与CustomRenderer相同
+    安装orjson时使用orjson编码，否则使用标准库json；列表超过FAST_RENDERER_STREAM_THRESHOLD条时可配合StreamingListMixin流式输出
+    orjson的浮点数格式与标准库略有不同(如1e16与1e+16)，NaN、Infinity输出为null
+    """
+    stream_chunk_size = 20
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # 没有renderer_context或需要缩进(如浏览器调试)时走原有渲染
+        if not renderer_context or self.get_indent(accepted_media_type, renderer_context):
             return super().render(data, accepted_media_type, renderer_context)
+        return self.encode(self.wrap(data, renderer_context))
+
+    def encode(self, data):
+        if orjson is not None:
+            ret = orjson.dumps(data, default=_orjson_default,
+                               option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        else:
+            ret = _json_encoder.encode(data).encode()
+        # 与JSONRenderer一致，转义U+2028、U+2029
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+    def should_stream(self, data):
+        if isinstance(data, dict):
+            data = data.get("results")
+        threshold = getattr(settings, "FAST_RENDERER_STREAM_THRESHOLD", 50)
+        return isinstance(data, list) and len(data) > threshold
+
+    def iter_render(self, data, renderer_context):
+        """分块输出，列表每stream_chunk_size条编码一次"""
+        envelope = self.wrap(data, renderer_context)
+        payload = envelope["data"]
+        if isinstance(payload, dict):
+            items = payload["results"]
+            meta = OrderedDict((key, value) for key, value in payload.items() if key != "results")
+            head = self.encode(dict(envelope, data=meta))[:-2]
+            head += b',"results":[' if meta else b'"results":['
+            tail = b']}}'
+        else:
+            items = payload
+            head = self.encode(dict(envelope, data=[]))[:-2]
+            tail = b']}'
+        yield head
+        for start in range(0, len(items), self.stream_chunk_size):
+            chunk = b','.join(self.encode(item) for item in items[start:start + self.stream_chunk_size])
+            yield (b',' + chunk) if start else chunk
+        yield tail
+
+    def streaming_response(self, response):
+        renderer_context = dict(response.renderer_context, response=response)
+        stream = StreamingHttpResponse(self.iter_render(response.data, renderer_context),
+                                       status=response.status_code, content_type=response.accepted_media_type)
+        for header, value in response.items():
+            # Content-Type在渲染时才确定，未渲染的Response中是默认值
+            if header.lower() != "content-type":
+                stream[header] = value
+        return stream
+
+
+class StreamingListMixin(object):
+    """使用FastJSONRenderer时，大列表响应改为流式输出"""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        renderer = getattr(response, "accepted_renderer", None)
+        if isinstance(response, Response) and isinstance(renderer, FastJSONRenderer) \
+                and renderer.should_stream(response.data):
+            return renderer.streaming_response(response)
+        return response
 
 
 def customExceptionHandler(exc, context):
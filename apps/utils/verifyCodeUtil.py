@@ -0,0 +1,130 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class BaseCodeStore(object):
+    """
+    短信验证码存储，按TTL实现发送间隔和有效期，不再查询VerifyCode表
+    reserve: 占用发送间隔，间隔内再次调用返回False
+    save/get: 保存、读取验证码，过期后get返回None
+    release: 短信发送失败时删除验证码并释放发送间隔
+    delete: 注册成功后删除，验证码只能使用一次
+    """
+
+    @property
+    def send_interval(self):
+        return getattr(settings, "VERIFY_CODE_SEND_INTERVAL", 60)
+
+    @property
+    def expire(self):
+        return getattr(settings, "VERIFY_CODE_EXPIRE", 300)
+
+    def reserve(self, mobile):
+        raise NotImplementedError
+
+    def save(self, mobile, code):
+        raise NotImplementedError
+
+    def get(self, mobile):
+        raise NotImplementedError
+
+    def delete(self, mobile):
+        raise NotImplementedError
+
+    def release(self, mobile, code):
+        # 已经重新获取的验证码不删除
+        if self.get(mobile) == code:
+            self.delete(mobile)
+
+
+class CacheCodeStore(BaseCodeStore):
+    """使用django缓存(生产环境为redis)，发送间隔用cache.add原子占用"""
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, "VERIFY_CODE_CACHE_ALIAS", "default")
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def reserve(self, mobile):
+        return self.cache.add("verify_code:interval:%s" % mobile, 1, self.send_interval)
+
+    def save(self, mobile, code):
+        self.cache.set("verify_code:code:%s" % mobile, code, self.expire)
+
+    def get(self, mobile):
+        return self.cache.get("verify_code:code:%s" % mobile)
+
+    def delete(self, mobile):
+        self.cache.delete("verify_code:code:%s" % mobile)
+
+    def release(self, mobile, code):
+        super().release(mobile, code)
+        self.cache.delete("verify_code:interval:%s" % mobile)
+
+
+class MemoryCodeStore(BaseCodeStore):
+    """进程内存储，用于测试和单进程开发环境"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._intervals = {}
+        self._codes = {}
+
+    def _alive(self, data, mobile):
+        item = data.get(mobile)
+        if item is not None and item[1] <= self.clock():
+            del data[mobile]
+            return None
+        return item
+
+    def reserve(self, mobile):
+        with self._lock:
+            if self._alive(self._intervals, mobile) is not None:
+                return False
+            self._intervals[mobile] = (1, self.clock() + self.send_interval)
+            return True
+
+    def save(self, mobile, code):
+        with self._lock:
+            self._codes[mobile] = (code, self.clock() + self.expire)
+
+    def get(self, mobile):
+        with self._lock:
+            item = self._alive(self._codes, mobile)
+        return item[0] if item is not None else None
+
+    def delete(self, mobile):
+        with self._lock:
+            self._codes.pop(mobile, None)
+
+    def release(self, mobile, code):
+        super().release(mobile, code)
+        with self._lock:
+            self._intervals.pop(mobile, None)
+
+    def clear(self):
+        with self._lock:
+            self._intervals.clear()
+            self._codes.clear()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_code_store():
+    """settings.VERIFY_CODE_STORE: cache(默认)、memory"""
+    name = getattr(settings, "VERIFY_CODE_STORE", "cache")
+    store = _stores.get(name)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(name)
+            if store is None:
+                store = _stores[name] = {"cache": CacheCodeStore, "memory": MemoryCodeStore}[name]()
+    return store
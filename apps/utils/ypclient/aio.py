@@ -0,0 +1,95 @@
+# coding: utf8
+"""
+asyncio client for YunPian, for ASGI views and background consumers.
+
+AsyncClientV2 has the same methods as ClientV2, every method returns a coroutine:
+    client = AsyncClientV2(api_key)
+    response = await client.send_sms(mobile, content)
+    response.json()
+
+Uses aiohttp when it is installed, otherwise runs the pooled requests session in the default executor.
+The aiohttp session belongs to the event loop it was created in, use one client per event loop.
+"""
+
+import asyncio
+import functools
+import json
+import random
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .yunpian import ClientV2
+
+
+class AsyncResponse(object):
+    """
+    The body is read before returning, so json() is not a coroutine, same as requests.Response
+    """
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncClientV2(ClientV2):
+    RETRY_STATUS = (429, 503)
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncClientV2, self).__init__(*args, **kwargs)
+        self._aiohttp_session = None
+
+    async def request(self, business_type, resource, function, req_method, **kwargs):
+        """
+        same as ClientBase.request, retry policy same as build_session
+        :return: {AsyncResponse}
+        """
+        req_method, req_url, kwargs = self.prepare_request(business_type, resource, function, req_method, **kwargs)
+        if aiohttp is None:
+            response = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                getattr(self.session, req_method), req_url, data=kwargs, verify=self.ssl_verify,
+                timeout=self.get_time_out()))
+            return AsyncResponse(response.status_code, response.text)
+
+        session = self.get_aiohttp_session()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.request(req_method, req_url, data=kwargs, ssl=None if self.ssl_verify else False,
+                                           timeout=self.get_aiohttp_timeout()) as response:
+                    text = await response.text()
+                    if response.status not in self.RETRY_STATUS or attempt == self.max_retries:
+                        return AsyncResponse(response.status, text)
+            except aiohttp.ClientConnectorError:
+                # the connection was not established, the request was not sent
+                if attempt == self.max_retries:
+                    raise
+            backoff = self.backoff_factor * 2 ** attempt
+            await asyncio.sleep(backoff + random.uniform(0, backoff))
+
+    def get_aiohttp_session(self):
+        if self._aiohttp_session is None or self._aiohttp_session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+            self._aiohttp_session = aiohttp.ClientSession(connector=connector)
+        return self._aiohttp_session
+
+    def get_aiohttp_timeout(self):
+        time_out = self.get_time_out()
+        if isinstance(time_out, tuple):
+            return aiohttp.ClientTimeout(sock_connect=time_out[0], sock_read=time_out[1])
+        return aiohttp.ClientTimeout(total=time_out)
+
+    async def close(self):
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+            self._aiohttp_session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
@@ -8,11 +8,18 @@ Features:
     1. Persistent connection
     2. Support py2/py3
     3. Configurable client
+    4. Pooled connections, retry on connection errors and 429/503 with jitter
 
 :author: gzj 20160812
 """
 
+import random
+import threading
+from contextlib import contextmanager
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from urllib.parse import quote
@@ -20,6 +27,44 @@ except ImportError:
     from urllib import quote
 
 
+class JitterRetry(Retry):
+    """
+    Retry with random jitter added to the exponential backoff,
+    so that workers retrying at the same time do not hit the server together
+    """
+
+    def get_backoff_time(self):
+        backoff = super(JitterRetry, self).get_backoff_time()
+        return backoff + random.uniform(0, backoff)
+
+
+def build_session(pool_size=10, max_retries=2, backoff_factor=0.3):
+    """
+    :param pool_size: {int} max connections kept alive per host, should cover the number of concurrent workers
+    :param max_retries: {int} retries on connection errors and 429/503 responses
+    :param backoff_factor: {float} base of the exponential backoff between retries, in seconds
+    :return: {Session}
+
+    Sending SMS is not idempotent, so a request is only retried when the server surely has not handled it:
+    the connection could not be established, or the server answered 429/503. Read errors are never retried.
+    """
+    retry = JitterRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=max_retries,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset(['POST']),
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class ClientBase(object):
     """
     :author gzj 20160808
@@ -35,11 +80,16 @@ class ClientBase(object):
     CARRIER_CHINA_UNICOM = '10010'
     CARRIER_CHINA_TELECOM = '10000'
 
-    def __init__(self, api_key, time_out=5, res_format='json', ssl_verify=True):
+    def __init__(self, api_key, time_out=5, res_format='json', ssl_verify=True,
+                 pool_size=10, max_retries=2, backoff_factor=0.3, session=None):
         """
         :param api_key: {string}
         :param res_format: {string}
-        :param time_out: {int} duration of request time out, in seconds
+        :param time_out: {int|tuple} duration of request time out, in seconds, or (connect, read)
+        :param pool_size: {int} see build_session
+        :param max_retries: {int} see build_session
+        :param backoff_factor: {float} see build_session
+        :param session: {Session} share a session between clients instead of building one
         """
         self.__heads = {
             "Accept": "application/json;charset=utf-8;",
@@ -48,8 +98,12 @@ class ClientBase(object):
         self.api_key = api_key
         self.url_tpl = "https://{business_type}.yunpian.com/{version}/{resource}/{function}.{res_format}"
         self.api_version = None
-        self.session = requests.Session()
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = session or build_session(pool_size, max_retries, backoff_factor)
         self.time_out = time_out
+        self._local = threading.local()
         self.res_format = res_format
         self.ssl_verify = ssl_verify
 
@@ -64,6 +118,14 @@ class ClientBase(object):
         :return: {Response}
         :author: gzj 20160812
         """
+        req_method, req_url, kwargs = self.prepare_request(business_type, resource, function, req_method, **kwargs)
+        return getattr(self.session, req_method)(req_url, data=kwargs, verify=self.ssl_verify,
+                                                 timeout=self.get_time_out())
+
+    def prepare_request(self, business_type, resource, function, req_method, **kwargs):
+        """
+        :return: {tuple} (request method, url, params)
+        """
         req_url = self.url_tpl.format(
             business_type=business_type,
             version=self.api_version,
@@ -80,7 +142,25 @@ class ClientBase(object):
         if req_method not in self.ALLOWED_METHODS:
             raise ValueError('method %s is not allowed' % req_method)
 
-        return getattr(self.session, req_method)(req_url, data=kwargs, verify=self.ssl_verify, timeout=self.time_out)
+        return req_method, req_url, kwargs
+
+    def get_time_out(self):
+        return getattr(self._local, 'time_out', self.time_out)
+
+    @contextmanager
+    def timeout(self, time_out):
+        """
+        Override the time out for calls made in this thread
+            with client.timeout(2):
+                client.send_sms(mobile, content)
+        :param time_out: {int|tuple}
+        """
+        previous = self.get_time_out()
+        self._local.time_out = time_out
+        try:
+            yield self
+        finally:
+            self._local.time_out = previous
 
     @staticmethod
     def assemble_params(**kwargs):
@@ -1,13 +1,43 @@
-import json
-from utils.ypclient.yunpian import ClientV2
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future
 
+import requests
 from django.conf import settings
+from django.core.cache import cache
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from utils import serviceLogger
+from utils.ypclient.yunpian import ClientV2
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    进程内共享的短信客户端，复用requests.Session中的连接；SMS_FAKE_GATEWAY为True时使用本地假网关
+    连接池大小SMS_HTTP_POOL_SIZE应不小于同时发送短信的线程数(TASK_QUEUE_THREADS、run_consumers的worker数)
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if getattr(settings, "SMS_FAKE_GATEWAY", False):
+                    _client = FakeSmsClient()
+                else:
+                    _client = ClientV2(settings.YUNPIAN_API_KEY,
+                                       time_out=getattr(settings, "SMS_HTTP_TIMEOUT", 5),
+                                       pool_size=getattr(settings, "SMS_HTTP_POOL_SIZE", 10),
+                                       max_retries=getattr(settings, "SMS_HTTP_RETRIES", 2))
+    return _client
 
 
 class YunPian(object):
-    def __init__(self):
+    def __init__(self, client=None):
         # api key
-        self.client = ClientV2(settings.YUNPIAN_API_KEY)
+        self.client = client or get_client()
 
     def send_register_sms(self, mobile, context):
         # 登录验证码短信
@@ -17,5 +47,241 @@ class YunPian(object):
             tpl_id=tpl_id,
             tpl_context=context
         )
-        print(json.dumps(res.json()))
-        return res.json()
+        result = res.json()
+        serviceLogger.debug("验证码短信发送结果: code=%s msg=%s", result.get("code"), result.get("msg"))
+        return result
+
+    def send_register_sms_once(self, key, mobile, context):
+        """
+        幂等发送登录验证码，同一个key只发送一次，任务重复投递时返回None
+        网络错误按指数退避重试SMS_MAX_RETRIES次，仍失败时抛出异常
+        """
+        sent_key = "sms:sent:%s" % key
+        if not cache.add(sent_key, 1, getattr(settings, "SMS_IDEMPOTENCY_TIMEOUT", 3600)):
+            return None
+        retries = getattr(settings, "SMS_MAX_RETRIES", 3)
+        for attempt in range(retries + 1):
+            try:
+                return self.send_register_sms(mobile, context)
+            except (requests.RequestException, ValueError) as e:
+                if attempt == retries:
+                    # 允许之后重新发送
+                    cache.delete(sent_key)
+                    raise
+                serviceLogger.warning("短信发送失败，第%d次重试: %s", attempt + 1, e)
+                time.sleep(getattr(settings, "SMS_RETRY_DELAY", 0.5) * 2 ** attempt)
+
+    def broadcast(self, mobiles, text, timeout=None):
+        """群发短信(如社区公告)，合并到批量接口发送，返回{号码: 该号码的发送结果}"""
+        futures = get_sms_batcher().send_many(mobiles, text)
+        return {mobile: future.result(timeout) for mobile, future in zip(mobiles, futures)}
+
+
+class SmsBatcher(object):
+    """
+    合并发送短信，收集window秒内(或满max_batch条)的短信一起发送
+    内容相同的多个号码走broadcast_sms(batch_send)，内容不同的走send_multi_sms(multi_send)
+    每条短信返回一个Future，结果为云片返回的该号码的发送结果；批量请求连接失败或部分号码失败时，失败的号码逐条重发
+    """
+    # 云片批量接口单次最多1000个号码
+    max_batch = 1000
+
+    def __init__(self, client=None, window=None):
+        self.client = client
+        self.window = window if window is not None else getattr(settings, "SMS_BATCH_WINDOW", 0.2)
+        self.upstream_calls = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def send(self, mobile, text):
+        future = Future()
+        with self._lock:
+            self._pending.append((mobile, text, future))
+            full = len(self._pending) >= self.max_batch
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+        return future
+
+    def send_many(self, mobiles, text):
+        return [self.send(mobile, text) for mobile in mobiles]
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return
+        # 同一号码同一内容只发送一次
+        waiters = defaultdict(list)
+        for mobile, text, future in pending:
+            waiters[(mobile, text)].append(future)
+        try:
+            results = self.send_jobs(list(waiters))
+        except Exception as e:
+            for futures in waiters.values():
+                for future in futures:
+                    future.set_exception(e)
+            raise
+        for job, futures in waiters.items():
+            for future in futures:
+                future.set_result(results[job])
+
+    def send_jobs(self, jobs):
+        """jobs为[(号码, 内容)]，返回{(号码, 内容): 发送结果}"""
+        client = self.client or get_client()
+        by_text = defaultdict(list)
+        for mobile, text in jobs:
+            by_text[text].append(mobile)
+
+        results = {}
+        singles = []
+        for text, mobiles in by_text.items():
+            if len(mobiles) == 1:
+                singles.append((mobiles[0], text))
+                continue
+            for start in range(0, len(mobiles), self.max_batch):
+                chunk = mobiles[start:start + self.max_batch]
+                results.update(self.send_batch(lambda: client.broadcast_sms(chunk, text),
+                                               [(mobile, text) for mobile in chunk]))
+
+        # multi_send的结果按号码对应，同一号码有多条不同内容时逐条发送
+        counts = Counter(mobile for mobile, text in singles)
+        multi = [job for job in singles if counts[job[0]] == 1]
+        for job in singles:
+            if counts[job[0]] > 1:
+                results[job] = self.send_one(client, *job)
+        for start in range(0, len(multi), self.max_batch):
+            chunk = multi[start:start + self.max_batch]
+            if len(chunk) == 1:
+                results[chunk[0]] = self.send_one(client, *chunk[0])
+            else:
+                results.update(self.send_batch(
+                    lambda: client.send_multi_sms(jobs=[{mobile: text} for mobile, text in chunk]), chunk))
+        return results
+
+    def send_batch(self, call, jobs):
+        """
+        批量发送，只有确定请求没有到达网关(连接失败)或网关明确返回失败的号码才逐条重发
+        读超时等情况网关可能已经接受了请求，重发会导致重复短信，这些号码的结果标记为未知
+        """
+        self.upstream_calls += 1
+        client = self.client or get_client()
+        try:
+            response = call()
+        except requests.RequestException as e:
+            if may_have_been_sent(e):
+                serviceLogger.error("批量短信发送结果未知，不重发: %s", e)
+                return {job: unknown_result(job[0], e) for job in jobs}
+            serviceLogger.warning("批量短信连接失败，改为逐条发送: %s", e)
+            return {job: self.send_one(client, *job) for job in jobs}
+        try:
+            items = {item.get("mobile"): item for item in response.json().get("data", [])}
+        except (ValueError, AttributeError) as e:
+            serviceLogger.error("批量短信返回无法解析，不重发: %s", e)
+            return {job: unknown_result(job[0], e) for job in jobs}
+        results = {}
+        for mobile, text in jobs:
+            item = items.get(mobile)
+            if item is None:
+                results[(mobile, text)] = unknown_result(mobile, "批量短信返回中没有该号码")
+            elif item.get("code") == 0:
+                results[(mobile, text)] = item
+            else:
+                results[(mobile, text)] = self.send_one(client, mobile, text)
+        return results
+
+    def send_one(self, client, mobile, text):
+        self.upstream_calls += 1
+        try:
+            return client.send_sms(mobile, text).json()
+        except (requests.RequestException, ValueError) as e:
+            return {"code": -1, "msg": str(e), "mobile": mobile}
+
+
+def may_have_been_sent(error):
+    """
+    请求是否可能已经到达网关，连接超时、建立连接失败时可以放心重发
+    ypclient不重试读错误，读超时和连接中断会包装在ConnectionError中抛出
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    if not isinstance(error, requests.ConnectionError):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (ReadTimeoutError, ProtocolError))
+
+
+def unknown_result(mobile, error):
+    return {"code": -1, "msg": "发送结果未知: %s" % error, "mobile": mobile}
+
+
+_batcher = None
+
+
+def get_sms_batcher():
+    """进程内共享的合并发送器"""
+    global _batcher
+    if _batcher is None:
+        with _client_lock:
+            if _batcher is None:
+                _batcher = SmsBatcher()
+    return _batcher
+
+
+class FakeSmsResponse(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeSmsClient(object):
+    """
+    本地假短信网关，开发和测试使用，不发送短信，发送记录保存在sent中，calls为请求次数
+    fail_times大于0时模拟网络错误，rejected中的号码发送失败
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.calls = 0
+        self.fail_times = 0
+        self.rejected = set()
+        self._lock = threading.Lock()
+
+    def _send(self, mobile, **kwargs):
+        if mobile in self.rejected:
+            return {"code": 2, "msg": "参数格式不正确", "mobile": mobile}
+        self.sent.append(dict(mobile=mobile, **kwargs))
+        return {"code": 0, "msg": "发送成功", "count": 1, "fee": 0.05, "unit": "RMB",
+                "mobile": mobile, "sid": len(self.sent)}
+
+    def _request(self, send):
+        with self._lock:
+            self.calls += 1
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise requests.ConnectionError("fake gateway unavailable")
+            return FakeSmsResponse(send())
+
+    def send_tpl_sms(self, mobile, tpl_id, tpl_context, **kwargs):
+        return self._request(lambda: self._send(mobile, tpl_id=tpl_id, tpl_context=tpl_context))
+
+    def send_sms(self, mobile, content, **kwargs):
+        return self._request(lambda: self._send(mobile, text=content))
+
+    def broadcast_sms(self, mobiles, content, **kwargs):
+        return self._request(lambda: {"data": [self._send(mobile, text=content) for mobile in mobiles]})
+
+    def send_multi_sms(self, mobiles=[], contents=[], jobs=[], **kwargs):
+        jobs = [item for job in jobs for item in job.items()] or list(zip(mobiles, contents))
+        return self._request(lambda: {"data": [self._send(mobile, text=text) for mobile, text in jobs]})
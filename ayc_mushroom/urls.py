@@ -23,7 +23,8 @@ from rest_framework.routers import DefaultRouter
 
 from emergency.views import EmergencyBuildViewSet
 from user_operation.views import UserTopicListViewSet, UserCommunityViewSet
-from users.views import UserViewset, SmsCodeViewset, UploadApiView, UserAddressViewSet
+from users.views import UserViewset, SmsCodeViewset, UploadApiView, UserAddressViewSet, UploadSignApiView, \
+    UploadConfirmApiView
 from forum.views import CommunityDetailViewSet, CommunityMembersViewSet, TopicThumbViewSet, TopicCommentViewSet, \
     CommunityCardChangeViewSet
 
@@ -39,12 +40,12 @@ router.register(r"address", UserAddressViewSet, basename="user_address")
 router.register(r"user/topic", UserTopicListViewSet, basename="user_topic")
 # 用户社区
 router.register(r"user/community", UserCommunityViewSet, basename="user_community")
-# 首页帖子
-router.register(r"topic", CommunityDetailViewSet, basename="topic")
 # 帖子点赞
 router.register(r"topic/thumb", TopicThumbViewSet, basename="topic_thumb")
 # 帖子评论
 router.register(r"topic/comment", TopicCommentViewSet, basename="topic_comment")
+# 首页帖子 (需注册在topic/thumb、topic/comment之后，否则topic/{pk}会匹配到topic/comment)
+router.register(r"topic", CommunityDetailViewSet, basename="topic")
 # 首页社区成员
 router.register(r"community/members", CommunityMembersViewSet, basename="community_members")
 # 社区成员交换名片
@@ -59,6 +60,8 @@ urlpatterns = [
     url(r'ayc_mushroom/api-token-auth/', views.obtain_auth_token),  # drf自带的token认证模式
     # 业务路由
     url(r"ayc_mushroom/login/", obtain_jwt_token),  # jwt-token登录
+    url(r"ayc_mushroom/oss/sign/", UploadSignApiView.as_view()),  # oss 直传签名
+    url(r"ayc_mushroom/oss/confirm/", UploadConfirmApiView.as_view()),  # oss 直传确认
     url(r"ayc_mushroom/oss/", UploadApiView.as_view()),  # oss 文件上传 删除
     url(r"^ayc_mushroom/api-v1/", include(router.urls))
 ]
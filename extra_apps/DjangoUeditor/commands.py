@@ -17,15 +17,22 @@ class UEditorEventHandler(object):
     def on_contentchange(self):
         return ""
 
+    @classmethod
+    def event_names(cls):
+        """列出所有on_打头的方法，然后在ueditor中进行侦听，每个类只扫描一次"""
+        names = cls.__dict__.get("_event_names")
+        if names is None:
+            names = [name for name in dir(cls) if name[0:3] == "on_"]
+            cls._event_names = names
+        return names
+
     def render(self, editorID):
         jscode = """
             %(editor)s.addListener('%(event)s', function () {
                 %(event_code)s
         });"""
         event_codes = []
-        # 列出所有on_打头的方法，然后在ueditor中进行侦听
-        events = filter(lambda x: x[0:3] == "on_", dir(self))
-        for event in events:
+        for event in self.event_names():
             try:
                 event_code = getattr(self, event)()
                 if event_code:
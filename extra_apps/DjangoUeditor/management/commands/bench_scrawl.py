@@ -0,0 +1,46 @@
+import base64
+import os
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from DjangoUeditor.views import save_scrawl_file
+
+
+def save_scrawl_file_at_once(request, filename):
+    """原实现: 从request.POST取出整个字段一次解码"""
+    content = request.POST.get("upfile")
+    with open(filename, "wb") as f:
+        f.write(base64.b64decode(content))
+    return "SUCCESS"
+
+
+class Command(BaseCommand):
+    help = "压测用: 对比一次解码与流式解码保存涂鸦时的内存峰值和耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1,5,10", help="涂鸦图片大小(MB)，逗号分隔")
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=None):
+            for size in [int(size) for size in options["sizes"].split(",")]:
+                self.stdout.write("========== %dMB ==========" % size)
+                body = urlencode({"upfile": base64.b64encode(os.urandom(size * 1024 * 1024))}).encode()
+                for name, save in (("一次解码", save_scrawl_file_at_once), ("流式解码", save_scrawl_file)):
+                    request = factory.post("/ueditor/controller/?action=uploadscrawl&scrawlMaxSize=0", body,
+                                           content_type="application/x-www-form-urlencoded")
+                    filename = os.path.join(tmp_dir, "scrawl.png")
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    state = save(request, filename)
+                    cost = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    self.stdout.write("-- %s: %s, 内存峰值%.2fMB, %.1fms" % (
+                        name, state, peak / 1024 / 1024, cost * 1000))
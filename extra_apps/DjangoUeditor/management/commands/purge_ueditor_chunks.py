@@ -0,0 +1,27 @@
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "删除超时未完成的编辑器分片上传"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=float, default=getattr(settings, "UEDITOR_CHUNK_EXPIRE", 24 * 3600) / 3600,
+                            help="删除多少小时内没有上传分片的上传，默认为UEDITOR_CHUNK_EXPIRE")
+
+    def handle(self, *args, **options):
+        root = os.path.join(settings.MEDIA_ROOT, getattr(settings, "UEDITOR_CHUNK_DIR", ".chunks"))
+        before = time.time() - options["hours"] * 3600
+        total = 0
+        if os.path.isdir(root):
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    # 写入分片会更新目录的mtime
+                    if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < before:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        total += 1
+        self.stdout.write("purged %d chunked uploads" % total)
@@ -0,0 +1,45 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from DjangoUeditor.models import UEditorFile
+from DjangoUeditor.utils import scan_files
+
+
+class Command(BaseCommand):
+    help = "扫描MEDIA_ROOT重建编辑器上传文件索引，新增、更新有变化的文件，删除已不存在的文件"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="", help="只重建MEDIA_ROOT下的该目录")
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批写入数量")
+
+    def handle(self, *args, **options):
+        sub_path = options["path"].strip("/")
+        batch_size = options["batch_size"]
+        indexed = UEditorFile.objects.all()
+        if sub_path:
+            indexed = indexed.filter(path__startswith=sub_path + "/")
+        existing = {path: (pk, size, mtime) for pk, path, size, mtime in
+                    indexed.values_list("id", "path", "size", "mtime").iterator()}
+
+        created, updated = [], []
+        for path, stat in scan_files(settings.MEDIA_ROOT, sub_path):
+            if len(path) > 255:
+                continue
+            old = existing.pop(path, None)
+            item = UEditorFile(path=path, ext=os.path.splitext(path)[1], size=stat.st_size, mtime=stat.st_mtime)
+            if old is None:
+                created.append(item)
+            elif old[1:] != (item.size, item.mtime):
+                item.id = old[0]
+                updated.append(item)
+
+        with transaction.atomic():
+            UEditorFile.objects.bulk_create(created, batch_size=batch_size)
+            UEditorFile.objects.bulk_update(updated, ["size", "mtime"], batch_size=batch_size)
+            removed = [pk for pk, size, mtime in existing.values()]
+            for start in range(0, len(removed), batch_size):
+                UEditorFile.objects.filter(id__in=removed[start:start + batch_size]).delete()
+        self.stdout.write("created %d, updated %d, removed %d" % (len(created), len(updated), len(removed)))
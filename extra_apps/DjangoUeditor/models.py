@@ -40,6 +40,28 @@ class UEditorField(models.TextField):
                 attrs=self.ueditor_settings)
         return super(UEditorField, self).formfield(**defaults)
 
+class UEditorFile(models.Model):
+    """
+    MEDIA_ROOT下上传文件的索引，列出文件时按mtime分页查询，不再遍历目录
+    上传时写入，可用rebuild_ueditor_index命令从磁盘重建
+    """
+    path = models.CharField(max_length=255, unique=True, verbose_name="相对MEDIA_ROOT的路径")
+    ext = models.CharField(max_length=20, default="", verbose_name="扩展名")
+    size = models.BigIntegerField(default=0, verbose_name="文件大小")
+    mtime = models.FloatField(default=0, verbose_name="修改时间")
+
+    class Meta:
+        verbose_name = "编辑器上传文件"
+        verbose_name_plural = verbose_name
+        indexes = [
+            # listimage/listfile按类型过滤、按修改时间倒序分页
+            models.Index(fields=["ext", "-mtime"], name="ueditor_file_ext_mtime_idx"),
+        ]
+
+    def __str__(self):
+        return self.path
+
+
 # 以下支持south
 try:
     from south.modelsinspector import add_introspection_rules
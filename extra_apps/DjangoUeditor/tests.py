@@ -0,0 +1,354 @@
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlencode
+
+from django import forms
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase, override_settings
+
+from DjangoUeditor.commands import UEditorEventHandler
+from DjangoUeditor.models import UEditorFile
+from DjangoUeditor.utils import Base64StreamDecoder, iter_form_field
+from DjangoUeditor.views import UploadFile, catcher_remote_image, get_ueditor_controller, list_files
+from DjangoUeditor.widgets import UEditorWidget
+from users.models import UploadObject, User
+
+
+class UploadFileTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_patcher = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.factory = RequestFactory()
+
+    def upload(self, content, name="a.png"):
+        request = self.factory.post("/ueditor/controller/?action=uploadimage",
+                                    {"upfile": SimpleUploadedFile(name, content)})
+        return json.loads(UploadFile(request).content)
+
+    def test_dedup(self):
+        first = self.upload(b"image")
+        self.assertEqual(first["state"], "SUCCESS")
+        second = self.upload(b"image", "b.png")
+        self.assertEqual(second["url"], first["url"])
+        self.assertNotEqual(self.upload(b"other")["url"], first["url"])
+        self.assertEqual(len(os.listdir(self.media_root)), 2)
+        self.assertEqual(UploadObject.objects.get(storage="local", name=first["url"][len("/media/"):]).ref_count, 2)
+
+
+class ListFilesTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_patcher = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.factory = RequestFactory()
+
+    def write(self, path, mtime, content=b"x"):
+        full_path = os.path.join(self.media_root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(content)
+        os.utime(full_path, (mtime, mtime))
+
+    def list(self, start, size):
+        request = self.factory.get("/ueditor/controller/", {"action": "listimage", "start": start, "size": size})
+        return json.loads(list_files(request).content)
+
+    def test_rebuild_and_paginate(self):
+        for i in range(5):
+            self.write("images/%d.png" % i, 1000 + i)
+        self.write("files/a.txt", 2000)
+        call_command("rebuild_ueditor_index", stdout=io.StringIO())
+        self.assertEqual(UEditorFile.objects.count(), 6)
+
+        with self.assertNumQueries(2):
+            result = self.list(1, 2)
+        self.assertEqual(result["total"], 5)
+        self.assertEqual([item["url"] for item in result["list"]], ["/media/images/3.png", "/media/images/2.png"])
+
+        # 上传的文件写入索引
+        request = self.factory.post("/ueditor/controller/?action=uploadimage",
+                                    {"upfile": SimpleUploadedFile("new.png", b"new")})
+        url = json.loads(UploadFile(request).content)["url"]
+        self.assertEqual(self.list(0, 1)["list"][0]["url"], url)
+
+        # 重建时删除已不存在的文件，更新有变化的文件
+        os.remove(os.path.join(self.media_root, "images/0.png"))
+        self.write("images/1.png", 4102444800)
+        out = io.StringIO()
+        call_command("rebuild_ueditor_index", stdout=out)
+        self.assertIn("created 0, updated 1, removed 1", out.getvalue())
+        self.assertEqual(self.list(0, 1)["list"][0]["url"], "/media/images/1.png")
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """/delay/秒数/文件名 延迟返回，/big.png 超过大小限制"""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "delay":
+            time.sleep(float(parts[1]))
+        body = b"x" * 2048 if self.path.endswith("big.png") else self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.end_headers()
+        # 不发送Content-Length，按读取的大小限制
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    """客户端超时断开后桩服务写响应会出现BrokenPipeError，不打印到测试输出"""
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+@override_settings(UEDITOR_CATCHER_TIMEOUT=2, UEDITOR_CATCHER_TOTAL_TIMEOUT=1)
+class CatcherRemoteImageTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubHTTPServer(("127.0.0.1", 0), StubImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.host = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        StubImageHandler.requests = []
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_patcher = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.factory = RequestFactory()
+
+    def catch(self, *paths):
+        request = self.factory.post("/ueditor/controller/?action=catchimage&catcherMaxSize=1024",
+                                    {"source[]": [self.host + path for path in paths]})
+        result = json.loads(catcher_remote_image(request).content)
+        return {item["source"][len(self.host):]: item for item in result["list"]}
+
+    def test_parallel_and_limits(self):
+        paths = ["/delay/0.3/%d.png" % i for i in range(6)]
+        start = time.monotonic()
+        result = self.catch(*paths + ["/big.png", "/delay/3/slow.png", "/a.txt", paths[0]])
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(set(result), set(paths) | {"/big.png", "/delay/3/slow.png"})
+        for path in paths:
+            self.assertEqual(result[path]["state"], "SUCCESS")
+            with open(os.path.join(self.media_root, result[path]["url"][len("/media/"):]), "rb") as f:
+                self.assertEqual(f.read(), path.encode())
+        self.assertIn("大小", result["/big.png"]["state"])
+        self.assertIn("超时", result["/delay/3/slow.png"]["state"])
+        self.assertEqual(StubImageHandler.requests.count(paths[0]), 1)
+
+        # 抓取过的地址不再下载
+        again = self.catch(paths[1])
+        self.assertEqual(again[paths[1]]["url"], result[paths[1]]["url"])
+        self.assertEqual(StubImageHandler.requests.count(paths[1]), 1)
+
+
+@override_settings(UEDITOR_CHUNK_SIZE=1000)
+class ChunkedUploadTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_patcher = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.factory = RequestFactory()
+        self.user = User.objects.create(username="13800000000", mobile="13800000000")
+
+    def call(self, step, data=b"", method="post", user=None, **params):
+        params.update(action="uploadvideo", chunk=step)
+        url = "/ueditor/controller/?" + "&".join("%s=%s" % item for item in params.items())
+        if method == "get":
+            request = self.factory.get(url)
+        else:
+            request = self.factory.post(url, data, content_type="application/octet-stream")
+        request.user = user or self.user
+        return json.loads(get_ueditor_controller(request).content)
+
+    def upload(self, content):
+        init = self.call("init", name="a.mp4", size=len(content))
+        for index in range(init["chunks"]):
+            self.call("put", content[index * 1000:(index + 1) * 1000], upload_id=init["upload_id"], index=index)
+        return self.call("complete", upload_id=init["upload_id"])
+
+    def test_out_of_order_parallel_and_resume(self):
+        content = os.urandom(4500)
+        init = self.call("init", name="a.mp4", size=len(content))
+        self.assertEqual((init["state"], init["chunks"]), ("SUCCESS", 5))
+        upload_id = init["upload_id"]
+
+        def put(index, data=None):
+            data = content[index * 1000:(index + 1) * 1000] if data is None else data
+            return self.call("put", data, upload_id=upload_id, index=index)
+
+        threads = [threading.Thread(target=put, args=(index,)) for index in (4, 2, 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(put(1, b"short")["state"], "分片大小错误")
+        self.assertEqual(self.call("complete", upload_id=upload_id)["missing"], [1, 3])
+
+        # 断线后查询已上传的分片，只上传缺少的
+        status = self.call("status", method="get", upload_id=upload_id)
+        self.assertEqual(status["uploaded"], [0, 2, 4])
+        for index in set(range(5)) - set(status["uploaded"]):
+            self.assertEqual(put(index)["state"], "SUCCESS")
+        result = self.call("complete", upload_id=upload_id)
+        self.assertEqual((result["state"], result["size"], result["original"]), ("SUCCESS", 4500, "a.mp4"))
+        with open(os.path.join(self.media_root, result["url"][len("/media/"):]), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertTrue(UEditorFile.objects.filter(path=result["url"][len("/media/"):]).exists())
+        self.assertEqual(self.call("complete", upload_id=upload_id)["state"], "上传不存在或已过期")
+
+    def test_validation(self):
+        self.assertNotEqual(self.call("init", name="a.exe", size=10)["state"], "SUCCESS")
+        self.assertNotEqual(self.call("init", name="a.mp4", size=10 ** 10)["state"], "SUCCESS")
+        # url参数不能放宽大小限制
+        self.assertNotEqual(self.call("init", name="a.mp4", size=10 ** 10, videoMaxSize=10 ** 12)["state"], "SUCCESS")
+        self.assertEqual(self.call("put", upload_id="../../etc", index=0)["state"], "upload_id错误")
+
+    def test_authentication(self):
+        request = self.factory.post("/ueditor/controller/?action=uploadvideo&chunk=init&name=a.mp4&size=10")
+        request.user = AnonymousUser()
+        self.assertEqual(get_ueditor_controller(request).status_code, 403)
+        # 不能操作其他用户的上传
+        upload_id = self.call("init", name="a.mp4", size=10)["upload_id"]
+        other = User.objects.create(username="13900000000", mobile="13900000000")
+        self.assertEqual(self.call("put", b"0123456789", user=other, upload_id=upload_id, index=0)["state"],
+                         "upload_id错误")
+        self.assertEqual(self.call("status", method="get", user=other, upload_id=upload_id)["state"], "upload_id错误")
+
+    @override_settings(UEDITOR_CHUNK_MAX_OPEN=2)
+    def test_open_upload_limit(self):
+        upload_ids = [self.call("init", name="a.mp4", size=10)["upload_id"] for _ in range(2)]
+        self.assertEqual(self.call("init", name="a.mp4", size=10)["state"], "未完成的上传过多，请稍后再试")
+        other = User.objects.create(username="13900000000", mobile="13900000000")
+        self.assertEqual(self.call("init", name="a.mp4", size=10, user=other)["state"], "SUCCESS")
+        # 超时的上传不计数并被删除
+        chunk_dir = os.path.join(self.media_root, ".chunks", upload_ids[0])
+        os.utime(chunk_dir, (0, 0))
+        self.assertEqual(self.call("init", name="a.mp4", size=10)["state"], "SUCCESS")
+        self.assertFalse(os.path.exists(chunk_dir))
+
+    def test_dedup(self):
+        content = os.urandom(2500)
+        first = self.upload(content)
+        second = self.upload(content)
+        self.assertEqual((first["state"], second["state"]), ("SUCCESS", "SUCCESS"))
+        self.assertEqual(second["url"], first["url"])
+        self.assertEqual(UploadObject.objects.get(storage="local", name=first["url"][len("/media/"):]).ref_count, 2)
+        files = [name for root, dirs, names in os.walk(self.media_root) for name in names]
+        self.assertEqual(len(files), 1)
+
+
+class ScrawlUploadTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_patcher = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.factory = RequestFactory()
+
+    def test_iter_form_field_across_chunks(self):
+        content = os.urandom(3000)
+        body = urlencode({"a": "1+1", "upfile": base64.b64encode(content), "b": "2"}).encode()
+        for chunk_size in (1, 2, 7, 4096):
+            stream = io.BytesIO(body)
+            output = io.BytesIO()
+            decoder = Base64StreamDecoder(output)
+            for chunk in iter_form_field(stream.read, "upfile", chunk_size):
+                decoder.feed(chunk)
+            decoder.close()
+            self.assertEqual(output.getvalue(), content)
+
+    def scrawl(self, data, url="/ueditor/controller/?action=uploadscrawl"):
+        request = self.factory.post(url, urlencode({"upfile": data}),
+                                    content_type="application/x-www-form-urlencoded")
+        return json.loads(UploadFile(request).content)
+
+    def test_scrawl(self):
+        content = os.urandom(100 * 1024)
+        result = self.scrawl("data:image/png;base64," + base64.b64encode(content).decode())
+        self.assertEqual((result["state"], result["size"]), ("SUCCESS", len(content)))
+        with open(os.path.join(self.media_root, result["url"][len("/media/"):]), "rb") as f:
+            self.assertEqual(f.read(), content)
+
+        result = self.scrawl(base64.b64encode(content).decode(),
+                             "/ueditor/controller/?action=uploadscrawl&scrawlMaxSize=51200")
+        self.assertIn("大小", result["state"])
+        # 超过大小时中止，不留下不完整的文件
+        self.assertEqual(len(os.listdir(self.media_root)), 1)
+        self.assertEqual(UEditorFile.objects.count(), 1)
+
+
+class TitleEventHandler(UEditorEventHandler):
+
+    def on_contentchange(self):
+        return "console.log(%(editor)s.getContent());"
+
+
+class WidgetRenderTest(TestCase):
+
+    def test_render_compiled_once(self):
+        class EditorForm(forms.Form):
+            content = forms.CharField(widget=UEditorWidget(attrs={
+                "width": 600, "height": 300, "toolbars": "mini", "imagePath": "images/",
+                "event_handler": TitleEventHandler()}))
+
+        with mock.patch("DjangoUeditor.widgets.render_to_string", wraps=render_to_string) as render:
+            first = str(EditorForm(initial={"content": "<p>a</p>"})["content"])
+            second = str(EditorForm(initial={"content": "<p>b</p>"})["content"])
+        self.assertEqual(render.call_count, 1)
+        self.assertIn("<p>a</p>", first)
+        self.assertEqual(first.replace("<p>a</p>", "<p>b</p>"), second)
+        self.assertIn("id_content.addListener('contentchange'", first)
+        settings_json = first.split("UE.getEditor('id_content',")[1].split(");")[0]
+        self.assertEqual(json.loads(settings_json)["initialFrameWidth"], 600)
+
+    def test_config_etag(self):
+        factory = RequestFactory()
+        response = get_ueditor_controller(factory.get("/ueditor/controller/?action=config"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("max-age=", response["Cache-Control"])
+        self.assertEqual(json.loads(response.content)["imageActionName"], "uploadimage")
+        response = get_ueditor_controller(factory.get("/ueditor/controller/?action=config",
+                                                      HTTP_IF_NONE_MATCH=response["ETag"]))
+        self.assertEqual(response.status_code, 304)
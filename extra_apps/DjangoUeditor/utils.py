@@ -1,4 +1,14 @@
 # coding: utf-8
+import binascii
+import errno
+import hashlib
+import os
+import re
+import shutil
+try:
+    from urllib.parse import unquote_to_bytes
+except ImportError:
+    from urllib import unquote as unquote_to_bytes
 
 
 # 文件大小类
@@ -130,3 +140,163 @@ class FileSize():
                 return True
             else:
                 return False
+
+
+# 上传文件索引
+def index_file(media_root, path):
+    """登记MEDIA_ROOT下的文件，path为相对路径"""
+    from .models import UEditorFile
+    path = path.replace("\\", "/").lstrip("/")
+    stat = os.stat(os.path.join(media_root, path))
+    UEditorFile.objects.update_or_create(path=path, defaults={
+        "ext": os.path.splitext(path)[1], "size": stat.st_size, "mtime": stat.st_mtime})
+
+
+def unindex_file(path):
+    from .models import UEditorFile
+    UEditorFile.objects.filter(path=path.replace("\\", "/").lstrip("/")).delete()
+
+
+def scan_files(media_root, sub_path=""):
+    """用os.scandir遍历目录，每个文件只stat一次，返回(相对路径, stat)"""
+    stack = [os.path.join(media_root, sub_path)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                # 跳过隐藏目录，如分片上传的临时目录
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield os.path.relpath(entry.path, media_root).replace("\\", "/"), entry.stat()
+
+
+def hash_files(paths):
+    """按顺序计算多个文件拼接后内容的sha256"""
+    hasher = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def concat_files(part_paths, dest_path):
+    """按顺序拼接文件，使用os.copy_file_range/os.sendfile在内核中复制，数据不经过进程内存"""
+    with open(dest_path, "wb") as dest:
+        for part_path in part_paths:
+            with open(part_path, "rb") as src:
+                _copy_fd(src.fileno(), dest.fileno(), os.fstat(src.fileno()).st_size)
+
+
+def _copy_fd(src, dest, size):
+    offset = 0
+    try:
+        while offset < size:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src, dest, size - offset)
+            else:
+                copied = os.sendfile(dest, src, offset, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError as e:
+        # 文件系统或系统不支持时按块复制
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EBADF):
+            raise
+    if offset < size:
+        os.lseek(src, offset, os.SEEK_SET)
+        with os.fdopen(os.dup(src), "rb") as reader, os.fdopen(os.dup(dest), "ab") as writer:
+            shutil.copyfileobj(reader, writer, 1024 * 1024)
+
+
+# 涂鸦上传的流式解码
+def iter_form_field(read, field_name, chunk_size=64 * 1024):
+    """
+    从application/x-www-form-urlencoded请求体中流式读取一个字段的值，按块返回url解码后的数据
+    read为读取请求体的函数，如request.read
+    """
+    field_name = field_name.encode("utf-8")
+    name = b""
+    # None: 读取字段名; True: 读取目标字段的值; False: 跳过其他字段的值
+    matched = None
+    carry = b""
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        pos = 0
+        while pos < len(chunk):
+            if matched is None:
+                ends = [index for index in (chunk.find(b"=", pos), chunk.find(b"&", pos)) if index != -1]
+                if not ends:
+                    name += chunk[pos:]
+                    break
+                end = min(ends)
+                name += chunk[pos:end]
+                if chunk[end:end + 1] == b"=":
+                    matched = unquote_to_bytes(name.replace(b"+", b" ")) == field_name
+                name = b""
+                pos = end + 1
+                continue
+            end = chunk.find(b"&", pos)
+            if matched:
+                data = carry + (chunk[pos:] if end == -1 else chunk[pos:end])
+                carry = b""
+                # %XX可能被分块截断，留到下一块
+                cut = data.find(b"%", len(data) - 2) if end == -1 else -1
+                if cut != -1:
+                    data, carry = data[:cut], data[cut:]
+                if data:
+                    yield unquote_to_bytes(data.replace(b"+", b" "))
+            if end == -1:
+                break
+            if matched:
+                return
+            matched = None
+            pos = end + 1
+    if carry:
+        yield unquote_to_bytes(carry)
+
+
+class Base64StreamDecoder(object):
+    """
+    分块解码base64并写入output，每次解码4的整数倍个字符，剩余的留到下一块
+    解码后的大小超过max_size时抛出ValueError
+    """
+    invalid_chars = re.compile(b"[^A-Za-z0-9+/=]")
+
+    def __init__(self, output, max_size=0):
+        self.output = output
+        self.max_size = max_size
+        self.size = 0
+        self.rest = b""
+
+    def feed(self, data):
+        # 兼容带data:image/png;base64,前缀的数据
+        if self.size == 0 and not self.rest and data.startswith(b"data:"):
+            data = data[data.find(b",") + 1:]
+        data = self.rest + self.invalid_chars.sub(b"", data)
+        end = len(data) // 4 * 4
+        self.rest = data[end:]
+        if end:
+            self.write(binascii.a2b_base64(data[:end]))
+
+    def close(self):
+        if self.rest:
+            # 缺少的填充补齐
+            self.write(binascii.a2b_base64(self.rest + b"=" * (-len(self.rest) % 4)))
+            self.rest = b""
+        if self.size == 0:
+            raise ValueError(u"涂鸦数据为空")
+
+    def write(self, decoded):
+        self.size += len(decoded)
+        if self.max_size and self.size > self.max_size:
+            raise ValueError(u"上传文件大小不允许超过%s。" % FileSize(self.max_size).FriendValue)
+        self.output.write(decoded)
@@ -2,18 +2,37 @@
 import os
 import json
 import random
+import hashlib
+import re
+import shutil
+import socket
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from functools import lru_cache
 try:
     # python3
     import urllib.request as urllib
     from urllib.request import urljoin as urljoin
+    from urllib.parse import urlparse
 except:
     # python2
     import urllib
     from urllib import basejoin as urljoin
+    from urlparse import urlparse
 import datetime
+from django.core.cache import cache
 from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from . import settings as USettings
 from django.views.decorators.csrf import csrf_exempt
+from utils import serviceLogger
+from utils.dedupUtil import UploadDedup, add_hashing_handler, file_digest
+from .models import UEditorFile
+from .utils import Base64StreamDecoder, FileSize, concat_files, hash_files, index_file, iter_form_field
 
 
 def get_path_format_vars():
@@ -40,9 +59,40 @@ def save_upload_file(PostFile, FilePath):
     return u"SUCCESS"
 
 
+def save_upload_file_once(request, PostFile, PathFormat, FilePath):
+    """同样内容的文件已保存过时不再写入，返回(文件相对MEDIA_ROOT的路径, 状态)"""
+    dedup = UploadDedup("local")
+    content_hash = file_digest(request, PostFile)
+    exists = lambda name: os.path.exists(os.path.join(USettings.gSettings.MEDIA_ROOT, name))
+    name = dedup.acquire(content_hash, exists=exists)
+    if name is not None:
+        return name, u"SUCCESS"
+    # 保存到文件中，如果保存错误，需要返回ERROR
+    state = save_upload_file(PostFile, FilePath)
+    if state != u"SUCCESS":
+        return PathFormat, state
+    name = dedup.register(content_hash, PostFile.size, PathFormat)
+    if name != PathFormat:
+        # 并发上传了同样的文件，保留先登记的
+        os.remove(FilePath)
+    else:
+        index_file(USettings.gSettings.MEDIA_ROOT, PathFormat)
+    return name, state
+
+
+@lru_cache(maxsize=1)
+def get_ueditor_config():
+    """预先序列化的上传配置和ETag，配置在进程内不变，修改配置后需调用get_ueditor_config.cache_clear()"""
+    content = json.dumps(USettings.UEditorUploadSettings, ensure_ascii=False)
+    return content, hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
 @csrf_exempt
+@condition(etag_func=lambda request: get_ueditor_config()[1])
 def get_ueditor_settings(request):
-    return HttpResponse(json.dumps(USettings.UEditorUploadSettings, ensure_ascii=False), content_type="application/javascript")
+    response = HttpResponse(get_ueditor_config()[0], content_type="application/javascript")
+    patch_cache_control(response, public=True, max_age=getattr(USettings.gSettings, "UEDITOR_CONFIG_MAX_AGE", 3600))
+    return response
 
 
 @csrf_exempt
@@ -60,6 +110,8 @@ def get_ueditor_controller(request):
         "listimage": list_files,
         "listfile": list_files
     }
+    if action in ("uploadvideo", "uploadfile") and "chunk" in request.GET:
+        return chunked_upload(request)
     return reponseAction[action](request)
 
 
@@ -87,46 +139,77 @@ def list_files(request):
     list_size = int(request.GET.get("size", listSize[action]))
     list_start = int(request.GET.get("start", 0))
 
-    files = []
-    root_path = os.path.join(USettings.gSettings.MEDIA_ROOT, listpath[action]).replace("\\", "/")
-    files = get_files(root_path, root_path, allowFiles[action])
+    # 从文件索引中分页查询，最新的文件在前
+    queryset = UEditorFile.objects.order_by("-mtime", "-id")
+    root_path = listpath[action].replace("\\", "/").strip("/")
+    if root_path:
+        queryset = queryset.filter(path__startswith=root_path + "/")
+    if allowFiles[action]:
+        queryset = queryset.filter(ext__in=allowFiles[action])
+    total = queryset.count()
+    files = [{
+        "url": urljoin(USettings.gSettings.MEDIA_URL, path),
+        "mtime": mtime
+    } for path, mtime in queryset.values_list("path", "mtime")[list_start:list_start + list_size]] if total else []
 
     if (len(files) == 0):
         return_info = {
             "state": u"未找到匹配文件！",
             "list": [],
             "start": list_start,
-            "total": 0
+            "total": total
         }
     else:
         return_info = {
             "state": "SUCCESS",
-            "list": files[list_start:list_start + list_size],
+            "list": files,
             "start": list_start,
-            "total": len(files)
+            "total": total
         }
 
     return HttpResponse(json.dumps(return_info), content_type="application/javascript")
 
 
-def get_files(root_path, cur_path, allow_types=[]):
-    files = []
-    items = os.listdir(cur_path)
-    for item in items:
-        item = unicode(item)
-        item_fullname = os.path.join(root_path, cur_path, item).replace("\\", "/")
-        if os.path.isdir(item_fullname):
-            files.extend(get_files(root_path, item_fullname, allow_types))
-        else:
-            ext = os.path.splitext(item_fullname)[1]
-            is_allow_list = (len(allow_types) == 0) or (ext in allow_types)
-            if is_allow_list:
-                files.append({
-                    "url": urljoin(USettings.gSettings.MEDIA_URL, os.path.join(os.path.relpath(cur_path, root_path), item).replace("\\", "/")),
-                    "mtime": os.path.getmtime(item_fullname)
-                })
+# 检测保存路径是否存在,如果不存在则需要创建
+UPLOAD_PATH_FORMAT = {
+    "uploadfile": "filePathFormat",
+    "uploadimage": "imagePathFormat",
+    "uploadscrawl": "scrawlPathFormat",
+    "uploadvideo": "videoPathFormat"
+}
 
-    return files
+
+def check_upload_file(request, action, upload_original_ext, upload_file_size, options=None):
+    """
+    按上传配置检验文件类型和大小，返回SUCCESS或错误信息
+    options为覆盖上传配置的参数，默认为请求的url参数，传{}时只使用服务端配置
+    """
+    options = request.GET if options is None else options
+    state = "SUCCESS"
+    # 文件类型检验
+    upload_allow_type = {
+        "uploadfile": "fileAllowFiles",
+        "uploadimage": "imageAllowFiles",
+        "uploadvideo": "videoAllowFiles"
+    }
+    if action in upload_allow_type:
+        allow_type = list(options.get(upload_allow_type[action], USettings.UEditorUploadSettings.get(upload_allow_type[action], "")))
+        if upload_original_ext not in allow_type:
+            state = u"服务器不允许上传%s类型的文件。" % upload_original_ext
+
+    # 大小检验
+    upload_max_size = {
+        "uploadfile": "fileMaxSize",
+        "uploadimage": "imageMaxSize",
+        "uploadscrawl": "scrawlMaxSize",
+        "uploadvideo": "videoMaxSize"
+    }
+    max_size = int(options.get(upload_max_size[action], USettings.UEditorUploadSettings.get(upload_max_size[action], 0)))
+    if max_size != 0:
+        MF = FileSize(max_size)
+        if upload_file_size > MF.size:
+            state = u"上传文件大小不允许超过%s。" % MF.FriendValue
+    return state
 
 
 @csrf_exempt
@@ -135,8 +218,9 @@ def UploadFile(request):
     if not request.method == "POST":
         return HttpResponse(json.dumps(u"{'state:'ERROR'}"), content_type="application/javascript")
 
-    state = "SUCCESS"
     action = request.GET.get("action")
+    # 接收文件时计算hash，用于去重
+    add_hashing_handler(request)
     # 上传文件
     upload_field_name = {
         "uploadfile": "fileFieldName", "uploadimage": "imageFieldName",
@@ -160,38 +244,7 @@ def UploadFile(request):
     # 取得上传的文件的原始名称
     upload_original_name, upload_original_ext = os.path.splitext(upload_file_name)
 
-    # 文件类型检验
-    upload_allow_type = {
-        "uploadfile": "fileAllowFiles",
-        "uploadimage": "imageAllowFiles",
-        "uploadvideo": "videoAllowFiles"
-    }
-    if action in upload_allow_type:
-        allow_type = list(request.GET.get(upload_allow_type[action], USettings.UEditorUploadSettings.get(upload_allow_type[action], "")))
-        if upload_original_ext not in allow_type:
-            state = u"服务器不允许上传%s类型的文件。" % upload_original_ext
-
-    # 大小检验
-    upload_max_size = {
-        "uploadfile": "filwMaxSize",
-        "uploadimage": "imageMaxSize",
-        "uploadscrawl": "scrawlMaxSize",
-        "uploadvideo": "videoMaxSize"
-    }
-    max_size = int(request.GET.get(upload_max_size[action], USettings.UEditorUploadSettings.get(upload_max_size[action], 0)))
-    if max_size != 0:
-        from .utils import FileSize
-        MF = FileSize(max_size)
-        if upload_file_size > MF.size:
-            state = u"上传文件大小不允许超过%s。" % MF.FriendValue
-
-    # 检测保存路径是否存在,如果不存在则需要创建
-    upload_path_format = {
-        "uploadfile": "filePathFormat",
-        "uploadimage": "imagePathFormat",
-        "uploadscrawl": "scrawlPathFormat",
-        "uploadvideo": "videoPathFormat"
-    }
+    state = check_upload_file(request, action, upload_original_ext, upload_file_size)
 
     path_format_var = get_path_format_vars()
     path_format_var.update({
@@ -200,15 +253,18 @@ def UploadFile(request):
         "filename": upload_file_name,
     })
     # 取得输出文件的路径
-    OutputPathFormat, OutputPath, OutputFile = get_output_path(request, upload_path_format[action], path_format_var)
+    OutputPathFormat, OutputPath, OutputFile = get_output_path(request, UPLOAD_PATH_FORMAT[action], path_format_var)
 
     # 所有检测完成后写入文件
     if state == "SUCCESS":
         if action == "uploadscrawl":
             state = save_scrawl_file(request, os.path.join(OutputPath, OutputFile))
+            if state == u"SUCCESS":
+                upload_file_size = os.path.getsize(os.path.join(OutputPath, OutputFile))
+                index_file(USettings.gSettings.MEDIA_ROOT, OutputPathFormat)
         else:
-            # 保存到文件中，如果保存错误，需要返回ERROR
-            state = save_upload_file(file, os.path.join(OutputPath, OutputFile))
+            OutputPathFormat, state = save_upload_file_once(request, file, OutputPathFormat,
+                                                            os.path.join(OutputPath, OutputFile))
 
     # 返回数据
     return_info = {
@@ -224,68 +280,351 @@ def UploadFile(request):
     return HttpResponse(json.dumps(return_info, ensure_ascii=False), content_type="application/javascript")
 
 
+def chunk_upload_dir(upload_id):
+    return os.path.join(USettings.gSettings.MEDIA_ROOT, getattr(USettings.gSettings, "UEDITOR_CHUNK_DIR", ".chunks"),
+                        upload_id)
+
+
+def chunk_response(return_info, status=200):
+    return HttpResponse(json.dumps(return_info, ensure_ascii=False), content_type="application/javascript",
+                        status=status)
+
+
+CHUNK_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+@csrf_exempt
+def chunked_upload(request):
+    """
+    视频、附件分片上传，参数都在url中: ?action=uploadvideo|uploadfile&chunk=
+        init: POST，name、size，返回upload_id、分片大小chunk_size、分片数chunks
+        put: POST，upload_id、index，请求体为分片数据，分片可以并行、乱序上传
+        status: GET，upload_id，返回已上传的分片，断线后只需上传缺少的分片
+        complete: POST，upload_id，分片齐全后拼接为最终文件，返回与普通上传相同的数据
+    分片保存在MEDIA_ROOT/UEDITOR_CHUNK_DIR/upload_id下，未完成的上传由purge_ueditor_chunks命令清理
+    只允许登录用户上传，每个用户同时最多UEDITOR_CHUNK_MAX_OPEN个未完成的上传，只能操作自己的上传
+    """
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        return chunk_response({"state": u"请先登录"}, status=403)
+    action = request.GET.get("action")
+    step = request.GET.get("chunk")
+    if step == "init" and request.method == "POST":
+        return chunk_init(request, action)
+
+    upload_id = request.GET.get("upload_id", "")
+    if not CHUNK_UPLOAD_ID.match(upload_id):
+        return chunk_response({"state": u"upload_id错误"})
+    try:
+        with open(os.path.join(chunk_upload_dir(upload_id), "meta.json")) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return chunk_response({"state": u"上传不存在或已过期"})
+    if meta["action"] != action or meta.get("user") != user.id:
+        return chunk_response({"state": u"upload_id错误"})
+
+    if step == "status":
+        return chunk_response({"state": "SUCCESS", "upload_id": upload_id, "chunks": meta["chunks"],
+                               "uploaded": uploaded_chunks(upload_id)})
+    if request.method != "POST":
+        return chunk_response({"state": "ERROR"})
+    if step == "put":
+        return chunk_put(request, upload_id, meta)
+    if step == "complete":
+        return chunk_complete(request, upload_id, meta)
+    return chunk_response({"state": "ERROR"})
+
+
+def chunk_init(request, action):
+    upload_file_name = os.path.basename(request.GET.get("name", ""))
+    try:
+        upload_file_size = int(request.GET.get("size", 0))
+    except ValueError:
+        upload_file_size = 0
+    if not upload_file_name or upload_file_size <= 0:
+        return chunk_response({"state": u"文件名或文件大小错误"})
+    # 分片上传的文件较大，只按服务端配置检验，不接受url参数覆盖大小限制
+    state = check_upload_file(request, action, os.path.splitext(upload_file_name)[1], upload_file_size, options={})
+    if state != "SUCCESS":
+        return chunk_response({"state": state})
+    if count_open_uploads(request.user.id) >= getattr(USettings.gSettings, "UEDITOR_CHUNK_MAX_OPEN", 3):
+        return chunk_response({"state": u"未完成的上传过多，请稍后再试"})
+
+    chunk_size = getattr(USettings.gSettings, "UEDITOR_CHUNK_SIZE", 4 * 1024 * 1024)
+    meta = {
+        "user": request.user.id,
+        "action": action,
+        "name": upload_file_name,
+        "size": upload_file_size,
+        "chunk_size": chunk_size,
+        "chunks": (upload_file_size + chunk_size - 1) // chunk_size,
+    }
+    upload_id = uuid.uuid4().hex
+    os.makedirs(chunk_upload_dir(upload_id))
+    with open(os.path.join(chunk_upload_dir(upload_id), "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return chunk_response({"state": "SUCCESS", "upload_id": upload_id, "chunk_size": chunk_size,
+                           "chunks": meta["chunks"]})
+
+
+def count_open_uploads(user_id):
+    """用户未完成的分片上传数，顺便删除该用户超过UEDITOR_CHUNK_EXPIRE秒没有上传分片的上传"""
+    root = os.path.join(USettings.gSettings.MEDIA_ROOT, getattr(USettings.gSettings, "UEDITOR_CHUNK_DIR", ".chunks"))
+    before = time.time() - getattr(USettings.gSettings, "UEDITOR_CHUNK_EXPIRE", 24 * 3600)
+    count = 0
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return 0
+    with entries:
+        for entry in entries:
+            try:
+                with open(os.path.join(entry.path, "meta.json")) as f:
+                    if json.load(f).get("user") != user_id:
+                        continue
+                mtime = entry.stat().st_mtime
+            except (IOError, ValueError):
+                continue
+            if mtime < before:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                count += 1
+    return count
+
+
+def uploaded_chunks(upload_id):
+    return sorted(int(name) for name in os.listdir(chunk_upload_dir(upload_id)) if name.isdigit())
+
+
+def chunk_put(request, upload_id, meta):
+    """分片先写入临时文件，大小正确后再改名，同一分片重复上传时后完成的覆盖先完成的"""
+    try:
+        index = int(request.GET.get("index", -1))
+    except ValueError:
+        index = -1
+    if not 0 <= index < meta["chunks"]:
+        return chunk_response({"state": u"分片序号错误"})
+    expected = min(meta["chunk_size"], meta["size"] - index * meta["chunk_size"])
+    # 写入前按请求头检查分片大小
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or -1)
+    except ValueError:
+        content_length = -1
+    if content_length != expected:
+        return chunk_response({"state": u"分片大小错误", "index": index})
+
+    chunk_path = os.path.join(chunk_upload_dir(upload_id), "%d" % index)
+    tmp_path = "%s.%s.tmp" % (chunk_path, uuid.uuid4().hex)
+    received = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            # 直接读取请求体，不经过django的上传文件处理
+            while received <= expected:
+                data = request.read(64 * 1024)
+                if not data:
+                    break
+                received += len(data)
+                f.write(data)
+    except IOError as e:
+        received = -1
+        serviceLogger.warning("分片上传中断 %s/%d: %s", upload_id, index, e)
+    if received != expected:
+        os.remove(tmp_path)
+        return chunk_response({"state": u"分片大小错误", "index": index})
+    os.replace(tmp_path, chunk_path)
+    return chunk_response({"state": "SUCCESS", "index": index})
+
+
+def chunk_complete(request, upload_id, meta):
+    upload_dir = chunk_upload_dir(upload_id)
+    missing = sorted(set(range(meta["chunks"])) - set(uploaded_chunks(upload_id)))
+    if missing:
+        return chunk_response({"state": u"分片未上传完成", "missing": missing})
+    # 防止重复提交时同时拼接
+    lock_path = os.path.join(upload_dir, "complete.lock")
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return chunk_response({"state": u"文件正在合并"})
+
+    upload_original_name, upload_original_ext = os.path.splitext(meta["name"])
+    path_format_var = get_path_format_vars()
+    path_format_var.update({
+        "basename": upload_original_name,
+        "extname": upload_original_ext[1:],
+        "filename": meta["name"],
+    })
+    OutputPathFormat, OutputPath, OutputFile = get_output_path(request, UPLOAD_PATH_FORMAT[meta["action"]],
+                                                               path_format_var)
+    parts = [os.path.join(upload_dir, "%d" % index) for index in range(meta["chunks"])]
+    # 与普通上传一样按内容去重，已有同样内容的文件时不再拼接
+    content_hash = hash_files(parts)
+    name = UploadDedup("local").acquire(content_hash, exists=lambda name: os.path.exists(
+        os.path.join(USettings.gSettings.MEDIA_ROOT, name)))
+    if name is None:
+        try:
+            concat_files(parts, os.path.join(OutputPath, OutputFile))
+        except Exception as e:
+            os.remove(lock_path)
+            return chunk_response({"state": u"写入文件错误:%s" % e})
+        name = save_file_once(content_hash, meta["size"], OutputPathFormat)
+    OutputPathFormat = name
+    shutil.rmtree(upload_dir, ignore_errors=True)
+
+    return chunk_response({
+        'url': urljoin(USettings.gSettings.MEDIA_URL, OutputPathFormat),
+        'original': meta["name"],
+        'type': upload_original_ext,
+        'state': "SUCCESS",
+        'size': meta["size"]
+    })
+
+
+def get_catcher_executor():
+    """进程内共享的抓图线程池，大小为UEDITOR_CATCHER_THREADS"""
+    global _catcher_executor
+    if _catcher_executor is None:
+        with _catcher_lock:
+            if _catcher_executor is None:
+                _catcher_executor = ThreadPoolExecutor(
+                    max_workers=getattr(USettings.gSettings, "UEDITOR_CATCHER_THREADS", 8),
+                    thread_name_prefix="ueditor-catcher")
+    return _catcher_executor
+
+
+_catcher_executor = None
+_catcher_lock = threading.Lock()
+
+
+def fetch_remote_file(remote_url, filename, max_size, deadline):
+    """
+    分块下载远程文件到filename，同时计算sha256，返回(文件大小, sha256)
+    单个请求超时为UEDITOR_CATCHER_TIMEOUT，超过max_size或deadline时中止并删除已下载的部分
+    """
+    timeout = min(getattr(USettings.gSettings, "UEDITOR_CATCHER_TIMEOUT", 5), max(deadline - time.monotonic(), 0.1))
+    part_filename = filename + ".part"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with closing(urllib.urlopen(remote_url, timeout=timeout)) as remote_file, open(part_filename, "wb") as f:
+            length = remote_file.headers.get("Content-Length")
+            if max_size and length and length.isdigit() and int(length) > max_size:
+                raise ValueError(u"图片大小超过限制")
+            while True:
+                chunk = remote_file.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise ValueError(u"图片大小超过限制")
+                if time.monotonic() > deadline:
+                    raise socket.timeout(u"抓取超时")
+                hasher.update(chunk)
+                f.write(chunk)
+        if time.monotonic() > deadline:
+            raise socket.timeout(u"抓取超时")
+        os.rename(part_filename, filename)
+    except Exception:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
+    return size, hasher.hexdigest()
+
+
 @csrf_exempt
 def catcher_remote_image(request):
     """远程抓图，当catchRemoteImageEnable:true时，
         如果前端插入图片地址与当前web不在同一个域，则由本函数从远程下载图片到本地
+        多个图片并行下载，总耗时不超过UEDITOR_CATCHER_TOTAL_TIMEOUT，抓取过的地址在缓存中记录保存的文件，不再下载
     """
     if not request.method == "POST":
         return HttpResponse(json.dumps(u"{'state:'ERROR'}"), content_type="application/javascript")
 
-    state = "SUCCESS"
-
     allow_type = list(request.GET.get("catcherAllowFiles", USettings.UEditorUploadSettings.get("catcherAllowFiles", "")))
     max_size = int(request.GET.get("catcherMaxSize", USettings.UEditorUploadSettings.get("catcherMaxSize", 0)))
+    deadline = time.monotonic() + getattr(USettings.gSettings, "UEDITOR_CATCHER_TOTAL_TIMEOUT", 15)
 
     remote_urls = request.POST.getlist("source[]", [])
-    catcher_infos = []
-    path_format_var = get_path_format_vars()
-
+    catcher_infos = {}
+    jobs = {}
     for remote_url in remote_urls:
+        if remote_url in catcher_infos or remote_url in jobs:
+            continue
+        url_path = urlparse(remote_url)
         # 取得上传的文件的原始名称
-        remote_file_name = os.path.basename(remote_url)
+        remote_file_name = os.path.basename(url_path.path)
         remote_original_name, remote_original_ext = os.path.splitext(remote_file_name)
-        # 文件类型检验
-        if remote_original_ext in allow_type:
-            path_format_var.update({
-                "basename": remote_original_name,
-                "extname": remote_original_ext[1:],
-                "filename": remote_original_name
-            })
-            # 计算保存的文件名
-            o_path_format, o_path, o_file = get_output_path(request, "catcherPathFormat", path_format_var)
-            o_filename = os.path.join(o_path, o_file).replace("\\", "/")
-            # 读取远程图片文件
-            try:
-                remote_image = urllib.urlopen(remote_url)
-                # 将抓取到的文件写入文件
-                try:
-                    f = open(o_filename, 'wb')
-                    f.write(remote_image.read())
-                    f.close()
-                    state = "SUCCESS"
-                except Exception as e:
-                    state = u"写入抓取图片文件错误:%s" % e
-            except Exception as e:
-                state = u"抓取图片错误：%s" % e
-
-            catcher_infos.append({
-                "state": state,
-                "url": urljoin(USettings.gSettings.MEDIA_URL, o_path_format),
-                "size": os.path.getsize(o_filename),
-                "title": os.path.basename(o_file),
-                "original": remote_file_name,
-                "source": remote_url
-            })
+        # 文件类型检验，只抓取http(s)地址
+        if remote_original_ext not in allow_type or url_path.scheme not in ("http", "https"):
+            continue
+        info = {
+            "title": remote_file_name,
+            "original": remote_file_name,
+            "source": remote_url
+        }
+        cached = cache.get(catcher_cache_key(remote_url))
+        if cached is not None and os.path.exists(os.path.join(USettings.gSettings.MEDIA_ROOT, cached["path"])):
+            info.update(state="SUCCESS", url=urljoin(USettings.gSettings.MEDIA_URL, cached["path"]),
+                        size=cached["size"], title=os.path.basename(cached["path"]))
+            catcher_infos[remote_url] = info
+            continue
+        # 每个文件单独计算保存的文件名，避免同名文件互相覆盖
+        path_format_var = get_path_format_vars()
+        path_format_var.update({
+            "basename": remote_original_name,
+            "extname": remote_original_ext[1:],
+            "filename": remote_original_name
+        })
+        o_path_format, o_path, o_file = get_output_path(request, "catcherPathFormat", path_format_var)
+        o_filename = os.path.join(o_path, o_file).replace("\\", "/")
+        info["title"] = os.path.basename(o_file)
+        jobs[remote_url] = (info, o_path_format, get_catcher_executor().submit(
+            fetch_remote_file, remote_url, o_filename, max_size, deadline))
+
+    if jobs:
+        wait([future for info, o_path_format, future in jobs.values()], timeout=max(deadline - time.monotonic(), 0))
+    for remote_url, (info, o_path_format, future) in jobs.items():
+        info["size"] = 0
+        info["url"] = urljoin(USettings.gSettings.MEDIA_URL, o_path_format)
+        error = future.exception() if future.done() else socket.timeout()
+        if isinstance(error, socket.timeout) or isinstance(getattr(error, "reason", None), socket.timeout):
+            # 未完成的下载在下一次读取时中止
+            info["state"] = u"抓取图片错误：抓取超时"
+        elif error is not None:
+            info["state"] = u"抓取图片错误：%s" % error
+        else:
+            size, content_hash = future.result()
+            path = save_file_once(content_hash, size, o_path_format)
+            cache.set(catcher_cache_key(remote_url), {"path": path, "size": size},
+                      getattr(USettings.gSettings, "UEDITOR_CATCHER_CACHE_TIMEOUT", 86400))
+            info.update(state="SUCCESS", url=urljoin(USettings.gSettings.MEDIA_URL, path), size=size)
+        catcher_infos[remote_url] = info
 
     return_info = {
         "state": "SUCCESS" if len(catcher_infos) > 0 else "ERROR",
-        "list": catcher_infos
+        "list": [catcher_infos[remote_url] for remote_url in dict.fromkeys(remote_urls) if remote_url in catcher_infos]
     }
 
     return HttpResponse(json.dumps(return_info, ensure_ascii=False), content_type="application/javascript")
 
 
+def catcher_cache_key(remote_url):
+    return "ueditor:catcher:%s" % hashlib.md5(remote_url.encode("utf-8")).hexdigest()
+
+
+def save_file_once(content_hash, size, path):
+    """已写入的文件(抓取、分片拼接)与已保存的文件内容相同时删除新文件，返回保存的文件路径"""
+    dedup = UploadDedup("local")
+    full_path = os.path.join(USettings.gSettings.MEDIA_ROOT, path)
+    name = dedup.acquire(content_hash, exists=lambda name: os.path.exists(os.path.join(
+        USettings.gSettings.MEDIA_ROOT, name))) or dedup.register(content_hash, size, path)
+    if name != path:
+        os.remove(full_path)
+    else:
+        index_file(USettings.gSettings.MEDIA_ROOT, path)
+    return name
+
+
 def get_output_path(request, path_format, path_format_var):
     # 取得输出文件的路径
     OutputPathFormat = (request.GET.get(path_format, USettings.UEditorSettings["defaultPathFormat"]) % path_format_var).replace("\\", "/")
@@ -304,13 +643,29 @@ def get_output_path(request, path_format, path_format_var):
 # 涂鸦功能上传处理
 @csrf_exempt
 def save_scrawl_file(request, filename):
-    import base64
+    """按块读取请求体中的base64数据，解码后直接写入文件，不在内存中保存整个图片"""
+    field_name = USettings.UEditorUploadSettings.get("scrawlFieldName", "upfile")
+    max_size = int(request.GET.get("scrawlMaxSize", USettings.UEditorUploadSettings.get("scrawlMaxSize", 0)))
+    # url编码的base64最多为原大小的4倍，超过时不读取请求体直接拒绝
+    if max_size and int(request.META.get("CONTENT_LENGTH") or 0) > max_size * 4:
+        return u"上传文件大小不允许超过%s。" % FileSize(max_size).FriendValue
+    if request.content_type == "application/x-www-form-urlencoded" and not hasattr(request, "_post"):
+        chunks = iter_form_field(request.read, field_name)
+    else:
+        # multipart等请求由django解析
+        chunks = [request.POST.get(field_name, "").encode("utf-8")]
+
+    part_filename = filename + ".part"
     try:
-        content = request.POST.get(USettings.UEditorUploadSettings.get("scrawlFieldName", "upfile"))
-        f = open(filename, 'wb')
-        f.write(base64.decodestring(content))
-        f.close()
+        with open(part_filename, "wb") as f:
+            decoder = Base64StreamDecoder(f, max_size)
+            for chunk in chunks:
+                decoder.feed(chunk)
+            decoder.close()
+        os.rename(part_filename, filename)
         state = "SUCCESS"
     except Exception as e:
-        state = u"写入图片文件错误:%s" % e
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        state = u"%s" % e if isinstance(e, ValueError) else u"写入图片文件错误:%s" % e
     return state
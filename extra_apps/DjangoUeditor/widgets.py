@@ -1,4 +1,6 @@
 # coding:utf-8
+import json
+
 from django import forms
 from django.conf import settings
 from django.contrib.admin.widgets import AdminTextareaWidget
@@ -9,6 +11,9 @@ from django.utils.http import urlencode
 from . import settings as uSettings
 from .commands import *
 
+# 渲染时替换为编辑器内容的占位符
+VALUE_PLACEHOLDER = "\x00UEDITOR_VALUE\x00"
+
 # 修正输入的文件路径,输入路径的标准格式：abc,不需要前后置的路径符号
 # 如果输入的路径参数是一个函数则执行，否则可以拉接受时间格式化，用来生成如file20121208.bmp的重命名格式
 
@@ -77,6 +82,12 @@ class UEditorWidget(forms.Textarea):
         except:
             pass
         self.ueditor_settings.update(settings)
+        # 编辑器配置不随渲染变化，预先序列化
+        self._settings_json = json.dumps(dict(self.ueditor_settings, **{
+            "serverUrl": "/ueditor/controller/?%s" % urlencode(self._upload_settings)
+        }), ensure_ascii=False)
+        # 按字段名缓存渲染结果，表单复制控件时为浅复制，同一个字段的控件共用
+        self._compiled = {}
         super(UEditorWidget, self).__init__(attrs)
 
     # def recalc_path(self, model_inst):
@@ -164,29 +175,36 @@ class UEditorWidget(forms.Textarea):
         except:
             pass
 
-    def render(self, name, value, attrs=None):
+    def render(self, name, value, attrs=None, renderer=None):
         if value is None:
             value = ''
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            compiled = self._compiled[name] = self.compile(name)
+        # 内容原样输出，与模板中的{{ UEditor.value|safe }}一致
+        return mark_safe(compiled.replace(VALUE_PLACEHOLDER, str(value)))
+
+    def compile(self, name):
+        """
+        渲染除内容外的部分，按字段名缓存
+        命令、事件的js和编辑器配置只在第一次渲染时生成，之后每次渲染只替换内容
+        """
         # 传入模板的参数
         editor_id = "id_%s" % name.replace("-", "_")
         uSettings = {
             "name": name,
             "id": editor_id,
-            "value": value
+            "value": VALUE_PLACEHOLDER
         }
         if isinstance(self.command, list):
             cmdjs = ""
-            if isinstance(self.command, list):
-                for cmd in self.command:
-                    cmdjs = cmdjs + cmd.render(editor_id)
-            else:
-                cmdis = self.command.render(editor_id)
+            for cmd in self.command:
+                cmdjs = cmdjs + cmd.render(editor_id)
             uSettings["commands"] = cmdjs
+        elif self.command is not None:
+            uSettings["commands"] = self.command.render(editor_id)
 
-        uSettings["settings"] = self.ueditor_settings.copy()
-        uSettings["settings"].update({
-            "serverUrl": "/ueditor/controller/?%s" % urlencode(self._upload_settings)
-        })
+        uSettings["settings"] = self._settings_json
         # 生成事件侦听
         if self.event_handler:
             uSettings["bindEvents"] = self.event_handler.render(editor_id)
@@ -198,7 +216,7 @@ class UEditorWidget(forms.Textarea):
             'MEDIA_URL': settings.MEDIA_URL,
             'MEDIA_ROOT': settings.MEDIA_ROOT
         }
-        return mark_safe(render_to_string('ueditor.html', context))
+        return render_to_string('ueditor.html', context)
 
     class Media:
         js = ("ueditor/ueditor.config.js",